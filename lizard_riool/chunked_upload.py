@@ -0,0 +1,222 @@
+"""Resumable uploads in chunks.
+
+Plupload sends a large file in chunks, one request each. The chunks of
+a file are kept per upload session: a name for the file that the client
+chooses, per user. Each chunk is written straight into place in the
+session's data file, at its offset, so chunks may arrive in any order,
+and more than once. A chunk only counts as present once it is on disk,
+with the SHA-1 checksum of its contents next to it; a client whose
+connection dropped can ask which chunks are present (see
+views.upload_chunks()) and send only the others.
+
+Sessions are kept below Upload.BASE_PATH, on the same file system as
+the uploads, so that the complete file becomes an Upload by renaming
+it: the data is never copied.
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import re
+import shutil
+import time
+
+from django.utils import simplejson as json
+
+from lizard_riool.models import Upload
+
+logger = logging.getLogger(__name__)
+
+SESSION_PATTERN = re.compile(r'^[\w.-]{1,100}$')
+SESSIONS_DIRECTORY = 'sessions'
+# Sessions without a new chunk for this long are removed
+SESSION_TIMEOUT = 2 * 24 * 60 * 60
+
+CHUNK_PATTERN = re.compile(r'^chunk-(\d+)\.sha1$')
+
+
+def sessions_path():
+    return os.path.join(Upload.BASE_PATH, SESSIONS_DIRECTORY)
+
+
+def remove_stale_sessions(timeout=SESSION_TIMEOUT):
+    "Remove the directories of sessions that were abandoned."
+    path = sessions_path()
+    if not os.path.exists(path):
+        return
+    for name in os.listdir(path):
+        directory = os.path.join(path, name)
+        try:
+            stale = os.path.getmtime(directory) < time.time() - timeout
+        except OSError:
+            continue  # Removed meanwhile
+        if stale:
+            logger.info("Removing abandoned upload session %s.", name)
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+class ChunkedUpload(object):
+    """The chunks of a file uploaded in an upload session. Methods
+    raise ValueError for requests that don't fit the session."""
+
+    def __init__(self, user_id, session):
+        if not session or not SESSION_PATTERN.match(session):
+            raise ValueError(
+                "Ongeldige upload sessie: '{0}'.".format(session))
+        self.directory = os.path.join(
+            sessions_path(), '{0}-{1}'.format(user_id, session))
+
+    @property
+    def data_path(self):
+        return os.path.join(self.directory, 'data')
+
+    @property
+    def info_path(self):
+        return os.path.join(self.directory, 'session.json')
+
+    def chunk_path(self, chunk):
+        return os.path.join(self.directory, 'chunk-{0}.sha1'.format(chunk))
+
+    def start(self, filename, chunks, chunk_size):
+        """Make the session, if it is new. Otherwise, check that the
+        file, its number of chunks and their size are the same as
+        when it was made."""
+        filename = os.path.basename(filename)
+        if filename in ('', '.', '..'):
+            raise ValueError(
+                "Ongeldige bestandsnaam: '{0}'.".format(filename))
+        if chunks < 1 or (chunks > 1 and chunk_size < 1):
+            raise ValueError("Ongeldig aantal of grootte van delen.")
+        info = {
+            'filename': filename,
+            'chunks': chunks,
+            'chunk_size': chunk_size if chunks > 1 else 0,
+            }
+
+        if not os.path.exists(self.directory):
+            remove_stale_sessions()
+            try:
+                os.makedirs(self.directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        # Linking fails if the file exists, so that of concurrent
+        # requests for a new session, only one makes it
+        temporary = '{0}.{1}'.format(self.info_path, os.getpid())
+        with open(temporary, 'w') as f:
+            json.dump(info, f)
+        try:
+            os.link(temporary, self.info_path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        finally:
+            os.remove(temporary)
+
+        if self.info() != info:
+            raise ValueError(
+                "Upload sessie hoort bij een ander bestand: {0}."
+                .format(self.info()))
+
+    def info(self):
+        with open(self.info_path) as f:
+            return json.load(f)
+
+    def write_chunk(self, chunk, data, checksum=None):
+        """Write chunk number chunk, whose contents are the strings in
+        data, at its place in the data file. If checksum is given, it
+        must be the SHA-1 (in hex) of the contents. Data that doesn't
+        fit in the chunk is never written, so that it can't overwrite
+        the next one."""
+        info = self.info()
+        last = info['chunks'] - 1
+        if not 0 <= chunk <= last:
+            raise ValueError("Ongeldig deel: {0}.".format(chunk))
+        # The only chunk of a file has no size limit
+        maximum = info['chunk_size'] if last > 0 else None
+
+        # Sent again, so it may be changing now
+        if os.path.exists(self.chunk_path(chunk)):
+            os.remove(self.chunk_path(chunk))
+
+        digest = hashlib.sha1()
+        size = 0
+        fd = os.open(self.data_path, os.O_RDWR | os.O_CREAT, 0644)
+        with os.fdopen(fd, 'r+b') as f:
+            f.seek(chunk * info['chunk_size'])
+            for string in data:
+                if maximum is not None and size + len(string) > maximum:
+                    raise ValueError(
+                        "Deel {0} is groter dan {1} bytes."
+                        .format(chunk, maximum))
+                digest.update(string)
+                size += len(string)
+                f.write(string)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if chunk < last and size != info['chunk_size']:
+            raise ValueError(
+                "Deel {0} heeft de verkeerde grootte: {1} bytes."
+                .format(chunk, size))
+        if checksum and checksum.lower() != digest.hexdigest():
+            raise ValueError(
+                "Deel {0} is beschadigd overgekomen.".format(chunk))
+
+        # Only now is the chunk present
+        temporary = '{0}.{1}'.format(self.chunk_path(chunk), os.getpid())
+        with open(temporary, 'w') as f:
+            f.write('{0} {1}'.format(digest.hexdigest(), size))
+        os.rename(temporary, self.chunk_path(chunk))
+
+    def present_chunks(self):
+        """Return a dictionary chunk number: SHA-1 checksum of the
+        chunks that are present."""
+        if not os.path.exists(self.directory):
+            return {}
+        present = dict()
+        for name in os.listdir(self.directory):
+            match = CHUNK_PATTERN.match(name)
+            if match:
+                with open(os.path.join(self.directory, name)) as f:
+                    present[int(match.group(1))] = f.read().split()[0]
+        return present
+
+    def assemble(self):
+        """If all chunks are present, return the path of the complete
+        file, with the client's filename, in the session directory.
+        Otherwise, or if a concurrent request already did, return
+        None."""
+        info = self.info()
+        last = info['chunks'] - 1
+        if len(self.present_chunks()) < info['chunks']:
+            return None
+
+        # Renaming succeeds only once. In a directory of its own, so
+        # that the filename can't be that of one of the other files.
+        directory = os.path.join(self.directory, 'complete')
+        try:
+            os.mkdir(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        path = os.path.join(directory, info['filename'])
+        try:
+            os.rename(self.data_path, path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+        # A larger last chunk that was sent before may have left bytes
+        # after the end
+        with open(self.chunk_path(last)) as f:
+            last_size = int(f.read().split()[1])
+        with open(path, 'r+b') as f:
+            f.truncate(last * info['chunk_size'] + last_size)
+        return path
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,70 @@
+"""Coordinate transformations of whole arrays of points at once.
+
+Coordinates used to be transformed one point or geometry at a time,
+by sufriblib during parsing and by GEOS in the views. Here, pyproj
+transforms arrays of coordinates in one call, and the Proj objects are
+made once per SRID and then cached.
+
+GEOS transform() is not accurate for 28992 (the infamous towgs84
+parameter is missing), so RD uses lizard_map's definition, like it
+always did.
+"""
+
+import logging
+
+from lizard_map.coordinates import RD
+
+import numpy as np
+import pyproj
+
+logger = logging.getLogger(__name__)
+
+WGS84_SRID = 4326
+RD_SRID = 28992
+GOOGLE_SRID = 3857  # aka 900913
+
+# Definitions of SRIDs that need more than 'init=epsg:<srid>', or that
+# older proj versions don't know.
+PROJ4_DEFINITIONS = {
+    WGS84_SRID: "+proj=longlat +datum=WGS84 +no_defs",
+    RD_SRID: RD,
+    GOOGLE_SRID: (
+        "+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 "
+        "+x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +no_defs"),
+    }
+PROJ4_DEFINITIONS[900913] = PROJ4_DEFINITIONS[GOOGLE_SRID]
+
+# SRID: pyproj.Proj
+_projections = dict()
+
+
+def projection(srid):
+    "Return the (cached) pyproj.Proj of an SRID."
+    if srid not in _projections:
+        if srid in PROJ4_DEFINITIONS:
+            _projections[srid] = pyproj.Proj(PROJ4_DEFINITIONS[srid])
+        else:
+            _projections[srid] = pyproj.Proj(init='epsg:{0}'.format(srid))
+    return _projections[srid]
+
+
+def transform(xs, ys, from_srid, to_srid):
+    """Transform the points (xs[i], ys[i]) from one SRID to another.
+    xs and ys can be sequences or arrays; returns two float arrays.
+    Longitudes and latitudes are in degrees."""
+    xs = np.array(xs, dtype=np.float64)
+    ys = np.array(ys, dtype=np.float64)
+    if from_srid == to_srid or not len(xs):
+        return xs, ys
+    return pyproj.transform(
+        projection(from_srid), projection(to_srid), xs, ys)
+
+
+def rd_to_wgs84(xs, ys):
+    return transform(xs, ys, RD_SRID, WGS84_SRID)
+
+
+def transform_point(x, y, from_srid, to_srid):
+    "Transform a single point, returns (x, y)."
+    xs, ys = transform([x], [y], from_srid, to_srid)
+    return float(xs[0]), float(ys[0])
@@ -0,0 +1,125 @@
+"""Disk cache of rendered side profile images.
+
+Images are stored as <key>.png files in one directory, where the key is
+a hash of everything that determines the image (see image_key()), so
+an image never has to be invalidated: if the data changes, so does
+the key. The directory is kept under a maximum size by removing the
+least recently used images; a file's access time is set whenever it
+is used, its modification time is when it was rendered.
+
+Settings:
+- LIZARD_RIOOL_IMAGE_CACHE_DIR: the directory, by default
+  var/lizard_riool/side_profiles in the buildout
+- LIZARD_RIOOL_IMAGE_CACHE_MAX_BYTES: the maximum total size of the
+  images, by default 100 MB
+
+The image_rendered signal is sent after each cold render, with the
+key and the duration in seconds, so that they can be measured.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.dispatch import Signal
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = getattr(
+    settings, 'LIZARD_RIOOL_IMAGE_CACHE_DIR', os.path.join(
+        settings.BUILDOUT_DIR, 'var', 'lizard_riool', 'side_profiles'))
+MAX_BYTES = getattr(
+    settings, 'LIZARD_RIOOL_IMAGE_CACHE_MAX_BYTES', 100 * 1024 * 1024)
+
+image_rendered = Signal(providing_args=["key", "duration"])
+
+
+def image_key(sewerage_pk, manholes, width, height, data_version):
+    """Return the key of the side profile image of the route along
+    manholes (a list of codes, in order) of this size, made from this
+    version of the sewerage data."""
+    description = json.dumps(
+        [sewerage_pk, list(manholes), width, height, data_version])
+    return hashlib.sha1(description).hexdigest()
+
+
+def image_path(key):
+    return os.path.join(CACHE_DIR, key + ".png")
+
+
+def get(key):
+    """Return (png, mtime) of the cached image, or (None, None) if it
+    isn't cached. Marks the image as used."""
+    path = image_path(key)
+    try:
+        with open(path, 'rb') as f:
+            png = f.read()
+        mtime = os.path.getmtime(path)
+        os.utime(path, (time.time(), mtime))
+    except (IOError, OSError):
+        return None, None
+    return png, mtime
+
+
+def put(key, png):
+    """Store the image, then remove least recently used images until
+    the cache is below MAX_BYTES. Return the mtime of the stored
+    image."""
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+
+    # Write to a temporary file first, so that concurrent requests
+    # never read half an image.
+    fd, temp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    with os.fdopen(fd, 'wb') as f:
+        f.write(png)
+    os.rename(temp_path, image_path(key))
+
+    evict(keep=key)
+    return os.path.getmtime(image_path(key))
+
+
+def evict(keep=None):
+    """Remove least recently used images, except the one with key
+    keep, until their total size is at most MAX_BYTES."""
+    images = []
+    for filename in os.listdir(CACHE_DIR):
+        if not filename.endswith(".png") or filename[:-4] == keep:
+            continue
+        path = os.path.join(CACHE_DIR, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue  # Removed by another process
+        images.append((stat.st_atime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in images)
+    if keep is not None and os.path.exists(image_path(keep)):
+        total += os.path.getsize(image_path(keep))
+
+    for _, size, path in sorted(images):
+        if total <= MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def render(key, render_function, *args, **kwargs):
+    """Call render_function(*args, **kwargs), which should return a
+    PNG, and store the result under key. Returns (png, mtime). Sends
+    image_rendered with the time the rendering took."""
+    start = time.time()
+    png = render_function(*args, **kwargs)
+    duration = time.time() - start
+
+    logger.debug("Rendered side profile %s in %.3f s.", key, duration)
+    image_rendered.send(sender=render_function, key=key, duration=duration)
+
+    return png, put(key, png)
@@ -3,7 +3,6 @@ import os
 
 from django.conf import settings
 from django.contrib.gis import geos
-from django.contrib.gis.geos import fromstr
 from staticfiles import finders
 import mapnik
 
@@ -11,10 +10,14 @@ from lizard_map.models import ICON_ORIGINALS
 from lizard_map.symbol_manager import SymbolManager
 from lizard_map.workspace import WorkspaceItemAdapter
 
+from lizard_riool import coordinates
 from lizard_riool.models import Manhole
 from lizard_riool.models import Sewer
+from lizard_riool.models import Sewerage
 from lizard_riool.models import SewerMeasurement
 from lizard_riool.models import CLASSES
+from lizard_riool.models import needs_measurement_rows
+from lizard_riool.save_uploaded_data import MEASUREMENT_STORAGE
 
 logger = logging.getLogger(__name__)
 
@@ -64,12 +67,14 @@ class SewerageAdapter(WorkspaceItemAdapter):
         if qs.count() < 1:
             return super(SewerageAdapter, self).extent(identifiers)
         else:
-            box = fromstr('MULTIPOINT (%s %s, %s %s)' % qs.extent())
-            box.set_srid(qs[0].the_geom.srid)
-            box.transform(3857)  # aka 900913
+            xmin, ymin, xmax, ymax = qs.extent()
+            xs, ys = coordinates.transform(
+                [xmin, xmax], [ymin, ymax],
+                Manhole._meta.get_field('the_geom').srid,
+                coordinates.GOOGLE_SRID)
             return {
-                'west': box[0].x, 'south': box[0].y,  # xmin, ymin
-                'east': box[1].x, 'north': box[1].y,  # xmax, ymax
+                'west': xs[0], 'south': ys[0],  # xmin, ymin
+                'east': xs[1], 'north': ys[1],  # xmax, ymax
             }
 
     def search(self, x, y, radius=None):
@@ -81,6 +86,7 @@ class SewerageAdapter(WorkspaceItemAdapter):
 
         """
         pnt = geos.Point(x, y, srid=3857)  # aka 900913
+        self.__materialize_measurements()
 
         qs = (
             SewerMeasurement.objects.
@@ -100,6 +106,21 @@ class SewerageAdapter(WorkspaceItemAdapter):
             'stored_graph_id': m.pk,
         }]
 
+    def __materialize_measurements(self):
+        """The layer and search query SewerMeasurement rows; make them
+        if the measurements were only saved packed. This runs for every
+        tile, so it only gets the sewerage (and locks it) when rows
+        have to be made, and does nothing if measurements are saved as
+        rows."""
+        if MEASUREMENT_STORAGE == 'rows':
+            return
+        if not needs_measurement_rows(self.id):
+            return
+        try:
+            Sewerage.objects.get(pk=self.id).materialize_measurements()
+        except Sewerage.DoesNotExist:
+            pass
+
     def legend(self, updates=None):
         """Return a legend describing the different classes of lost capacity.
 
@@ -160,6 +181,7 @@ class SewerageAdapter(WorkspaceItemAdapter):
     def __add_measurements(self, layers, styles):
         "Docstring."
 
+        self.__materialize_measurements()
         measurements = SewerMeasurement.objects.filter(
             sewer__sewerage__pk=self.id
         )
@@ -0,0 +1,268 @@
+"""Random access to the lines of uploaded files.
+
+Uploaded RIB and RMB files can be tens of megabytes. To show a few
+lines of one, or to read the records of a single sewer, reading it
+from the start is wasteful. A LineIndex keeps the byte offset of the
+start of every line, the record type of every line ('*RIOO', '*MRIO',
+...) and the runs of consecutive lines with the same record type and
+sewer id, so that the lines needed can be read with a seek per run.
+
+The index is made in large blocks with NumPy. Uploads get theirs
+saved in sidecar files next to them when they are processed (see
+save_index()), which are moved along with them (see move_sidecars()).
+Those are NumPy files that are memory mapped when loaded, so that only
+the parts that are used are read. For any other file, the index is
+made in memory each time; reading a file never writes next to it.
+"""
+
+import logging
+import os
+import shutil
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SIDECAR_SUFFIX = '.lines.npy'
+RECORDS_SUFFIX = '.records.npy'
+RUNS_SUFFIX = '.runs.npy'
+SUFFIXES = (SIDECAR_SUFFIX, RECORDS_SUFFIX, RUNS_SUFFIX)
+
+BLOCK_SIZE = 1024 * 1024
+RECORD_LENGTH = 5  # '*MRIO'
+
+
+def sidecar_path(path):
+    return path + SIDECAR_SUFFIX
+
+
+def sidecar_paths(path):
+    return [path + suffix for suffix in SUFFIXES]
+
+
+def move_sidecars(path, new_path):
+    """Move the sidecar files of the file at path along with it, to
+    those of new_path. Missing ones are made again when needed."""
+    for old, new in zip(sidecar_paths(path), sidecar_paths(new_path)):
+        if os.path.exists(old):
+            shutil.move(old, new)
+
+
+def remove_sidecars(path):
+    for sidecar in sidecar_paths(path):
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+
+
+def save_index(path):
+    """Make the LineIndex of an uploaded file and save it in sidecar
+    files next to it, for everything that reads parts of the file
+    later. Returns it."""
+    index = LineIndex.build(path)
+    index.save()
+    return index
+
+
+def line_offsets(path):
+    """Return an array with the byte offset of the start of each line
+    of the file at path, and finally the size of the file. Line n
+    (counting from 1, like enumerate_file()) is bytes offsets[n - 1]
+    up to offsets[n]."""
+    starts = [np.zeros(1, dtype=np.int64)]
+    position = 0
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            newlines = np.flatnonzero(
+                np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+            starts.append(position + newlines.astype(np.int64) + 1)
+            position += len(block)
+
+    offsets = np.concatenate(starts)
+    if offsets[-1] != position:
+        # The last line has no newline
+        offsets = np.append(offsets, position)
+    return offsets
+
+
+def line_records(path, offsets):
+    """Return an array with the record type of each line of the file
+    at path: its first RECORD_LENGTH characters, up to the line
+    ending."""
+    count = len(offsets) - 1
+    characters = np.zeros((count, RECORD_LENGTH), dtype=np.uint8)
+    if count == 0 or offsets[-1] == 0:
+        return characters.view('S%d' % RECORD_LENGTH).ravel()
+
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    starts = offsets[:-1]
+    lengths = offsets[1:] - starts
+    for i in range(RECORD_LENGTH):
+        present = lengths > i
+        characters[present, i] = data[starts[present] + i]
+    del data
+
+    # Short lines end before the record type does
+    ended = np.cumsum(
+        (characters == ord('\n')) | (characters == ord('\r')), axis=1) > 0
+    characters[ended] = 0
+    return characters.view('S%d' % RECORD_LENGTH).ravel()
+
+
+def _among(array, values):
+    "Boolean array, which elements of array are one of values."
+    values = [value.encode('utf-8') if isinstance(value, unicode) else value
+              for value in values]
+    if not values:
+        return np.zeros(len(array), dtype=bool)
+    return np.in1d(array, values)
+
+
+def sewer_id(record, line):
+    """Return the sewer id of a *RIOO or *MRIO line, or '' for other
+    lines."""
+    if record == '*RIOO':
+        return line[6:36].strip()
+    elif record == '*MRIO':
+        fields = line.split('|', 4)
+        return fields[3].strip() if len(fields) > 3 else ''
+    return ''
+
+
+class LineIndex(object):
+    "The lines of a file, by line number, record type and sewer id."
+
+    def __init__(self, path, offsets, records, runs):
+        self.path = path
+        self.offsets = offsets
+        # Record type per line, line n is records[n - 1]
+        self.records = records
+        # Runs of lines with the same record type and sewer id
+        self.runs = runs
+
+    @classmethod
+    def for_file(cls, path):
+        """Return the LineIndex of the file at path, from its sidecar
+        files if those are up to date (see save_index()), otherwise
+        made in memory."""
+        size = os.path.getsize(path)
+        sidecars = sidecar_paths(path)
+        if all(os.path.exists(sidecar) and
+               os.path.getmtime(sidecar) >= os.path.getmtime(path)
+               for sidecar in sidecars):
+            try:
+                offsets, records, runs = [
+                    np.load(sidecar, mmap_mode='r') for sidecar in sidecars]
+            except (IOError, ValueError):
+                logger.warn("Can't read %s, making the index again.",
+                            sidecars)
+            else:
+                if (len(offsets) and offsets[-1] == size and
+                    len(records) == len(offsets) - 1):
+                    return cls(path, offsets, records, runs)
+
+        return cls.build(path)
+
+    @classmethod
+    def build(cls, path):
+        """Make the LineIndex of the file at path. Only the *RIOO and
+        *MRIO lines are read one by one, for their sewer ids."""
+        offsets = line_offsets(path)
+        records = line_records(path, offsets)
+
+        with_sewers = np.flatnonzero(
+            (records == '*RIOO') | (records == '*MRIO'))
+        sewer_ids = np.zeros(len(records), dtype=object)
+        sewer_ids[:] = ''
+        with open(path, 'rb') as f:
+            for i in with_sewers:
+                f.seek(offsets[i])
+                sewer_ids[i] = sewer_id(
+                    records[i], f.read(offsets[i + 1] - offsets[i]))
+        sewer_ids = sewer_ids.astype(str)
+
+        changes = np.ones(len(records), dtype=bool)
+        changes[1:] = ((records[1:] != records[:-1]) |
+                       (sewer_ids[1:] != sewer_ids[:-1]))
+        firsts = np.flatnonzero(changes)
+        lasts = np.append(firsts[1:], len(records)) - 1
+
+        runs = np.zeros(len(firsts), dtype=[
+                ('record', records.dtype),
+                ('sewer_id', sewer_ids.dtype),
+                ('first', np.int64),
+                ('last', np.int64)])
+        runs['record'] = records[firsts]
+        runs['sewer_id'] = sewer_ids[firsts]
+        runs['first'] = firsts + 1
+        runs['last'] = lasts + 1
+        return cls(path, offsets, records, runs)
+
+    def save(self):
+        """Save the index next to the file. Not being able to is no
+        reason to fail; for_file() makes it in memory then."""
+        for sidecar, array in zip(
+            sidecar_paths(self.path),
+            (self.offsets, self.records, self.runs)):
+            temporary = sidecar + '.tmp'
+            try:
+                with open(temporary, 'wb') as f:
+                    np.save(f, array)
+                os.rename(temporary, sidecar)
+            except (IOError, OSError) as e:
+                logger.warn("Can't save line index %s: %s", sidecar, e)
+
+    def __len__(self):
+        "The number of lines."
+        return len(self.offsets) - 1
+
+    def lines(self, first, last):
+        """Yield (line number, line without line ending) of the lines
+        first up to and including last, as far as the file has them."""
+        first = max(first, 1)
+        last = min(last, len(self))
+        if first > last:
+            return
+
+        with open(self.path, 'rb') as f:
+            for line in self._read(f, first, last):
+                yield line
+
+    def _read(self, f, first, last):
+        start = int(self.offsets[first - 1])
+        f.seek(start)
+        data = f.read(int(self.offsets[last]) - start)
+
+        for line_number, line in enumerate(
+            data.split('\n')[:last - first + 1], first):
+            yield line_number, line.rstrip('\r')
+
+    def record_lines(self, records):
+        """Yield (line number, line) of the lines whose record type is
+        one of records, in file order."""
+        return self._run_lines(
+            _among(self.runs['record'], records))
+
+    def other_lines(self, records):
+        """Yield (line number, line) of the lines whose record type is
+        none of records, in file order."""
+        return self._run_lines(
+            ~_among(self.runs['record'], records))
+
+    def sewer_lines(self, sewer_ids, record='*MRIO'):
+        """Yield (line number, line) of the lines of the given record
+        type of the sewers with the given ids, in file order."""
+        return self._run_lines(
+            (self.runs['record'] == record) &
+            _among(self.runs['sewer_id'], sewer_ids))
+
+    def _run_lines(self, selected):
+        runs = self.runs[selected]
+        if not len(runs):
+            return
+        with open(self.path, 'rb') as f:
+            for first, last in zip(runs['first'], runs['last']):
+                for line in self._read(f, int(first), int(last)):
+                    yield line
@@ -0,0 +1,44 @@
+"""Objects loaded from files, kept per process.
+
+The routing index and the side profile data of a sewerage are saved as
+files in its directory when it is processed. A process loads them when
+they are first asked for and keeps them, until their file changes. Only
+the most recently used few are kept, so that a long-running process
+that sees many sewerages doesn't hold them all.
+"""
+
+from collections import OrderedDict
+
+
+class LoadedFiles(object):
+    """At most max_size objects, each with the modification time of
+    the file it was loaded from. The least recently used is dropped
+    first."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # Key: (mtime, object), least recently used first
+        self._loaded = OrderedDict()
+
+    def get(self, key, mtime):
+        """Return the object kept under key, or None if there is none,
+        or if it was loaded from the file as it was before mtime."""
+        if key not in self._loaded:
+            return None
+        loaded_mtime, obj = self._loaded.pop(key)
+        if loaded_mtime != mtime:
+            return None
+        self._loaded[key] = (loaded_mtime, obj)
+        return obj
+
+    def put(self, key, mtime, obj):
+        self._loaded.pop(key, None)
+        self._loaded[key] = (mtime, obj)
+        while len(self._loaded) > self.max_size:
+            self._loaded.popitem(last=False)
+
+    def discard(self, key):
+        self._loaded.pop(key, None)
+
+    def __len__(self):
+        return len(self._loaded)
@@ -5,6 +5,9 @@ First, a graph is built.
 Then we compute lost capacity in the graph.
 
 Then the numbers from the graph are stored in the relevant database models.
+
+The graph is a network.SewerNetwork; the networkx graph made by
+create_graph() is only used by the reference implementation.
 """
 
 import logging
@@ -14,15 +17,57 @@ from heapq import heappush, heappop
 from itertools import chain
 
 import networkx as nx
+import numpy as np
+
+from lizard_riool import models
+from lizard_riool.network import SewerNetwork
+from lizard_riool.network import csr_adjacency
 
 logger = logging.getLogger(__name__)
 
 
-def compute_lost_capacity(saved_puts, saved_sewers, measurements_dict):
-    G, sink_node = create_graph(
+def compute_lost_capacity(
+    saved_puts, saved_sewers, measurements_dict, reference=False):
+    """Compute water levels and flooded percentages of all the
+    measurements in measurements_dict. If reference is True, the
+    original networkx graph and water level algorithm are used.
+
+    Returns the SewerNetwork with the computed water levels, or None
+    if reference is True."""
+    if reference:
+        G, sink_node = create_graph(
+            saved_puts, saved_sewers, measurements_dict)
+        compute_water_level(G, sink_node, reference=True)
+        add_lost_capacity_from_graph(measurements_dict, saved_sewers, G)
+        return None
+
+    network = create_network(
         saved_puts, saved_sewers, measurements_dict)
-    compute_water_level(G, sink_node)
-    add_lost_capacity(measurements_dict, saved_sewers, G)
+    network.compute_water_level()
+    add_lost_capacity(measurements_dict, saved_sewers, network)
+    return network
+
+
+def compute_lost_capacity_of_tables(saved_puts, saved_sewers, tables):
+    """Like compute_lost_capacity(), for measurements that are kept in
+    structured arrays (see save_uploaded_data.measurement_table()).
+    Their water_level and flooded_pct fields are filled in. Returns
+    the SewerNetwork."""
+    network = create_network(saved_puts, saved_sewers, tables)
+    network.compute_water_level()
+    add_lost_capacity_to_tables(tables, saved_sewers, network)
+    return network
+
+
+def dists_and_bobs(measurements):
+    """Return float arrays with the dist and bob of the measurements,
+    which are either a list of SewerMeasurements or a structured
+    array with 'dist' and 'bob' fields."""
+    if isinstance(measurements, np.ndarray):
+        return (measurements['dist'].astype(np.float64),
+                measurements['bob'].astype(np.float64))
+    return (np.array([m.dist for m in measurements], dtype=np.float64),
+            np.array([m.bob for m in measurements], dtype=np.float64))
 
 
 def get_manhole_bobs(saved_sewers):
@@ -115,9 +160,163 @@ def create_graph(saved_puts, saved_sewers, measurements_dict):
     return G, ("put", sink_id)
 
 
-def compute_water_level(G, sink_node):
-    """Compute the lost capacity in graph G. sink must be a put-id of some
-    put in the graph.
+def create_network(saved_puts, saved_sewers, measurements_dict):
+    """Create a SewerNetwork with the same nodes and edges as the graph
+    that create_graph() makes from the same arguments, but with
+    integer nodes.
+
+    Measurements of one sewer that have the same dist are a single
+    node, whose bob is that of the last of them (in the networkx graph
+    the later add_node() overwrote the earlier)."""
+
+    manhole_bobs = get_manhole_bobs(saved_sewers)
+
+    sewer_ids = [sewer_id for sewer_id in saved_sewers
+                 if sewer_id in measurements_dict]
+
+    # Puts come first
+    put_nodes = dict()
+    for saved_sewer in (saved_sewers[sewer_id] for sewer_id in sewer_ids):
+        for code in (saved_sewer.manhole1.code, saved_sewer.manhole2.code):
+            if code not in put_nodes:
+                put_nodes[code] = len(put_nodes)
+
+    bobs = [np.array([manhole_bobs[code] for code in sorted(
+                    put_nodes, key=put_nodes.get)], dtype=np.float64)]
+    dists = [np.empty(len(put_nodes))]
+    dists[0].fill(np.nan)
+    sources = []
+    targets = []
+    sewer_nodes = dict()
+    measurement_nodes = dict()
+    next_node = len(put_nodes)
+
+    for sewer_id in sewer_ids:
+        saved_sewer = saved_sewers[sewer_id]
+        measurements = measurements_dict[sewer_id]
+
+        measurement_dists, measurement_bobs = dists_and_bobs(measurements)
+
+        order = np.argsort(measurement_dists, kind='mergesort')  # Stable
+        sorted_dists = measurement_dists[order]
+
+        # Index of the node of each sorted measurement, counting from 0
+        is_new = np.ones(len(sorted_dists), dtype=bool)
+        is_new[1:] = sorted_dists[1:] != sorted_dists[:-1]
+        rank = np.cumsum(is_new) - 1
+        last_of_each = np.append(
+            np.flatnonzero(is_new)[1:] - 1, len(sorted_dists) - 1)
+        last_of_each = last_of_each[last_of_each >= 0]
+
+        first = next_node  # sewer_end 1
+        nodes_between = len(last_of_each)
+        last = first + nodes_between + 1  # sewer_end 2
+        next_node = last + 1
+
+        sewer_nodes[sewer_id] = (first, next_node)
+        measurement_nodes[sewer_id] = np.empty(
+            len(measurements), dtype=np.int64)
+        measurement_nodes[sewer_id][order] = first + 1 + rank
+
+        bobs.append(np.concatenate((
+                    [saved_sewer.bob1],
+                    measurement_bobs[order][last_of_each],
+                    [saved_sewer.bob2])))
+        dists.append(np.concatenate((
+                    [np.nan], sorted_dists[last_of_each], [np.nan])))
+
+        # Edges along put1, sewer_end1, measurements, sewer_end2, put2
+        chain_nodes = np.concatenate((
+                [put_nodes[saved_sewer.manhole1.code]],
+                np.arange(first, next_node),
+                [put_nodes[saved_sewer.manhole2.code]]))
+        sources.append(chain_nodes[:-1])
+        targets.append(chain_nodes[1:])
+
+    # Find the put ids that are sinks, see create_graph()
+    bob = np.concatenate(bobs)
+    sink_ids = [manhole_id for manhole_id, manhole in saved_puts.iteritems()
+                if manhole.is_sink and manhole_id in put_nodes]
+    if not sink_ids:
+        sink = None
+        sinks = []
+    else:
+        sink_id = min(sink_ids, key=lambda sink: bob[put_nodes[sink]])
+        sink = put_nodes[sink_id]
+        sinks = [put_nodes[code] for code in sink_ids]
+        for higher_sink_id in sink_ids:
+            if higher_sink_id != sink_id:
+                sources.append([sink])
+                targets.append([put_nodes[higher_sink_id]])
+
+    indptr, indices = csr_adjacency(
+        next_node,
+        np.concatenate(sources) if sources else [],
+        np.concatenate(targets) if targets else [])
+
+    return SewerNetwork(
+        bob=bob, dist=np.concatenate(dists), indptr=indptr, indices=indices,
+        sink=sink, put_nodes=put_nodes, sewer_nodes=sewer_nodes,
+        measurement_nodes=measurement_nodes, sinks=sinks)
+
+
+def compute_water_level(G, sink_node, reference=False):
+    """Compute the water level of every node in graph G that is
+    connected to sink_node, and store it as the 'waterlevel' node
+    attribute.
+
+    Water is poured in at the sink. Everything lower than the current
+    water level that is reachable from the sink is under water and
+    gets that water level. At the shores, where the bob rises to at
+    least the water level, we climb up; climbing nodes are dry, their
+    water level is their own bob. Every node we reach is put on a
+    priority queue with its level, and the lowest one is always
+    expanded first, so when we go over a peak the water behind it is
+    filled up to the level of the peak.
+
+    This is the same computation as compute_water_level_reference(),
+    but all nodes share a single visited set and every node is
+    expanded exactly once, so it runs in O(E log V). Pass
+    reference=True to use the original implementation instead."""
+    if reference:
+        return compute_water_level_reference(G, sink_node)
+
+    sink_bob = G.node[sink_node]['bob']
+    G.node[sink_node]['waterlevel'] = sink_bob
+
+    todo = [(sink_bob, sink_node)]  # Priority queue of shores and peaks
+    visited = set([sink_node])
+
+    while todo:
+        water_level, node = heappop(todo)
+
+        # Pour water from this node. Nodes that are not higher than
+        # the water level are flooded and don't need to go through the
+        # priority queue; higher ones are shores, we climb from them
+        # later, when the water level has risen to their bob.
+        pour = [node]
+        while pour:
+            current = pour.pop()
+            for neighbour in G[current]:
+                if neighbour in visited:
+                    continue
+                visited.add(neighbour)
+
+                bob = G.node[neighbour]['bob']
+                if bob <= water_level:
+                    G.node[neighbour]['waterlevel'] = water_level
+                    pour.append(neighbour)
+                else:
+                    G.node[neighbour]['waterlevel'] = bob
+                    heappush(todo, (bob, neighbour))
+
+    # Nodes that aren't connected to the sink keep a waterlevel of None.
+
+
+def compute_water_level_reference(G, sink_node):
+    """Reference implementation of compute_water_level(). Compute the
+    lost capacity in graph G. sink must be a put-id of some put in the
+    graph.
 
     From the sink, go up until we reach "peaks", places where the
     water level goes down. From there, fill the network with water to a level
@@ -179,6 +378,27 @@ def compute_water_level(G, sink_node):
     # them as being 100% underwater.
 
 
+def compare_water_levels(G, sink_node):
+    """Run both water level algorithms on G and return a list of
+    (node, waterlevel, reference_waterlevel) tuples for the nodes
+    where they disagree. Meant for checking the fast algorithm
+    against the reference on real data. G is left with the
+    waterlevels of the reference algorithm."""
+    for node in G:
+        G.node[node]['waterlevel'] = None
+    compute_water_level(G, sink_node)
+    waterlevels = dict(
+        (node, G.node[node]['waterlevel']) for node in G)
+
+    for node in G:
+        G.node[node]['waterlevel'] = None
+    compute_water_level_reference(G, sink_node)
+
+    return [(node, waterlevels[node], G.node[node]['waterlevel'])
+            for node in sorted(G)
+            if waterlevels[node] != G.node[node]['waterlevel']]
+
+
 def neighbouring_nodes_satisfying_condition(G, start, visited, condition):
     """Produce nodes in a depth-first-search pre-ordering starting at
     source and skipping the already visited nodes and do so only while
@@ -217,7 +437,75 @@ def neighbouring_nodes_satisfying_condition(G, start, visited, condition):
                        if c not in set(satisfied)]
 
 
-def add_lost_capacity(measurements_dict, sewerdict, G):
+def add_lost_capacity(measurements_dict, sewerdict, network):
+    """Set water level and flooded percentage of the measurements from
+    the computed water levels in network.
+
+    This is done for all measurements at once, using
+    models.clamp_water_levels() and models.flooded_fractions()."""
+    sewer_ids = list(measurements_dict)
+    measurements = list(chain.from_iterable(
+            measurements_dict[sewer_id] for sewer_id in sewer_ids))
+    if not measurements:
+        return
+
+    bob = np.array([m.bob for m in measurements], dtype=np.float64)
+    obb = np.array([m.obb for m in measurements], dtype=np.float64)
+    water_levels, flooded_pcts = measurement_lost_capacity(
+        measurements_dict, sewerdict, network, sewer_ids, bob, obb)
+
+    for measurement, water_level, flooded_pct in zip(
+        measurements, water_levels.tolist(), flooded_pcts.tolist()):
+        # NaN != NaN; those are unknown
+        if water_level != water_level:
+            measurement.water_level = None
+            measurement.flooded_pct = None
+        else:
+            measurement.water_level = water_level
+            measurement.flooded_pct = flooded_pct
+
+
+def add_lost_capacity_to_tables(tables, sewerdict, network):
+    """Like add_lost_capacity(), for a dictionary sewer_id: structured
+    array of measurements. Sets their water_level and flooded_pct
+    fields; NaN means unknown."""
+    sewer_ids = list(tables)
+    if not sum(len(tables[sewer_id]) for sewer_id in sewer_ids):
+        return
+
+    bob = np.concatenate([tables[sewer_id]['bob'] for sewer_id in sewer_ids])
+    obb = np.concatenate([tables[sewer_id]['obb'] for sewer_id in sewer_ids])
+    water_levels, flooded_pcts = measurement_lost_capacity(
+        tables, sewerdict, network, sewer_ids, bob, obb)
+
+    start = 0
+    for sewer_id in sewer_ids:
+        table = tables[sewer_id]
+        stop = start + len(table)
+        table['water_level'] = water_levels[start:stop]
+        table['flooded_pct'] = flooded_pcts[start:stop]
+        start = stop
+
+
+def measurement_lost_capacity(
+    measurements_dict, sewerdict, network, sewer_ids, bob, obb):
+    """Return arrays with the water level and flooded percentage of
+    all the measurements of the sewers in sewer_ids, in that order,
+    given the arrays of their bobs and obbs. NaN for unknown."""
+    nodes = np.concatenate([
+            network.measurement_nodes[sewer_id] for sewer_id in sewer_ids])
+    shape = np.repeat(
+        [sewerdict[sewer_id].shape for sewer_id in sewer_ids],
+        [len(measurements_dict[sewer_id]) for sewer_id in sewer_ids])
+
+    water_levels = models.clamp_water_levels(
+        network.waterlevel[nodes], bob, obb)
+    flooded_pcts = models.flooded_fractions(water_levels, bob, obb, shape)
+    return water_levels, flooded_pcts
+
+
+def add_lost_capacity_from_graph(measurements_dict, sewerdict, G):
+    """Like add_lost_capacity(), using the networkx graph G."""
     for sewer_id, measurements in measurements_dict.iteritems():
         sewer = sewerdict[sewer_id]
         for measurement in measurements:
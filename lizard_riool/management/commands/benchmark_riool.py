@@ -0,0 +1,329 @@
+"""Benchmark the processing of the RIB/RMB pairs in lizard_riool/data.
+
+Every stage of processing an upload is run on each pair, with and
+without LIZARD_RIOOL_STREAM_RMB's streaming, and its wall time, memory
+use and the number of queries it did are reported. Results are written
+as JSON, so that runs of different versions can be compared.
+
+Memory is measured in the one process that runs all stages, so it is
+reported per stage as the change in resident set size (memory that
+the stage kept) and as the amount by which the stage raised the peak
+RSS of the process (zero if it stayed below an earlier stage's peak).
+
+The sewerages are saved into the configured database, so run this
+against a scratch PostGIS or SpatiaLite database. They are deleted
+afterwards, unless --keep is given.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+from optparse import make_option
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+
+import pkg_resources
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+
+from sufriblib import parsers
+
+from lizard_riool import lost_capacity
+from lizard_riool import models
+from lizard_riool import routing
+from lizard_riool import save_uploaded_data
+from lizard_riool.views import SideProfileGraph2
+
+DATA_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'data')
+
+# Sewerages are saved under this prefix, to not clash with real ones
+NAME_PREFIX = "benchmark "
+# And the streamed ones under the same name with this suffix
+STREAMED_SUFFIX = " streamed"
+
+PROFILE_WIDTH = 800
+PROFILE_HEIGHT = 400
+
+
+def data_pairs(data_dir):
+    """Return a sorted list of (name, rib path, rmb path) of the files
+    in data_dir that have both a .rib and a .rmb file (in any case)."""
+    files = defaultdict(dict)
+    for filename in os.listdir(data_dir):
+        name, extension = os.path.splitext(filename)
+        if extension.lower() in ('.rib', '.rmb'):
+            files[name][extension.lower()] = os.path.join(
+                data_dir, filename)
+
+    return sorted(
+        (name, paths['.rib'], paths['.rmb'])
+        for name, paths in files.iteritems()
+        if '.rib' in paths and '.rmb' in paths)
+
+
+def farthest_manhole(index, source):
+    """Return the code of a manhole in the routing index that has the
+    most sewers between it and source, along the shortest path."""
+    indptr, indices = index.indptr.tolist(), index.indices.tolist()
+    farthest = index.nodes[source]
+    seen = set([farthest])
+    level = [farthest]
+    while level:
+        farthest = level[-1]
+        next_level = []
+        for node in level:
+            for neighbour in indices[indptr[node]:indptr[node + 1]]:
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    next_level.append(neighbour)
+        level = next_level
+    return index.codes[farthest]
+
+
+def peak_rss_kb():
+    "Peak resident set size of this process so far, in KB (on Linux)."
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def rss_kb():
+    """Current resident set size of this process in KB, or None where
+    there is no /proc/self/statm."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize() // 1024
+
+
+class Benchmark(object):
+    "Collects the results of the stages of one run."
+
+    def __init__(self):
+        self.results = []
+
+    @contextmanager
+    def stage(self, pair_name, stage_name):
+        """Time the with-block. The queries are counted with Django's
+        debug cursor; their SQL is thrown away after each stage."""
+        reset_queries()
+        rss_before, peak_before = rss_kb(), peak_rss_kb()
+        start = time.time()
+        yield
+        wall_time = time.time() - start
+        rss_after = rss_kb()
+        self.results.append({
+                'file': pair_name,
+                'stage': stage_name,
+                'wall_time': wall_time,
+                'rss_delta_kb': (
+                    None if rss_before is None
+                    else rss_after - rss_before),
+                'peak_rss_increase_kb': peak_rss_kb() - peak_before,
+                'queries': len(connection.queries),
+                })
+        reset_queries()
+
+
+class Command(BaseCommand):
+    args = "[name ...]"
+    help = ("Benchmark the stages of processing the RIB/RMB pairs in "
+            "lizard_riool/data (or only the named ones). Saves into the "
+            "configured database; use a scratch one.")
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--output', dest='output', default=None,
+            help="Write JSON results to this file instead of stdout"),
+        make_option(
+            '--data-dir', dest='data_dir', default=DATA_DIR,
+            help="Directory with RIB/RMB pairs"),
+        make_option(
+            '--keep', action='store_true', dest='keep', default=False,
+            help="Don't delete the created sewerages"),
+        )
+
+    def handle(self, *names, **options):
+        pairs = data_pairs(options['data_dir'])
+        if names:
+            pairs = [pair for pair in pairs if pair[0] in names]
+        if not pairs:
+            raise CommandError("No RIB/RMB pairs found.")
+
+        # Count queries even if DEBUG is off
+        connection.use_debug_cursor = True
+
+        benchmark = Benchmark()
+        for name, rib_path, rmb_path in pairs:
+            self.stderr.write("Benchmarking {0}...\n".format(name))
+            self.run_pair(
+                benchmark, name, rib_path, rmb_path, options['keep'])
+
+        results = {
+            'version': pkg_resources.get_distribution(
+                'lizard-riool').version,
+            'python': platform.python_version(),
+            'database': connection.settings_dict['ENGINE'],
+            'date': datetime.datetime.now().isoformat(),
+            'results': benchmark.results,
+            }
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+        else:
+            self.stdout.write(json.dumps(results, indent=2) + "\n")
+
+        for result in benchmark.results:
+            self.stderr.write(
+                "{file:30} {stage:30} {wall_time:8.3f} s "
+                "{rss_delta_kb!s:>8} KB {peak_rss_increase_kb:8d} KB peak "
+                "{queries:6d} queries\n".format(**result))
+
+    def run_pair(self, benchmark, name, rib_path, rmb_path, keep):
+        sewerage_name = NAME_PREFIX + name
+        streamed_name = sewerage_name + STREAMED_SUFFIX
+        for sewerage in models.Sewerage.objects.filter(
+            name__in=(sewerage_name, streamed_name)):
+            sewerage.delete()
+
+        # Saving moves the files, so work on copies
+        temp_dir = tempfile.mkdtemp()
+        try:
+            rib_copy, rmb_copy = self.copy_pair(
+                temp_dir, sewerage_name, rib_path, rmb_path)
+            sewerages = [
+                self.run_stages(benchmark, name, rib_copy, rmb_copy)]
+
+            rib_copy, rmb_copy = self.copy_pair(
+                temp_dir, streamed_name, rib_path, rmb_path)
+            sewerages.append(self.run_streamed_stages(
+                    benchmark, name, rib_copy, rmb_copy))
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        if not keep:
+            for sewerage in sewerages:
+                if sewerage is not None:
+                    sewerage.delete()
+
+    def copy_pair(self, temp_dir, sewerage_name, rib_path, rmb_path):
+        """Copy a pair into a directory of its own in temp_dir, named so
+        that the sewerage gets sewerage_name."""
+        directory = tempfile.mkdtemp(dir=temp_dir)
+        rib_copy = os.path.join(directory, sewerage_name + ".RIB")
+        rmb_copy = os.path.join(directory, sewerage_name + ".RMB")
+        shutil.copy(rib_path, rib_copy)
+        shutil.copy(rmb_path, rmb_copy)
+        return rib_copy, rmb_copy
+
+    def run_stages(self, benchmark, name, rib_path, rmb_path):
+        """Run all the stages on one pair. Returns the saved Sewerage,
+        or None if the files have errors."""
+        with benchmark.stage(name, "parse"):
+            ribinstance, riberrors = parsers.parse(rib_path)
+            rmbinstance, rmberrors = parsers.parse(rmb_path)
+
+        if not ribinstance or not rmbinstance:
+            self.stderr.write("  Files could not be parsed, skipped.\n")
+            return None
+
+        with benchmark.stage(name, "get_puts/get_sewers/get_mrio"):
+            putdict = save_uploaded_data.get_puts(ribinstance, riberrors)
+            sewerdict = save_uploaded_data.get_sewers(
+                ribinstance, putdict, riberrors)
+            lines = save_uploaded_data.mrio_lines_by_sewer_id(rmbinstance)
+            for sewerinfo in sewerdict.itervalues():
+                sewerinfo['measurements'] = save_uploaded_data.get_mrio(
+                    lines, putdict, sewerinfo, rmberrors)
+
+        if riberrors or rmberrors:
+            self.stderr.write("  Files have errors, skipped.\n")
+            return None
+
+        with benchmark.stage(name, "save_into_database"):
+            save_uploaded_data.save_into_database(
+                rib_path, rmb_path, putdict, sewerdict, rmberrors)
+
+        sewerage = models.Sewerage.objects.get(
+            name=os.path.basename(rmb_path)[:-4])
+
+        # Load what save_into_database() passes to compute_lost_capacity
+        saved_puts = dict(
+            (manhole.code, manhole) for manhole in
+            models.Manhole.objects.filter(sewerage=sewerage))
+        saved_sewers = dict(
+            (sewer.code, sewer) for sewer in
+            models.Sewer.objects.filter(sewerage=sewerage).select_related(
+                'manhole1', 'manhole2'))
+
+        packed = models.PackedMeasurements.objects.filter(
+            sewer__sewerage=sewerage).select_related('sewer')
+        if packed.exists():
+            tables = dict(
+                (p.sewer.code, p.table(saved_sewers[p.sewer.code]))
+                for p in packed)
+            with benchmark.stage(name, "compute_lost_capacity"):
+                lost_capacity.compute_lost_capacity_of_tables(
+                    saved_puts, saved_sewers, tables)
+        else:
+            measurements = defaultdict(list)
+            for measurement in models.SewerMeasurement.objects.filter(
+                sewer__sewerage=sewerage).select_related('sewer'):
+                measurements[measurement.sewer.code].append(measurement)
+
+            with benchmark.stage(name, "compute_lost_capacity"):
+                lost_capacity.compute_lost_capacity(
+                    saved_puts, saved_sewers, measurements)
+
+        with benchmark.stage(name, "generate_rib"):
+            sewerage.generate_rib()
+
+        with benchmark.stage(name, "routing index build"):
+            routing.build_index(sewerage.pk)
+
+        with benchmark.stage(name, "routing index load"):
+            index = routing.RoutingIndex.load(
+                routing.index_path(sewerage.pk))
+
+        # Route from the sink to the manhole that is farthest away
+        source = next(
+            (code for code, manhole in saved_puts.iteritems()
+             if manhole.is_sink), index.codes[0])
+        target = farthest_manhole(index, source)
+
+        with benchmark.stage(name, "path lookup"):
+            path, sewers = index.shortest_path(source, target)
+            index.shortest_path(source, target, weighted=True)
+
+        with benchmark.stage(name, "profile render"):
+            SideProfileGraph2().render_png(
+                sewerage.pk, path, PROFILE_WIDTH, PROFILE_HEIGHT)
+
+        return sewerage
+
+    def run_streamed_stages(self, benchmark, name, rib_path, rmb_path):
+        """Parse and save one pair the way LIZARD_RIOOL_STREAM_RMB does.
+        Returns the saved Sewerage, or None if the files have errors."""
+        with benchmark.stage(name, "parse (streamed)"):
+            putdict, sewerdict, riberrors, rmberrors = (
+                save_uploaded_data.parse_files(
+                    rib_path, rmb_path, stream=True))
+
+        if not putdict or not sewerdict or riberrors or rmberrors:
+            self.stderr.write("  Files have errors, skipped.\n")
+            return None
+
+        with benchmark.stage(name, "save_streamed_into_database"):
+            save_uploaded_data.save_streamed_into_database(
+                rib_path, rmb_path, putdict, sewerdict, rmberrors)
+
+        return models.Sewerage.objects.get(
+            name=os.path.basename(rmb_path)[:-4])
@@ -71,14 +71,24 @@ $(function () {
 /* Constantly rebuild the file list ajaxically */
 var beheer_functions = beheer_functions || (function () {
     var refresh_url = $("#uploaded_file_lists").attr("data-refresh-url");
+    var changes_url = $("#uploaded_file_lists").attr("data-changes-url");
 
-    /* The refresh url will give a bit of JSON data. This is an array
-       of objects, of the form:
+    /* The refresh url will give a bit of JSON data. This is a page
+       of uploads, of the form:
        {
-           id: a unique id string
-           name: filename
-           status: One of "not_being_processed_yet", "being_processed", "with_errors", "successful"
+           uploads: an array of objects, of the form:
+           {
+               id: a unique id string
+               name: filename
+               status: One of "not_being_processed_yet", "being_processed", "with_errors", "successful"
+               progress: for files being processed, {stage: label,
+                         percentage: number} or null
            }
+           next: the "after" parameter of the next page, or null if this
+                 is the last one
+       }
+       Pages that didn't change since the last time are answered with
+       304 Not Modified, and the browser gives us its cached copy.
     */
 
     var id_present_in = function (status, id) {
@@ -121,6 +131,11 @@ var beheer_functions = beheer_functions || (function () {
             li = li.append(sprite_remove);
         }
 
+        if (status === "being_processed") {
+            li = li.append($("<span>").attr("class", "progress")
+                           .text(progress_text(uploaded_file.progress)));
+        }
+
         if (status === "with_errors") {
             sprite_remove = ($("<span>")
                              .attr("class", "remove ss_sprite ss_delete")
@@ -150,6 +165,23 @@ var beheer_functions = beheer_functions || (function () {
         $("#uploaded_files_" + status + " ul").append(li);
     };
 
+    var progress_text = function (progress) {
+        if (!progress || !progress.stage) {
+            return "";
+        }
+        return " (" + progress.stage + ", " + progress.percentage + "%)";
+    };
+
+    var update_progress = function (uploaded_file) {
+        $("#uploaded_files_being_processed ul li").each(function (i, item) {
+            item = $(item);
+            if (item.attr("data-file-id") === uploaded_file.id) {
+                item.children(".progress").text(
+                    progress_text(uploaded_file.progress));
+            }
+        });
+    };
+
     var record_id_to_keep = function (ids_to_keep, status, id) {
         ids_to_keep[status] = ids_to_keep[status] || {};
         ids_to_keep[status][id] = true;
@@ -175,34 +207,92 @@ var beheer_functions = beheer_functions || (function () {
     }
 
     var update_file_list = function () {
-        $.getJSON(refresh_url, function(data) {
-            var ids_to_keep = {};
-
-            // Sync the lists to the file ids in the data
-            // First go through all the data, add the files to the right
-            // lists, adding all ids to ids_to_keep.
-            // Then go through all the lists and remove the files we haven't
-            // seen this way.
-            $.each(data, function (i, uploaded_file) {
-                var id = uploaded_file.id;
-                var status = uploaded_file.status;
-
-                record_id_to_keep(ids_to_keep, status, id);
-
-                if (!id_present_in(status, id)) {
-                    add_to_list(uploaded_file);
+        var uploaded_files = [];
+
+        // Get all pages, then sync the lists
+        var get_page = function (after) {
+            $.getJSON(refresh_url, {after: after}, function (data) {
+                uploaded_files = uploaded_files.concat(data.uploads);
+                if (data.next === null) {
+                    sync_file_list(uploaded_files);
+                } else {
+                    get_page(data.next);
                 }
             });
+        };
+        get_page(0);
+    };
+
+    var sync_file_list = function (uploaded_files) {
+        var ids_to_keep = {};
+
+        // Sync the lists to the file ids in the data
+        // First go through all the data, add the files to the right
+        // lists, adding all ids to ids_to_keep.
+        // Then go through all the lists and remove the files we haven't
+        // seen this way.
+        $.each(uploaded_files, function (i, uploaded_file) {
+            var id = uploaded_file.id;
+            var status = uploaded_file.status;
 
-            remove_ids("not_being_processed_yet", ids_to_keep);
-            remove_ids("being_processed", ids_to_keep);
-            remove_ids("with_errors", ids_to_keep);
-            remove_ids("successful", ids_to_keep);
+            record_id_to_keep(ids_to_keep, status, id);
 
-            if (($("#uploaded_files_not_being_processed_yet ul li").length !== 0) ||
-                ($("#uploaded_files_being_processed ul li").length !== 0)) {
-                // Keep refreshing until these tables are empty
-                repeat_update_file_list = true;
+            if (!id_present_in(status, id)) {
+                add_to_list(uploaded_file);
+            } else if (status === "being_processed") {
+                update_progress(uploaded_file);
+            }
+        });
+
+        remove_ids("not_being_processed_yet", ids_to_keep);
+        remove_ids("being_processed", ids_to_keep);
+        remove_ids("with_errors", ids_to_keep);
+        remove_ids("successful", ids_to_keep);
+
+        if (files_pending()) {
+            wait_for_changes();
+        }
+    };
+
+    var files_pending = function () {
+        return (($("#uploaded_files_not_being_processed_yet ul li").length !== 0) ||
+                ($("#uploaded_files_being_processed ul li").length !== 0));
+    };
+
+    // Instead of refreshing the list every second while files are
+    // waiting or being processed, wait for the server to tell that
+    // something changed (a long poll, see uploaded_file_changes() in
+    // views.py). Once no files are pending, stop, like the list did
+    // before; schedule_update_file_list() (after an upload or a
+    // delete) starts it again.
+    var version = null;
+    var waiting_for_changes = false;
+
+    var wait_for_changes = function () {
+        if (waiting_for_changes) {
+            return;
+        }
+        waiting_for_changes = true;
+        $.ajax({
+            url: changes_url,
+            data: {version: version},
+            dataType: "json",
+            cache: false,
+            success: function (data, status, xhr) {
+                waiting_for_changes = false;
+                if (data.version !== version) {
+                    // Waits again after the list is synced
+                    version = data.version;
+                    schedule_update_file_list();
+                } else if (files_pending()) {
+                    var retry_after = parseFloat(
+                        xhr.getResponseHeader("Retry-After")) || 0;
+                    setTimeout(wait_for_changes, retry_after * 1000);
+                }
+            },
+            error: function () {
+                waiting_for_changes = false;
+                setTimeout(schedule_update_file_list, 5000);
             }
         });
     };
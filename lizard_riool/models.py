@@ -23,25 +23,53 @@
 This serves as a long usage message.
 """
 
+from itertools import groupby
+from operator import itemgetter, or_
 from os.path import basename, splitext
+import base64
 import logging
 import math
 import os
+import re
 import shutil
+import time
+import zlib
 
 from django.contrib.gis.db import models
+from django.contrib.gis.geos import Point
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 
-from sufriblib.parsers import enumerate_file
+import numpy as np
 
+from lizard_riool import line_index
 from lizard_riool.waar import WAAR
 
 
 RDNEW = 28992
 SRID = RDNEW
 
+# Version of the uploads feed (see views.uploaded_file_list()), bumped
+# whenever an upload is saved or deleted. Kept in the cache, which is
+# shared by the web server and the Celery workers.
+UPLOADS_VERSION_KEY = 'lizard_riool_uploads_version'
+
 logger = logging.getLogger(__name__)
 
+# The measurements of a sewer as a structured array, see
+# save_uploaded_data.measurement_table() and PackedMeasurements. x and
+# y are WGS84.
+MEASUREMENT_DTYPE = np.dtype([
+        ('dist', np.float64),
+        ('bob', np.float64),
+        ('obb', np.float64),
+        ('x', np.float64),
+        ('y', np.float64),
+        ('virtual', np.bool_),
+        ('water_level', np.float64),
+        ('flooded_pct', np.float64)])
+
 # Colors from http://www.herethere.net/~samson/php/color_gradient/
 
 CLASSES = (
@@ -74,6 +102,32 @@ def get_class_boundaries(pct):
     return UNKNOWN_CLASS[0], UNKNOWN_CLASS[2], UNKNOWN_CLASS[3]
 
 
+def waar_lines(sewer_code, measurements):
+    """Construct and return *WAAR records for in a RIB file.
+
+    measurements is an iterable of (dist, flooded_pct) tuples of the
+    sewer with this code, ordered by dist. Each can be classified
+    according to its percentage flooded. The class boundaries are
+    printed in the ZZI and ZZJ fields of the *WAAR record. Only *WAAR
+    records that mark a change of class are returned.
+    """
+
+    prev_klasse = None
+    for dist, pct in measurements:
+        klasse, min_pct, max_pct = get_class_boundaries(pct)
+        if klasse != prev_klasse:
+            waar = WAAR()
+            waar.ZZA = dist
+            waar.ZZB = "1"
+            waar.ZZE = sewer_code
+            waar.ZZF = 'BDD'
+            waar.ZZI = min_pct
+            waar.ZZJ = max_pct
+            waar.ZZV = 'Door Lizard Riool Toolkit'
+            yield str(waar)
+            prev_klasse = klasse
+
+
 def circular_surface(obj):
     """return section surface of obj with diam
     """
@@ -110,6 +164,16 @@ class Upload(models.Model):
     BASE_PATH = os.path.join(
         settings.BUILDOUT_DIR, 'var', 'lizard_riool', 'uploads')
 
+    # A broken RMB file has an error on every *MRIO line. Only the
+    # first this many errors of an upload are saved as
+    # UploadedFileErrors; all of them are counted, in error_count and
+    # per UploadErrorCategory.
+    MAX_RECORDED_ERRORS = getattr(
+        settings, 'LIZARD_RIOOL_MAX_RECORDED_ERRORS', 1000)
+    MAX_ERROR_CATEGORIES = 100
+    # Number of UploadedFileError rows inserted at a time
+    ERROR_CHUNK_SIZE = 1000
+
     "An uploaded file"
     objects = models.GeoManager()
     the_file = models.FilePathField(
@@ -123,6 +187,17 @@ class Upload(models.Model):
     status = models.IntegerField(
         choices=STATUS_CHOICES, default=1, null=True)
 
+    # Lowercase filename without extension, for pairing RIB and RMB
+    # files
+    stem = models.CharField(max_length=400, default='', db_index=True)
+
+    # Number of errors, also those that weren't saved
+    error_count = models.IntegerField(default=0)
+
+    # An RMB file that updates the existing sewerage with its name
+    # (see update.py), instead of making a new one with a RIB file
+    is_update = models.BooleanField(default=False)
+
     def status_string(self):
         """For use in Javascript (beheer.js)"""
         return {
@@ -148,15 +223,27 @@ class Upload(models.Model):
 
         shutil.move(path, newpath)
         self.the_file = newpath
+        self.stem = Upload.stem_of(newpath)
         self.save()
 
+    @staticmethod
+    def stem_of(path):
+        "Return the stem under which the file at path is paired."
+        return splitext(basename(path))[0].lower()
+
+    def save(self, *args, **kwargs):
+        super(Upload, self).save(*args, **kwargs)
+        bump_uploads_version()
+
     def delete(self):
         """Delete this Upload including the file and directory"""
         shutil.rmtree(
             os.path.join(Upload.BASE_PATH, str(self.id)),
             ignore_errors=True)
 
-        return super(Upload, self).delete()
+        result = super(Upload, self).delete()
+        bump_uploads_version()
+        return result
 
     @property
     def full_path(self):
@@ -184,48 +271,135 @@ class Upload(models.Model):
         if not self.filename.lower().endswith(".rmb"):
             raise ValueError("find_relevant_rib() called on a non-rmb Upload")
 
-        filename = self.filename.lower()[:-4]
-
-        for upload in Upload.objects.filter(status=Upload.NOT_PROCESSED_YET):
-            if not upload.filename.lower().endswith(".rib"):
-                continue
-            if upload.filename.lower()[:-4] == filename:
-                return upload
-
+        return self._find_waiting_partner(".rib")
+
+    def find_relevant_rmb(self):
+        """The other way around: find the RMB Upload with status 1 that
+        belongs to this RIB, or None.
+
+        If this is not a .RIB file, raise ValueError."""
+        if not self.filename.lower().endswith(".rib"):
+            raise ValueError("find_relevant_rmb() called on a non-rib Upload")
+
+        return self._find_waiting_partner(".rmb")
+
+    def _find_waiting_partner(self, suffix):
+        """Return the oldest Upload with status 1 that has the same stem
+        as this one and the given suffix, or None. Uses the index on
+        stem, instead of looking at all waiting uploads. Updates have
+        no partner."""
+        uploads = Upload.objects.filter(
+            stem=self.stem, status=Upload.NOT_PROCESSED_YET,
+            the_file__iendswith=suffix, is_update=False).exclude(
+            pk=self.pk).order_by('id')
+        for upload in uploads[:1]:
+            return upload
         return None
 
     def record_error(self, error_message, line_number=0):
         """Record error message. Does not set state yet, more errors
         may come."""
-        UploadedFileError.objects.create(
-            uploaded_file=self,
-            line=line_number or 0,  # Save 0 if line_number is None
-            error_message=error_message[:300])
+        self._record_errors([(error_message, line_number)])
 
     def record_errors(self, errorlist):
         """Errorlist is an iterable of sufriblib.errors.Error objects."""
-        for e in errorlist:
-            self.record_error(e.message, e.line_number)
+        self._record_errors((e.message, e.line_number) for e in errorlist)
+
+    def _record_errors(self, errors):
+        """Record (error message, line number) pairs. The first ones,
+        up to MAX_RECORDED_ERRORS for this upload, are inserted as
+        UploadedFileErrors in bulk; all of them are counted."""
+        recorded = UploadedFileError.objects.filter(
+            uploaded_file=self).count()
+        categories = dict(
+            (category.error_message, category) for category in
+            UploadErrorCategory.objects.filter(uploaded_file=self))
+        counts = dict()  # Category message: [count, first line]
+        known = set(categories)
+        count = 0
+        chunk = []
+
+        for error_message, line_number in errors:
+            error_message = error_message[:300]
+            line_number = line_number or 0  # Save 0 if it is None
+            count += 1
+
+            category = UploadErrorCategory.category_of(error_message)
+            if category not in known:
+                if len(known) >= Upload.MAX_ERROR_CATEGORIES - 1:
+                    category = UploadErrorCategory.OTHER_ERRORS
+                known.add(category)
+            if category in counts:
+                counts[category][0] += 1
+            else:
+                counts[category] = [1, line_number]
+
+            if recorded < Upload.MAX_RECORDED_ERRORS:
+                chunk.append(UploadedFileError(
+                        uploaded_file=self, line=line_number,
+                        error_message=error_message))
+                recorded += 1
+                if len(chunk) >= Upload.ERROR_CHUNK_SIZE:
+                    UploadedFileError.objects.bulk_create(chunk)
+                    chunk = []
+        if chunk:
+            UploadedFileError.objects.bulk_create(chunk)
+
+        if not count:
+            return
 
-    def error_description(self):
+        Upload.objects.filter(pk=self.pk).update(
+            error_count=models.F('error_count') + count)
+        self.error_count += count
+
+        new_categories = []
+        for category, (category_count, first_line) in counts.iteritems():
+            if category in categories:
+                UploadErrorCategory.objects.filter(
+                    pk=categories[category].pk).update(
+                    count=models.F('count') + category_count)
+            else:
+                new_categories.append(UploadErrorCategory(
+                        uploaded_file=self, error_message=category,
+                        count=category_count, first_line=first_line))
+        UploadErrorCategory.objects.bulk_create(new_categories)
+
+    def error_description(self, first_error=None):
+        """Describe the errors of an unsuccessful upload, with its
+        first error. Pass that if it is already known, see
+        upload_statuses()."""
         if self.status != Upload.UNSUCCESSFUL:
             return None
 
-        errors = list(UploadedFileError.objects.filter(
-                uploaded_file=self))
+        if first_error is None:
+            errors = list(UploadedFileError.objects.filter(
+                    uploaded_file=self)[:1])
+            if not errors:
+                return None
+            first_error = errors[0]
 
-        if not errors:
-            return None
-        if len(errors) == 1:
-            return errors[0].message()
+        if self.error_count <= 1:
+            return first_error.message()
         else:
             return (u"{0} fouten, eerste is: {1}"
-                    .format(len(errors), errors[0].message()))
+                    .format(self.error_count, first_error.message()))
 
     def set_being_processed(self):
         self.status = Upload.BEING_PROCESSED
         self.save()
 
+    def claim(self):
+        """Set the status to being processed if it is still status 1.
+        This is a single UPDATE, so if several workers try to claim an
+        upload, only one succeeds. Returns True if this one did."""
+        claimed = Upload.objects.filter(
+            pk=self.pk, status=Upload.NOT_PROCESSED_YET).update(
+            status=Upload.BEING_PROCESSED)
+        if claimed:
+            self.status = Upload.BEING_PROCESSED
+            bump_uploads_version()
+        return bool(claimed)
+
     def set_unsuccessful(self):
         self.status = Upload.UNSUCCESSFUL
         self.save()
@@ -258,6 +432,46 @@ class UploadedFileError(models.Model):
             message=self.message())
 
 
+class UploadErrorCategory(models.Model):
+    """The errors of an upload that have the same message, apart from
+    the values in it, counted. Lets the error page summarize the errors
+    without loading all of them, and includes those that weren't saved
+    because of Upload.MAX_RECORDED_ERRORS."""
+
+    # Category of the errors that didn't fit in MAX_ERROR_CATEGORIES
+    OTHER_ERRORS = u"Overige fouten"
+
+    uploaded_file = models.ForeignKey(
+        Upload, related_name='error_categories')
+    error_message = models.CharField(max_length=300)
+    count = models.IntegerField(default=0)
+    first_line = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ('uploaded_file', '-count')
+
+    @staticmethod
+    def category_of(error_message):
+        """Return the error message with the quoted values and numbers in
+        it replaced, so that "Waarde in veld ZYA, 'x', is geen decimaal
+        getal." is the same category for each value of x."""
+        return re.sub(
+            r"\d+(?:[.,]\d+)*", u"#",
+            re.sub(r"'[^']*'", u"'...'", error_message))[:300]
+
+    def message(self):
+        if self.count > 1:
+            return u"{count} keer: {error_message}".format(
+                count=self.count, error_message=self.error_message)
+        else:
+            return self.error_message
+
+    def __unicode__(self):
+        return u"{file}: {message}".format(
+            file=self.uploaded_file.the_file,
+            message=self.message())
+
+
 class Sewerage(models.Model):
     """A system of sewers.
 
@@ -269,7 +483,16 @@ class Sewerage(models.Model):
     BASE_PATH = os.path.join(
         settings.BUILDOUT_DIR, 'var', 'lizard_riool', 'sewerages')
 
-    name = models.CharField(max_length=128)
+    # Write buffer of the generated RIB file
+    RIB_BUFFER_SIZE = 64 * 1024
+
+    # Number of SewerMeasurement rows materialize_measurements()
+    # inserts at a time
+    MEASUREMENT_CHUNK_SIZE = 10000
+
+    # Unique, so that two workers can't both create a sewerage with
+    # the same name (see save_uploaded_data.create_sewerage())
+    name = models.CharField(max_length=128, unique=True)
     rib = models.FilePathField(
         path=BASE_PATH, verbose_name='RIB File', null=True,
         max_length=400)  # Note this is including the path, and we
@@ -302,44 +525,110 @@ class Sewerage(models.Model):
 
         new_rib_path = os.path.join(directory, os.path.basename(rib_path))
         shutil.move(rib_path, new_rib_path)
+        line_index.move_sidecars(rib_path, new_rib_path)
         self.rib = new_rib_path
 
         new_rmb_path = os.path.join(directory, os.path.basename(rmb_path))
         shutil.move(rmb_path, new_rmb_path)
+        line_index.move_sidecars(rmb_path, new_rmb_path)
         self.rmb = new_rmb_path
 
         self.save()
 
     def generate_rib(self):
         """When everything is saved and moved, a "result" RIB file is
-        generated."""
+        generated. Only the *ALGE and *RIOO lines of the RMB file are
+        read, found with its line index."""
         self.generated_rib = os.path.join(
             os.path.dirname(self.rib),
             os.path.splitext(os.path.basename(self.rmb))[0] + '_results.rib')
 
-        with open(self.generated_rib, 'w') as rib:
-            for line in self._generate_generated_rib_lines(
-                enumerate_file(self.rmb)):
-                rib.write(line + "\n")
+        with open(self.generated_rib, 'w', Sewerage.RIB_BUFFER_SIZE) as rib:
+            rib.writelines(
+                line + "\n" for line in self._generate_generated_rib_lines(
+                    line_index.LineIndex.for_file(self.rmb).record_lines(
+                        ["*ALGE", "*RIOO"])))
 
         self.save()
 
     def _generate_generated_rib_lines(self, file_enumerator):
+        waar_lines_by_code = self._waar_lines_by_sewer_code()
+
         for line_number, line in file_enumerator:
             if line.startswith("*ALGE"):
                 yield line  # Copy *ALGE lines
             elif line.startswith("*RIOO"):
                 yield line  # Copy *RIOO lines
 
-                # After the *RIOO lines, add the relevant *WAAR lines
+                # After the *RIOO lines, add the relevant *WAAR
+                # lines. Sewers that don't exist get none.
                 sewer_code = line[6:36].strip()
-                try:
-                    sewer = Sewer.objects.get(
-                        sewerage=self, code=sewer_code)
-                    for extra_waar_line in sewer.generate_waar_lines():
-                        yield extra_waar_line
-                except Sewer.DoesNotExist:
-                    pass  # Don't print *WAAR records for this one
+                for extra_waar_line in waar_lines_by_code.get(
+                    sewer_code, ()):
+                    yield extra_waar_line
+
+    def _waar_lines_by_sewer_code(self):
+        """Return a dictionary sewer code: list of *WAAR lines, made
+        from a single query over all measurements of this sewerage,
+        ordered by sewer and dist. Only the lines are kept, not the
+        measurements."""
+        measurements = measurement_values(
+            self.pk, 'sewer__code', 'dist', 'flooded_pct')
+
+        return dict(
+            (code, list(waar_lines(
+                        code, ((dist, pct) for _, dist, pct in rows))))
+            for code, rows in groupby(measurements, key=itemgetter(0)))
+
+    def materialize_measurements(self):
+        """Make sure that this sewerage has SewerMeasurement rows, which
+        the map layers query. If its measurements were only saved as
+        PackedMeasurements, the rows are created from those, once.
+        Returns True if rows were created.
+
+        Only if rows have to be made is the sewerage locked, so that
+        concurrent tile requests don't both create them; otherwise
+        this is two cheap queries, see needs_measurement_rows()."""
+        if not needs_measurement_rows(self.pk):
+            return False
+
+        with transaction.commit_on_success():
+            Sewerage.objects.select_for_update().get(pk=self.pk)
+            # Another request may have made them while we waited
+            if SewerMeasurement.objects.filter(sewer__sewerage=self).exists():
+                return False
+
+            chunk = []
+            for packed in PackedMeasurements.objects.filter(
+                sewer__sewerage=self).select_related('sewer').iterator():
+                chunk.extend(packed.measurements())
+                if len(chunk) >= Sewerage.MEASUREMENT_CHUNK_SIZE:
+                    SewerMeasurement.objects.bulk_create(chunk)
+                    chunk = []
+            if chunk:
+                SewerMeasurement.objects.bulk_create(chunk)
+
+        return True
+
+    def replace_rmb(self, rmb_path):
+        """Move a new RMB file into this sewerage's directory, in place
+        of the current one, which is removed. Saves this object.
+
+        The removal can't be rolled back, so when the database is
+        changed for the new file, call this only after that has been
+        committed (see update.finish_rmb_update())."""
+        directory = os.path.join(Sewerage.BASE_PATH, str(self.id))
+        new_rmb_path = os.path.join(directory, os.path.basename(rmb_path))
+
+        if self.rmb and self.rmb != new_rmb_path and os.path.exists(self.rmb):
+            os.remove(self.rmb)
+            line_index.remove_sidecars(self.rmb)
+        line_index.remove_sidecars(new_rmb_path)
+        shutil.move(rmb_path, new_rmb_path)
+        line_index.move_sidecars(rmb_path, new_rmb_path)
+        self.rmb = new_rmb_path
+
+        self.save()
 
     def delete(self):
         """Delete this Sewerage -- also deletes the entire directory
@@ -348,6 +637,10 @@ class Sewerage(models.Model):
             os.path.join(Sewerage.BASE_PATH, str(self.id)),
             ignore_errors=True)
 
+        # Imported here, because side_profile imports this module
+        from lizard_riool import side_profile
+        side_profile.invalidate_cache(self.pk)
+
         return super(Sewerage, self).delete()
 
     @property
@@ -440,37 +733,54 @@ class Sewer(models.Model):
 
         If both those are satisfied, this sewer is reliable, otherwise
         unreliable."""
-        if not measurements:
-            self.quality = Sewer.QUALITY_UNKNOWN
-            return
+        self.quality = Sewer.judged_quality(
+            [m.dist for m in measurements], self.the_geom_length)
+
+    @staticmethod
+    def judged_quality(dists, length):
+        """Return the quality judge_quality() gives a sewer of this
+        length with measurements at these dists."""
+        if not dists:
+            return Sewer.QUALITY_UNKNOWN
 
-        mindist = min(m.dist for m in measurements)
-        maxdist = max(m.dist for m in measurements)
+        mindist = min(dists)
+        maxdist = max(dists)
 
         # Restrict it to only inside the sewer's length, to prevent
         # strange dists resulting in good quality
         mindist = max(0.0, mindist)
-        maxdist = min(maxdist, self.the_geom_length)
+        maxdist = min(maxdist, length)
 
         measurements_length = maxdist - mindist
 
-        proportion = measurements_length / self.the_geom_length
+        proportion = measurements_length / length
 
-        measurements_per_m = len(measurements) / measurements_length
+        measurements_per_m = len(dists) / measurements_length
 
         if proportion >= 0.9 and measurements_per_m >= 1:
-            self.quality = Sewer.QUALITY_RELIABLE
+            return Sewer.QUALITY_RELIABLE
         else:
-            self.quality = Sewer.QUALITY_UNRELIABLE
+            return Sewer.QUALITY_UNRELIABLE
 
     def generate_waar_lines(self):
-        """Construct and return *WAAR records for in a RIB file.
+        """Construct and return *WAAR records for in a RIB file, see
+        waar_lines()."""
+        try:
+            columns = self.packed_measurements.columns()
+        except PackedMeasurements.DoesNotExist:
+            measurements = SewerMeasurement.objects.filter(
+                sewer=self).order_by('dist').values_list(
+                'dist', 'flooded_pct')
+        else:
+            measurements = zip(
+                columns['dist'].tolist(),
+                [none_if_nan(pct)
+                 for pct in columns['flooded_pct'].tolist()])
+        return waar_lines(self.code, measurements)
 
-        Each *MRIO can be classified according to its percentage flooded.
-        The class boundaries are printed in the ZZI and ZZJ fields of
-        the *WAAR record. Only *WAAR records that mark a change of
-        class are returned.
-        """
+    def generate_waar_lines_reference(self):
+        """The original version of generate_waar_lines(), that reads
+        SewerMeasurement rows, kept as a reference."""
 
         prev_klasse = None
         for measurement in SewerMeasurement.objects.filter(
@@ -550,6 +860,238 @@ class SewerMeasurement(models.Model):
         self.flooded_pct = percentage
 
 
+class PackedMeasurements(models.Model):
+    """All measurements of a sewer in a single row, instead of a
+    SewerMeasurement row each.
+
+    Their dist, bob, obb, water_level, flooded_pct and virtual values
+    are stored as packed arrays, one after the other, compressed and
+    base64 encoded. There are no geometries: measurements lie on the
+    straight line between the sewer's manholes, so their points are
+    interpolated along Sewer.the_geom when they are needed."""
+    FLOAT_FIELDS = ('dist', 'bob', 'obb', 'water_level', 'flooded_pct')
+
+    sewer = models.OneToOneField(Sewer, related_name="packed_measurements")
+    count = models.IntegerField()
+    data = models.TextField()
+
+    @classmethod
+    def from_table(cls, sewer, table):
+        """Return (unsaved) PackedMeasurements of the measurements in
+        table, an array of MEASUREMENT_DTYPE. They are stored sorted by
+        dist, measurements with the same dist in their original
+        order."""
+        table = table[np.argsort(table['dist'], kind='mergesort')]
+        columns = [table[field].astype('<f8') for field in cls.FLOAT_FIELDS]
+        columns.append(table['virtual'].astype(np.uint8))
+        data = ''.join(column.tostring() for column in columns)
+        return cls(
+            sewer=sewer, count=len(table),
+            data=base64.b64encode(zlib.compress(data)))
+
+    def columns(self):
+        """Return a dictionary field: array of the stored values. Unknown
+        water levels and flooded pcts are NaN."""
+        data = zlib.decompress(base64.b64decode(self.data))
+        floats = np.frombuffer(
+            data, dtype='<f8', count=len(self.FLOAT_FIELDS) * self.count)
+
+        columns = dict(
+            (field, floats[i * self.count:(i + 1) * self.count])
+            for i, field in enumerate(self.FLOAT_FIELDS))
+        columns['virtual'] = np.frombuffer(
+            data, dtype=np.uint8, count=self.count,
+            offset=floats.nbytes).astype(np.bool_)
+        return columns
+
+    def table(self, sewer=None):
+        """Return the measurements as an array of MEASUREMENT_DTYPE,
+        with x and y interpolated along the sewer. Pass the sewer if it
+        is already loaded."""
+        sewer = sewer or self.sewer
+        columns = self.columns()
+
+        table = np.empty(self.count, dtype=MEASUREMENT_DTYPE)
+        for field, column in columns.iteritems():
+            table[field] = column
+
+        x1, y1 = sewer.the_geom.coords[0]
+        x2, y2 = sewer.the_geom.coords[-1]
+        if sewer.the_geom_length:
+            factors = table['dist'] / sewer.the_geom_length
+        else:
+            factors = np.zeros(self.count)
+        table['x'] = x1 + factors * (x2 - x1)
+        table['y'] = y1 + factors * (y2 - y1)
+        return table
+
+    def measurements(self, sewer=None):
+        "Return a list of (unsaved) SewerMeasurements of the measurements."
+        sewer = sewer or self.sewer
+        return [
+            SewerMeasurement(
+                sewer=sewer,
+                dist=dist,
+                virtual=virtual,
+                water_level=none_if_nan(water_level),
+                flooded_pct=none_if_nan(flooded_pct),
+                bob=bob,
+                obb=obb,
+                the_geom=Point(x, y))
+            for (dist, bob, obb, x, y, virtual,
+                 water_level, flooded_pct) in self.table(sewer).tolist()]
+
+
+def uploads_version():
+    """Return the current version of the uploads feed. If the cache
+    lost it, a new one is started from the current time, so that it
+    doesn't repeat an old version."""
+    cache.add(UPLOADS_VERSION_KEY, int(time.time() * 1000), None)
+    version = cache.get(UPLOADS_VERSION_KEY)
+    if version is None:  # Evicted right away
+        version = int(time.time() * 1000)
+    return version
+
+
+def bump_uploads_version():
+    "Note that something in the uploads feed changed."
+    try:
+        cache.incr(UPLOADS_VERSION_KEY)
+    except ValueError:
+        # Not in the cache; the next uploads_version() starts anew
+        pass
+
+
+def upload_page_rows(after=0, limit=100):
+    """Return what a page of the uploads feed (see upload_statuses())
+    shows of each of its uploads, as far as it is in the database: a
+    list of (pk, the_time, status, error_count), ordered by pk. The
+    row after the page is included, as it decides whether there is a
+    next page. One query, of only these columns."""
+    return list(
+        Upload.objects.filter(pk__gt=after).order_by('pk').values_list(
+            'pk', 'the_time', 'status', 'error_count')[:limit + 1])
+
+
+def upload_statuses(after=0, limit=100):
+    """Return (uploads, first_errors, next_after) for a page of the
+    uploads feed: the first limit uploads with a pk greater than
+    after, ordered by pk; a dictionary upload pk: first
+    UploadedFileError of the unsuccessful ones among them; and the
+    after of the next page, or None if this is the last one.
+
+    Upload.error_description() used to load all errors of each upload;
+    this takes one query for the uploads, annotated with the line of
+    their first error, and one for those errors."""
+    uploads = list(
+        Upload.objects.filter(pk__gt=after).order_by('pk').annotate(
+            first_error_line=models.Min('uploadedfileerror__line'))[
+            :limit + 1])
+    next_after = uploads[limit - 1].pk if len(uploads) > limit else None
+    uploads = uploads[:limit]
+
+    first_lines = [
+        models.Q(uploaded_file=upload.pk, line=upload.first_error_line)
+        for upload in uploads
+        if (upload.status == Upload.UNSUCCESSFUL and
+            upload.first_error_line is not None)]
+
+    first_errors = dict()
+    if first_lines:
+        for error in UploadedFileError.objects.filter(
+            reduce(or_, first_lines)).order_by('-id'):
+            # The lowest id of each upload is seen last
+            first_errors[error.uploaded_file_id] = error
+
+    return uploads, first_errors, next_after
+
+
+def needs_measurement_rows(sewerage_pk):
+    """Return True if the measurements of a sewerage were saved only
+    as PackedMeasurements, so that Sewerage.materialize_measurements()
+    has SewerMeasurement rows to make. Doesn't lock anything."""
+    return (
+        not SewerMeasurement.objects.filter(
+            sewer__sewerage__pk=sewerage_pk).exists() and
+        PackedMeasurements.objects.filter(
+            sewer__sewerage__pk=sewerage_pk).exists())
+
+
+def measurement_values(sewerage_pk, *fields):
+    """Iterate over the measurements of a sewerage like
+    SewerMeasurement.objects.values_list(*fields), ordered by sewer and
+    dist. They come from the sewerage's PackedMeasurements if it has
+    any, otherwise from its SewerMeasurement rows.
+
+    Fields can be 'sewer__id', 'sewer__code', and the fields of
+    PackedMeasurements.columns()."""
+    packed = PackedMeasurements.objects.filter(
+        sewer__sewerage__pk=sewerage_pk)
+    if not packed.exists():
+        return SewerMeasurement.objects.filter(
+            sewer__sewerage__pk=sewerage_pk).order_by(
+            'sewer__id', 'dist', 'id').values_list(*fields).iterator()
+
+    return _packed_measurement_values(
+        packed.order_by('sewer__id').select_related('sewer'), fields)
+
+
+def measurement_tables(sewerage_pk, sewers):
+    """Return a dictionary sewer code: array of MEASUREMENT_DTYPE with
+    the stored measurements of each sewer of a sewerage, sorted by
+    dist. sewers is a dictionary sewer code: Sewer of the sewerage.
+    Sewers without measurements get an empty table."""
+    tables = dict(
+        (code, np.empty(0, dtype=MEASUREMENT_DTYPE)) for code in sewers)
+
+    packed = PackedMeasurements.objects.filter(
+        sewer__sewerage__pk=sewerage_pk).select_related('sewer')
+    if packed.exists():
+        for packed_measurements in packed.iterator():
+            code = packed_measurements.sewer.code
+            tables[code] = packed_measurements.table(sewers[code])
+        return tables
+
+    rows = SewerMeasurement.objects.filter(
+        sewer__sewerage__pk=sewerage_pk).order_by(
+        'sewer__id', 'dist', 'id').values_list(
+            'sewer__code', 'dist', 'bob', 'obb', 'the_geom', 'virtual',
+            'water_level', 'flooded_pct').iterator()
+    for code, sewer_rows in groupby(rows, key=itemgetter(0)):
+        tables[code] = np.array(
+            [(dist, bob, obb, the_geom.x, the_geom.y, virtual,
+              np.nan if water_level is None else water_level,
+              np.nan if flooded_pct is None else flooded_pct)
+             for (_, dist, bob, obb, the_geom, virtual,
+                  water_level, flooded_pct) in sewer_rows],
+            dtype=MEASUREMENT_DTYPE)
+    return tables
+
+
+def _packed_measurement_values(packed, fields):
+    for packed_measurements in packed.iterator():
+        sewer = packed_measurements.sewer
+        columns = packed_measurements.columns()
+        values = []
+        for field in fields:
+            if field == 'sewer__id':
+                values.append([sewer.id] * packed_measurements.count)
+            elif field == 'sewer__code':
+                values.append([sewer.code] * packed_measurements.count)
+            elif field in ('water_level', 'flooded_pct'):
+                values.append(
+                    [none_if_nan(value) for value in columns[field].tolist()])
+            else:
+                values.append(columns[field].tolist())
+
+        for row in zip(*values):
+            yield row
+
+
+def none_if_nan(value):
+    return None if value != value else value  # NaN != NaN
+
+
 def disc_segment(radius, height):
     """Compute the area of a disc segment with height 'height' in a
     circle of radius 'radius', when height < radius"""
@@ -570,3 +1112,57 @@ def disc_segment(radius, height):
     area = ((radius ** 2) / 2) * (angle - math.sin(angle))
 
     return area
+
+
+def clamp_water_levels(water_level, bob, obb):
+    """Vectorized SewerMeasurement.set_water_level(): restrict each
+    water level to be in between its bob and obb. Unknown water levels
+    (None or NaN) become NaN."""
+    water_level = np.array(water_level, dtype=np.float64)
+    return np.maximum(bob, np.minimum(obb, water_level))
+
+
+def flooded_fractions(water_level, bob, obb, shape):
+    """Vectorized SewerMeasurement.compute_flooded_pct().
+
+    All arguments are arrays of the same length, with the
+    measurements' (already clamped) water level, bob and obb, and the
+    shape of their sewer (Sewer.SHAPE_* codes). Returns an array of
+    flooded fractions, NaN where the water level is unknown.
+
+    The formulas are the same as those of the scalar version,
+    including the order in which the cases are decided, so results
+    are equal up to floating point rounding in the last bit."""
+    water_level = np.array(water_level, dtype=np.float64)
+    bob = np.asarray(bob, dtype=np.float64)
+    obb = np.asarray(obb, dtype=np.float64)
+    rectangular = np.asarray(shape) == Sewer.SHAPE_RECTANGULAR
+
+    depth = water_level - bob
+    diameter = obb - bob
+    radius = diameter / 2
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Circular. Below half, the flooded part is a disc segment with
+        # height depth; above half, it's the disc minus the dry segment.
+        area = math.pi * (radius ** 2)
+        lower_half = depth < radius
+        height = np.where(lower_half, depth, diameter - depth)
+        segment = disc_segments(radius, height)
+        fractions = np.where(
+            lower_half, segment / area, (area - segment) / area)
+        fractions[depth == radius] = 0.5
+
+        fractions = np.where(rectangular, depth / diameter, fractions)
+        fractions[depth >= diameter] = 1
+        fractions[depth <= 0.0] = 0
+
+    fractions[np.isnan(water_level)] = np.nan
+    return fractions
+
+
+def disc_segments(radius, height):
+    """Vectorized disc_segment(), without the checks. Gives NaN where
+    height is not in between 0 and 2 * radius."""
+    angle = 2 * np.arccos((radius - height) / radius)
+    return ((radius ** 2) / 2) * (angle - np.sin(angle))
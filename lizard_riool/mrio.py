@@ -0,0 +1,146 @@
+"""Streaming reader for the *MRIO records of SUFRMB files.
+
+sufriblib.parsers.parse() reads a whole file into memory before
+anything can be done with it. For large RMB files that is expensive,
+while the *MRIO records of a sewer are all we need at any one time.
+The functions here read only the *MRIO lines of an RMB file, found
+with its line index (see lizard_riool.line_index), and hand them out
+one sewer at a time.
+
+Field positions are those of the SUFRIB 2.1 specification (see the PDF
+in the data directory); fields are separated by '|'.
+"""
+
+import hashlib
+import logging
+
+from sufriblib.errors import Error
+
+from lizard_riool.line_index import LineIndex
+
+logger = logging.getLogger(__name__)
+
+
+class MRIO(object):
+    "A SUFRMB *MRIO record."
+
+    FIELDS = (
+        'ZYA', 'ZYB', 'ZYE', 'ZYK', 'ZYL', 'ZYM', 'ZYN', 'ZYO', 'ZYP',
+        'ZYQ', 'ZYR', 'ZYS', 'ZYT', 'ZYU', 'ZYV', 'ZYW', 'ZYX', 'ZYY',
+        'ZYZ')
+
+    def __init__(self, line_number, line):
+        """Split the line into its fields. Empty fields are None.
+
+        Raises ValueError if ZYA (distance), ZYT (measured value) or
+        ZYU (power of 10 of the measured value) are not numbers."""
+        self.line_number = line_number
+
+        values = [value.strip() for value in line.split("|")[1:]]
+        values += [""] * (len(MRIO.FIELDS) - len(values))
+        for field, value in zip(MRIO.FIELDS, values):
+            setattr(self, field, value or None)
+
+        self.distance = MRIO._float('ZYA', self.ZYA)
+        self.measurement = MRIO._float('ZYT', self.ZYT)
+        if self.ZYU is not None and self.measurement is not None:
+            self.measurement *= 10 ** MRIO._int('ZYU', self.ZYU)
+
+    @property
+    def sewer_id(self):
+        return self.ZYE
+
+    def values(self):
+        "Tuple of the values of the fields, None for empty ones."
+        return tuple(getattr(self, field) for field in MRIO.FIELDS)
+
+    @staticmethod
+    def _float(field, value):
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            raise ValueError(
+                "Waarde in veld {field}, '{value}', is geen decimaal getal."
+                .format(field=field, value=value))
+
+    @staticmethod
+    def _int(field, value):
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError(
+                "Waarde in veld {field}, '{value}', is geen geheel getal."
+                .format(field=field, value=value))
+
+
+def mrio_blocks(path, errors):
+    """Yield (sewer_id, [MRIO, ...]) for each run of consecutive
+    *MRIO lines with the same sewer id in the file at path.
+
+    Only one sewer's records are in memory at any time. That only
+    works if the records of a sewer are all together, as they are in
+    practice (they follow the sewer's *RIOO line). If they aren't, an
+    error is appended to errors (a list of sufriblib.errors.Error
+    objects), as it is for records that can't be read."""
+    return _blocks(LineIndex.for_file(path).record_lines(["*MRIO"]), errors)
+
+
+def sewer_blocks(path, sewer_ids, errors):
+    """Like mrio_blocks(), but only for the sewers with the given ids.
+    Only their lines are read from the file."""
+    return _blocks(
+        LineIndex.for_file(path).sewer_lines(sewer_ids, "*MRIO"), errors)
+
+
+def _blocks(lines, errors):
+    seen = set()
+    sewer_id = None
+    block = []
+
+    for line_number, line in lines:
+        try:
+            mrio = MRIO(line_number, line)
+        except ValueError as e:
+            errors.append(Error(line_number=line_number, message=str(e)))
+            continue
+
+        if mrio.sewer_id != sewer_id:
+            if block:
+                yield sewer_id, block
+            sewer_id = mrio.sewer_id
+            block = []
+
+            if sewer_id in seen:
+                errors.append(Error(
+                        line_number=line_number,
+                        message=(
+                            "De *MRIO regels van streng {sewer_id} staan "
+                            "niet allemaal bij elkaar.")
+                        .format(sewer_id=sewer_id)))
+            seen.add(sewer_id)
+
+        block.append(mrio)
+
+    if block:
+        yield sewer_id, block
+
+
+def block_digest(block):
+    """Return a hash of the field values of a block of MRIO records, as
+    yielded by mrio_blocks(). Blocks with the same records have the
+    same digest, wherever they are in the file."""
+    digest = hashlib.sha1()
+    for mrio in block:
+        digest.update(repr(mrio.values()))
+    return digest.hexdigest()
+
+
+def block_digests(path):
+    """Return a dictionary sewer id: block_digest() of the *MRIO
+    records of each sewer in the file at path. Records that can't be
+    read are left out."""
+    return dict(
+        (sewer_id, block_digest(block))
+        for sewer_id, block in mrio_blocks(path, []))
@@ -0,0 +1,303 @@
+"""A compact, array based representation of a sewerage network.
+
+The lost capacity computation used to work on a networkx graph whose
+nodes are tuples with an attribute dictionary each. For large
+sewerages that costs a lot of memory, so here nodes are just integers
+0..n-1, their bob and computed water level are kept in NumPy arrays,
+and the adjacency is stored in compressed sparse row (CSR) form: the
+neighbours of node i are indices[indptr[i]:indptr[i + 1]].
+
+SewerNetwork instances are built by lost_capacity.create_network().
+"""
+
+from heapq import heapify, heappush, heappop
+import logging
+
+import networkx as nx
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def csr_adjacency(number_of_nodes, sources, targets):
+    """Return (indptr, indices) of the undirected graph with the edges
+    (sources[i], targets[i]). Self loops are dropped."""
+    indptr, indices, _ = csr_adjacency_with_edges(
+        number_of_nodes, sources, targets)
+    return indptr, indices
+
+
+def csr_adjacency_with_edges(number_of_nodes, sources, targets):
+    """Like csr_adjacency(), but also returns an array edges that is
+    aligned with indices: edges[j] is the i of the edge (sources[i],
+    targets[i]) that indices[j] was reached by."""
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    edge_ids = np.arange(len(sources), dtype=np.int64)
+
+    keep = sources != targets
+    sources, targets, edge_ids = (
+        sources[keep], targets[keep], edge_ids[keep])
+
+    # Both directions
+    froms = np.concatenate((sources, targets))
+    tos = np.concatenate((targets, sources))
+    edges = np.concatenate((edge_ids, edge_ids))
+
+    order = np.argsort(froms, kind='mergesort')
+    indices = tos[order]
+    edges = edges[order]
+
+    indptr = np.zeros(number_of_nodes + 1, dtype=np.int64)
+    np.cumsum(
+        np.bincount(froms, minlength=number_of_nodes), out=indptr[1:])
+
+    return indptr, indices, edges
+
+
+def flood(indptr, indices, bob, sink):
+    """Compute the water level of every node connected to sink. Returns
+    an array of water levels, NaN for nodes that can't be reached.
+
+    Same algorithm as lost_capacity.compute_water_level(), on a CSR
+    adjacency. The computed levels double as the visited set."""
+    waterlevel = [None] * len(bob)
+    waterlevel[sink] = float(bob[sink])
+    return fill(indptr, indices, bob, waterlevel, [(waterlevel[sink], sink)])
+
+
+def reflood(indptr, indices, bob, waterlevel, basin, sinks):
+    """Compute the water levels of the nodes in basin (a boolean array)
+    again, keeping those of all other nodes. Returns the new array of
+    water levels.
+
+    Water enters the basin from the sinks in it and from the nodes
+    around it, at their known levels. That gives the same levels as
+    flood() if no node outside the basin can be reached more cheaply
+    through it, see SewerNetwork.affected_basin()."""
+    basin = np.asarray(basin, dtype=bool)
+    waterlevel = np.where(basin, np.nan, waterlevel)
+
+    # Nodes outside the basin next to a node in it
+    around = np.zeros(len(basin), dtype=bool)
+    around[indices[np.repeat(basin, np.diff(indptr))]] = True
+    around &= ~basin
+
+    todo = [(level, node) for node, level in zip(
+            np.flatnonzero(around).tolist(),
+            waterlevel[around].tolist()) if level == level]  # Not NaN
+    waterlevel = [
+        None if level != level else level for level in waterlevel.tolist()]
+    for sink in sinks:
+        if basin[sink]:
+            waterlevel[sink] = float(bob[sink])
+            todo.append((waterlevel[sink], sink))
+    heapify(todo)
+
+    return fill(indptr, indices, bob, waterlevel, todo)
+
+
+def fill(indptr, indices, bob, waterlevel, todo):
+    """Pour water into the network from the nodes in todo, a heap of
+    (water level, node), whose levels are already set in waterlevel
+    (a list, None for unknown). The lowest one is handled first;
+    nodes that get a level are added to the heap. Returns the levels
+    as an array, NaN for nodes that stay unknown."""
+    # Indexing Python lists is a lot faster than indexing NumPy
+    # arrays one element at a time.
+    indptr = indptr.tolist()
+    indices = indices.tolist()
+    bob = bob.tolist()
+
+    while todo:
+        water_level, node = heappop(todo)
+
+        pour = [node]
+        while pour:
+            current = pour.pop()
+            for neighbour in indices[indptr[current]:indptr[current + 1]]:
+                if waterlevel[neighbour] is not None:
+                    continue
+
+                neighbour_bob = bob[neighbour]
+                if neighbour_bob <= water_level:
+                    waterlevel[neighbour] = water_level
+                    pour.append(neighbour)
+                else:
+                    waterlevel[neighbour] = neighbour_bob
+                    heappush(todo, (neighbour_bob, neighbour))
+
+    # None becomes NaN
+    return np.array(waterlevel, dtype=np.float64)
+
+
+class SewerNetwork(object):
+    """A sewerage as a graph of integer nodes.
+
+    Nodes are laid out like the nodes of lost_capacity.create_graph():
+    one node per put, and per sewer a contiguous range of nodes: the
+    sewer end at manhole 1, the measurements ordered by dist, and the
+    sewer end at manhole 2.
+
+    Attributes:
+    - bob, waterlevel: float arrays indexed by node. waterlevel is NaN
+      for nodes that are not (yet) computed.
+    - dist: float array, the dist of measurement nodes, NaN otherwise
+    - indptr, indices: the CSR adjacency
+    - sink: node id of the sink, or None
+    - sinks: list of the node ids of all sinks; the others are
+      connected to sink
+    - put_nodes: dictionary put_id: node
+    - sewer_nodes: dictionary sewer_id: (first node, last node + 1)
+    - measurement_nodes: dictionary sewer_id: array with the node of
+      each of the sewer's measurements, in the order they were given
+    """
+
+    def __init__(self, bob, dist, indptr, indices, sink,
+                 put_nodes, sewer_nodes, measurement_nodes, sinks=None):
+        self.bob = bob
+        self.dist = dist
+        self.waterlevel = np.empty_like(bob)
+        self.waterlevel.fill(np.nan)
+        self.indptr = indptr
+        self.indices = indices
+        self.sink = sink
+        if sinks is None:
+            sinks = [] if sink is None else [sink]
+        self.sinks = sinks
+        self.put_nodes = put_nodes
+        self.sewer_nodes = sewer_nodes
+        self.measurement_nodes = measurement_nodes
+
+    def __len__(self):
+        return len(self.bob)
+
+    def neighbours(self, node):
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    def compute_water_level(self):
+        """Fill self.waterlevel. Nodes not connected to the sink get
+        NaN."""
+        if self.sink is None:
+            logger.warn("No sink in the network, no water levels computed.")
+            self.waterlevel.fill(np.nan)
+            return
+
+        self.waterlevel = flood(
+            self.indptr, self.indices, self.bob, self.sink)
+
+    def update_water_level(self, previous):
+        """Compute self.waterlevel from the water levels of previous, a
+        SewerNetwork made from the same sewers, before some bobs were
+        edited or some manholes made a sink or not. Only the water
+        levels in the affected_basin() of the edited nodes are computed
+        again. Returns a boolean array that is True for the nodes whose
+        water level changed."""
+        if (self.sink is None or previous.sink is None or
+            self.put_nodes != previous.put_nodes or
+            self.sewer_nodes != previous.sewer_nodes):
+            # Nothing to start from
+            self.compute_water_level()
+        else:
+            edited = np.flatnonzero(self.bob != previous.bob).tolist()
+            edited.extend(set(self.sinks) ^ set(previous.sinks))
+            if edited:
+                basin = previous.affected_basin(
+                    edited, min(self.bob[edited].min(),
+                                previous.bob[edited].min()))
+                self.waterlevel = reflood(
+                    self.indptr, self.indices, self.bob,
+                    previous.waterlevel, basin, self.sinks)
+            else:
+                self.waterlevel = previous.waterlevel.copy()
+
+        return ~((self.waterlevel == previous.waterlevel) |
+                 (np.isnan(self.waterlevel) & np.isnan(previous.waterlevel)))
+
+    def affected_basin(self, nodes, threshold):
+        """Return a boolean array that is True for the nodes whose water
+        level may change if the bobs of nodes change, or if they become
+        a sink or stop being one, with threshold the lowest of their
+        bobs before and after.
+
+        A node's water level is the lowest level at which water can
+        flow from a sink to it, over the highest peak in between. Nodes
+        below the threshold are reached over lower peaks than any of
+        the edited ones, and don't change. That leaves the nodes at or
+        above the threshold (or unreached) that are connected to one of
+        the edited nodes through such nodes."""
+        # Unreached nodes count as above
+        above = np.where(
+            np.isnan(self.waterlevel), np.inf, self.waterlevel) >= threshold
+        basin = np.zeros(len(self), dtype=bool)
+        todo = [node for node in nodes if above[node]]
+        basin[todo] = True
+        while todo:
+            neighbours = self.indices[np.concatenate(
+                    [np.arange(self.indptr[node], self.indptr[node + 1])
+                     for node in todo])]
+            neighbours = np.unique(neighbours[above[neighbours] &
+                                              ~basin[neighbours]])
+            basin[neighbours] = True
+            todo = neighbours.tolist()
+        return basin
+
+    def sewers_with_nodes(self, nodes):
+        """Return the set of ids of the sewers that have one of nodes (a
+        boolean array) among their nodes."""
+        counts = np.concatenate(([0], np.cumsum(nodes)))
+        return set(
+            sewer_id
+            for sewer_id, (start, stop) in self.sewer_nodes.iteritems()
+            if counts[stop] > counts[start])
+
+    def measurement_waterlevels(self, sewer_id):
+        """Return a list of the water levels of the measurements of
+        this sewer, in the order they were given; None if unknown."""
+        return [
+            None if level != level else level  # NaN != NaN
+            for level in
+            self.waterlevel[self.measurement_nodes[sewer_id]].tolist()]
+
+    def sewer_end_waterlevels(self, sewer_id):
+        """Return the water levels at both ends of a sewer, NaN if
+        unknown."""
+        start, stop = self.sewer_nodes[sewer_id]
+        return (float(self.waterlevel[start]),
+                float(self.waterlevel[stop - 1]))
+
+    def labels(self):
+        """Return a list with, for each node, the label the node has
+        in the networkx graph made by lost_capacity.create_graph()."""
+        dist = self.dist.tolist()
+        labels = [None] * len(self)
+        for put_id, node in self.put_nodes.iteritems():
+            labels[node] = ("put", put_id)
+        for sewer_id, (start, stop) in self.sewer_nodes.iteritems():
+            labels[start] = ("sewer_end", sewer_id, "1")
+            for node in xrange(start + 1, stop - 1):
+                labels[node] = ("measurement", sewer_id, dist[node])
+            labels[stop - 1] = ("sewer_end", sewer_id, "2")
+        return labels
+
+    def to_networkx(self):
+        """Export to a networkx graph like the one made by
+        lost_capacity.create_graph(), for debugging. Returns (G, sink_node),
+        where the nodes have 'bob' and 'waterlevel' attributes."""
+        labels = self.labels()
+        bobs = self.bob.tolist()
+        waterlevels = self.waterlevel.tolist()
+
+        G = nx.Graph()
+        for node, label in enumerate(labels):
+            waterlevel = waterlevels[node]
+            G.add_node(
+                label, bob=bobs[node],
+                waterlevel=None if waterlevel != waterlevel else waterlevel)
+
+        for node, label in enumerate(labels):
+            for neighbour in self.neighbours(node):
+                G.add_edge(label, labels[neighbour])
+
+        sink_node = labels[self.sink] if self.sink is not None else None
+        return G, sink_node
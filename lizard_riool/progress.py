@@ -0,0 +1,106 @@
+"""Progress of the processing of uploads.
+
+Processing an upload happens in a Celery worker, in a transaction, so
+the web server can't see anything of it in the database until it is
+done. The stage it is in is therefore kept in the cache (which must be
+shared, as for the locks in tasks.py), per upload. Every change bumps
+the version of the uploads feed, so that browsers that poll it (see
+views.uploaded_file_changes()) fetch the feed again.
+"""
+
+from contextlib import contextmanager
+import logging
+import time
+
+from django.core.cache import cache
+
+from lizard_riool import models
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_KEY = "lizard_riool_upload_progress_{upload_id}"
+PROGRESS_TIMEOUT = 60 * 60  # Processing takes minutes, not hours
+
+# The stages of processing a RIB and RMB file, with a label and a
+# rough estimate of the percentage of the time that each takes.
+STAGES = (
+    ('parsing', "Bestanden inlezen", 25),
+    ('manholes', "Putten opslaan", 5),
+    ('sewers', "Strengen opslaan", 10),
+    ('water_levels', "Waterstanden berekenen", 20),
+    ('measurements', "Metingen opslaan", 30),
+    ('rib', "RIB genereren", 10),
+)
+
+
+def progress_key(upload_id):
+    return PROGRESS_KEY.format(upload_id=upload_id)
+
+
+def upload_progress(upload_ids):
+    """Return a dictionary upload id: progress of those uploads that
+    have any, see UploadProgress.state()."""
+    progresses = cache.get_many(
+        [progress_key(upload_id) for upload_id in upload_ids])
+    return dict(
+        (upload_id, progresses[progress_key(upload_id)])
+        for upload_id in upload_ids
+        if progress_key(upload_id) in progresses)
+
+
+class UploadProgress(object):
+    """Reports the progress of processing some uploads (a RIB and its
+    RMB), stage by stage. Without uploads, it only logs."""
+
+    def __init__(self, upload_ids=()):
+        self.upload_ids = list(upload_ids)
+        self.current = None
+        self.percentage = 0
+        # (label, seconds) of the stages that are done, to see where
+        # the time goes
+        self.durations = []
+
+    @contextmanager
+    def stage(self, stage):
+        """Report that the with-block is the given stage, one of
+        STAGES. Afterwards, its duration is logged and kept."""
+        stages = [key for key, _, _ in STAGES]
+        index = stages.index(stage)
+        _, label, _ = STAGES[index]
+
+        self.current = label
+        self.percentage = sum(weight for _, _, weight in STAGES[:index])
+        self.report()
+
+        start = time.time()
+        yield
+        duration = time.time() - start
+
+        logger.info("Stage '%s' took %.2f s.", label, duration)
+        self.durations.append((label, round(duration, 2)))
+
+    def finish(self):
+        "Report that processing is done."
+        self.current = None
+        self.percentage = 100
+        self.report()
+
+    def state(self):
+        """Return the progress as a dictionary with the label of the
+        current 'stage' (None when done), its 'percentage' and the
+        'durations' of the stages before it."""
+        return {
+            'stage': self.current,
+            'percentage': self.percentage,
+            'durations': self.durations,
+            }
+
+    def report(self):
+        if not self.upload_ids:
+            return
+        state = self.state()
+        cache.set_many(
+            dict((progress_key(upload_id), state)
+                 for upload_id in self.upload_ids),
+            PROGRESS_TIMEOUT)
+        models.bump_uploads_version()
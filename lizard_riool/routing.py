@@ -0,0 +1,253 @@
+"""Routing index of a sewerage, for finding paths between manholes.
+
+PathFinder used to build a networkx graph of the whole sewerage for
+every click. A RoutingIndex holds the same graph in compressed sparse
+row form (see lizard_riool.network), with the code and length of the
+sewer along each edge and the coordinates of the manholes.
+
+The index is built when a sewerage is saved and stored as a .npz file
+in the sewerage's directory. Processes load it when it is first asked
+for and keep the most recently used ones (see loaded_files.py); it is
+reloaded if the file changes. Manhole coordinates are transformed once
+per requested SRID.
+"""
+
+from heapq import heappush, heappop
+import logging
+import os
+
+import numpy as np
+
+from lizard_riool import coordinates
+from lizard_riool import models
+from lizard_riool.loaded_files import LoadedFiles
+from lizard_riool.network import csr_adjacency_with_edges
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = "routing.npz"
+
+# Per process, the RoutingIndex of the most recently routed sewerages
+MAX_LOADED = 20
+_indexes = LoadedFiles(MAX_LOADED)
+
+
+class RoutingIndex(object):
+    """The manholes of a sewerage as nodes 0..n-1, connected by its
+    sewers.
+
+    Attributes:
+    - codes: list of manhole codes, indexed by node
+    - nodes: dictionary manhole code: node
+    - x, y: float arrays of WGS84 coordinates, indexed by node
+    - indptr, indices, edges: CSR adjacency; the neighbours of node i
+      are indices[indptr[i]:indptr[i + 1]], along the sewers with the
+      same positions in edges
+    - sewer_codes, lengths: the code and the_geom_length of each sewer
+    """
+
+    def __init__(self, codes, x, y, indptr, indices, edges,
+                 sewer_codes, lengths):
+        self.codes = list(codes)
+        self.nodes = dict((code, node) for node, code in enumerate(codes))
+        self.x = x
+        self.y = y
+        self.indptr = indptr
+        self.indices = indices
+        self.edges = edges
+        self.sewer_codes = list(sewer_codes)
+        self.lengths = lengths
+
+        # Lists are much faster to index one by one than arrays
+        self._indptr = indptr.tolist()
+        self._indices = indices.tolist()
+        self._edges = edges.tolist()
+        self._lengths = lengths.tolist()
+
+        # SRID: (x, y) lists
+        self._coordinates = dict()
+
+    @classmethod
+    def from_database(cls, sewerage_pk):
+        "Build the index of a sewerage, in two queries."
+        codes, x, y = [], [], []
+        for code, the_geom in models.Manhole.objects.filter(
+            sewerage__pk=sewerage_pk).order_by('id').values_list(
+            'code', 'the_geom'):
+            codes.append(code)
+            x.append(the_geom.x)  # These are WGS84
+            y.append(the_geom.y)
+        nodes = dict((code, node) for node, code in enumerate(codes))
+
+        sources, targets, sewer_codes, lengths = [], [], [], []
+        for sewer_code, code1, code2, length in models.Sewer.objects.filter(
+            sewerage__pk=sewerage_pk).order_by('id').values_list(
+            'code', 'manhole1__code', 'manhole2__code', 'the_geom_length'):
+            sources.append(nodes[code1])
+            targets.append(nodes[code2])
+            sewer_codes.append(sewer_code)
+            lengths.append(length)
+
+        indptr, indices, edges = csr_adjacency_with_edges(
+            len(codes), sources, targets)
+
+        return cls(codes, np.array(x, dtype=np.float64),
+                   np.array(y, dtype=np.float64), indptr, indices, edges,
+                   sewer_codes, np.array(lengths, dtype=np.float64))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(
+                data['codes'].tolist(), data['x'], data['y'],
+                data['indptr'], data['indices'], data['edges'],
+                data['sewer_codes'].tolist(), data['lengths'])
+
+    def save(self, path):
+        # Write to a temporary file first, processes may be loading it
+        temp_path = path + ".tmp"
+        with open(temp_path, 'wb') as f:
+            np.savez(
+                f, codes=np.array(self.codes, dtype=np.unicode_),
+                x=self.x, y=self.y, indptr=self.indptr,
+                indices=self.indices, edges=self.edges,
+                sewer_codes=np.array(self.sewer_codes, dtype=np.unicode_),
+                lengths=self.lengths)
+        os.rename(temp_path, path)
+
+    def shortest_path(self, source, target, weighted=False):
+        """Return (manhole codes, sewer codes) of the shortest path
+        from manhole source to manhole target. The path has the least
+        number of sewers, or if weighted is True, the least total
+        sewer length.
+
+        Raises ValueError if a manhole doesn't exist or if there is
+        no path."""
+        if source not in self.nodes or target not in self.nodes:
+            raise ValueError(
+                "Manhole {source} or {target} not found.".format(
+                    source=source, target=target))
+
+        source_node = self.nodes[source]
+        target_node = self.nodes[target]
+
+        if weighted:
+            previous = self._dijkstra(source_node, target_node)
+        else:
+            previous = self._breadth_first(source_node, target_node)
+
+        if target_node not in previous:
+            raise ValueError(
+                "No path from {source} to {target}.".format(
+                    source=source, target=target))
+
+        nodes = [target_node]
+        sewers = []
+        while nodes[-1] != source_node:
+            node, edge = previous[nodes[-1]]
+            nodes.append(node)
+            sewers.append(edge)
+        nodes.reverse()
+        sewers.reverse()
+
+        return ([self.codes[n] for n in nodes],
+                [self.sewer_codes[e] for e in sewers])
+
+    def _breadth_first(self, source, target):
+        """Return a dictionary node: (previous node, edge) of the nodes
+        found before target was reached."""
+        indptr, indices, edges = self._indptr, self._indices, self._edges
+
+        previous = {source: None}
+        level = [source]
+        while level and target not in previous:
+            next_level = []
+            for node in level:
+                for j in xrange(indptr[node], indptr[node + 1]):
+                    neighbour = indices[j]
+                    if neighbour not in previous:
+                        previous[neighbour] = (node, edges[j])
+                        next_level.append(neighbour)
+            level = next_level
+        return previous
+
+    def _dijkstra(self, source, target):
+        "Like _breadth_first(), weighted by sewer length."
+        indptr, indices, edges = self._indptr, self._indices, self._edges
+        lengths = self._lengths
+
+        previous = {source: None}
+        distances = {source: 0.0}
+        done = set()
+        todo = [(0.0, source)]
+        while todo:
+            distance, node = heappop(todo)
+            if node in done:
+                continue
+            if node == target:
+                break
+            done.add(node)
+
+            for j in xrange(indptr[node], indptr[node + 1]):
+                neighbour = indices[j]
+                new_distance = distance + lengths[edges[j]]
+                if (neighbour not in distances or
+                    new_distance < distances[neighbour]):
+                    distances[neighbour] = new_distance
+                    previous[neighbour] = (node, edges[j])
+                    heappush(todo, (new_distance, neighbour))
+        return previous
+
+    def coordinates(self, srid):
+        """Return (xs, ys), lists with the coordinates of all nodes in
+        this SRID. They are transformed only the first time."""
+        if srid not in self._coordinates:
+            xs, ys = coordinates.transform(
+                self.x, self.y, coordinates.WGS84_SRID, srid)
+            self._coordinates[srid] = (xs.tolist(), ys.tolist())
+        return self._coordinates[srid]
+
+    def locations(self, codes, srid):
+        "Return a list of (x, y) of these manholes, in this SRID."
+        xs, ys = self.coordinates(srid)
+        return [(xs[self.nodes[code]], ys[self.nodes[code]])
+                for code in codes]
+
+
+def index_path(sewerage_pk):
+    return os.path.join(
+        models.Sewerage.BASE_PATH, str(sewerage_pk), INDEX_FILENAME)
+
+
+def build_index(sewerage_pk):
+    """Build the index of a sewerage from the database and save it in
+    the sewerage's directory, which must exist."""
+    index = RoutingIndex.from_database(sewerage_pk)
+    index.save(index_path(sewerage_pk))
+    return index
+
+
+def get_index(sewerage_pk):
+    """Return the index of a sewerage. It is loaded from its file the
+    first time in this process, or when the file has changed. If
+    there is no file (sewerages saved before there were indexes), it
+    is built."""
+    path = index_path(sewerage_pk)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        if os.path.isdir(os.path.dirname(path)):
+            index = build_index(sewerage_pk)
+            mtime = os.path.getmtime(path)
+        else:
+            # Probably deleted; don't keep this around
+            _indexes.discard(sewerage_pk)
+            return RoutingIndex.from_database(sewerage_pk)
+    else:
+        index = _indexes.get(sewerage_pk, mtime)
+        if index is not None:
+            return index
+        index = RoutingIndex.load(path)
+
+    _indexes.put(sewerage_pk, mtime, index)
+    return index
@@ -1,49 +1,106 @@
 """Helper functions used by the "process uploaded file" task."""
 
+from bisect import bisect
+from collections import defaultdict
+from contextlib import contextmanager
+import logging
 import math
+import multiprocessing
 import os.path
-from itertools import chain, count
+import shutil
+import tempfile
+import time
+from itertools import chain, count, islice
 
+from django.conf import settings
 from django.contrib.gis.geos import LineString, Point
+from django.db import IntegrityError
+from django.db import transaction
 
-from lizard_map.coordinates import RD
+import numpy as np
 
 from sufriblib import parsers
 from sufriblib.errors import Error
 from sufriblib import util
 
+from . import coordinates
 from . import lost_capacity
+from . import line_index
 from . import models
+from . import routing
+from .progress import UploadProgress
+from . import side_profile
+from .mrio import mrio_blocks
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of primary keys in one "pk IN (...)" query; SQLite
+# doesn't allow more than 999 variables in a query.
+MAX_PKS_PER_QUERY = 500
+
+# If true, the RMB file isn't parsed as a whole by sufriblib but read
+# one sewer at a time, see stream_mrio().
+STREAM_RMB = getattr(settings, 'LIZARD_RIOOL_STREAM_RMB', False)
+
+# Number of SewerMeasurements that save_measurement_tables() creates
+# and inserts at a time.
+MEASUREMENT_CHUNK_SIZE = getattr(
+    settings, 'LIZARD_RIOOL_MEASUREMENT_CHUNK_SIZE', 10000)
+
+# How sewers without *MRIO data get virtual measurements. 'fixed': one
+# every LIZARD_RIOOL_VIRTUAL_SPACING meters and one at the end.
+# 'adaptive': one at each end and one where the water level along the
+# sewer starts to follow its bob (see water_level_breakpoint()), which
+# are all that the lost capacity and the side profile need, plus one
+# every LIZARD_RIOOL_VIRTUAL_SPACING meters if that is not None.
+VIRTUAL_MEASUREMENTS = getattr(
+    settings, 'LIZARD_RIOOL_VIRTUAL_MEASUREMENTS', 'fixed')
+VIRTUAL_SPACING = getattr(
+    settings, 'LIZARD_RIOOL_VIRTUAL_SPACING',
+    0.3 if VIRTUAL_MEASUREMENTS == 'fixed' else None)
+
+# Number of processes that make the measurement tables of the sewers
+# of a streamed RMB file (see map_sewers()). 1 does everything in the
+# worker itself, None uses all cores of the host.
+PROCESSES = getattr(settings, 'LIZARD_RIOOL_PROCESSES', 1)
+
+# Number of sewers that are handed to a process at a time, and the
+# number of sewers that are read ahead for the processes.
+SEWERS_PER_TASK = 50
+SEWERS_PER_BATCH = 5000
+
+# Where measurements are saved: 'rows', a SewerMeasurement per
+# measurement; 'packed', a PackedMeasurements per sewer, from which
+# rows are only made if the map needs them (see
+# Sewerage.materialize_measurements()); or 'both'.
+MEASUREMENT_STORAGE = getattr(
+    settings, 'LIZARD_RIOOL_MEASUREMENT_STORAGE', 'rows')
+
+# The measurements of a sewer, as kept by stream_mrio()
+MEASUREMENT_DTYPE = models.MEASUREMENT_DTYPE
+
+
+@contextmanager
+def log_duration(phase):
+    """Log how long the with-block took."""
+    start = time.time()
+    yield
+    logger.info("%s took %.2f s.", phase, time.time() - start)
 
 
 def protected_file_processing(rib_upload, rmb_upload):
     """Called from tasks.py, and wrapped there in a
     transaction.commit_on_success; in case of an exception in here,
-    nothing is committed."""
+    nothing is committed. Its progress is reported per stage, see
+    progress.py."""
+    progress = UploadProgress([rib_upload.pk, rmb_upload.pk])
 
-    # Initial parse of RIB and RMB file
-    ribinstance, riberrors = parsers.parse(rib_upload.full_path)
-    rmbinstance, rmberrors = parsers.parse(rmb_upload.full_path)
+    with progress.stage('parsing'):
+        for upload in (rib_upload, rmb_upload):
+            line_index.save_index(upload.full_path)
 
-    putdict = None
-    sewerdict = None
-    if ribinstance:
-        # Get PUT data from the RIB and put it in a dictionary
-        putdict = get_puts(ribinstance, riberrors)
-        # Get RIOOL data from the RIB and put it in a dictionary
-        sewerdict = get_sewers(
-            ribinstance, putdict, riberrors)
-
-        if rmbinstance:
-            # Add MRIO information from the RMB to the sewerdict
-            lines = mrio_lines_by_sewer_id(rmbinstance)
-            for sewer in sewerdict:
-                sewerdict[sewer]['measurements'] = (
-                    get_mrio(
-                        lines,
-                        putdict,
-                        sewerdict[sewer],
-                        rmberrors))
+        putdict, sewerdict, riberrors, rmberrors = parse_files(
+            rib_upload.full_path, rmb_upload.full_path, STREAM_RMB)
 
     if putdict and sewerdict and not riberrors and not rmberrors:
         # From here on, no more errors are added, we assume all the
@@ -51,9 +108,15 @@ def protected_file_processing(rib_upload, rmb_upload):
         # some further processing along the way.
 
         # Save everything into the database
-        save_into_database(
-            rib_upload.full_path, rmb_upload.full_path,
-            putdict, sewerdict, rmberrors)
+        if STREAM_RMB:
+            save_streamed_into_database(
+                rib_upload.full_path, rmb_upload.full_path,
+                putdict, sewerdict, rmberrors, progress)
+        else:
+            save_into_database(
+                rib_upload.full_path, rmb_upload.full_path,
+                putdict, sewerdict, rmberrors, progress)
+        progress.finish()
         rib_upload.set_successful()
         rmb_upload.set_successful()
     else:
@@ -75,6 +138,79 @@ def protected_file_processing(rib_upload, rmb_upload):
         rmb_upload.set_unsuccessful()
 
 
+def parse_files(rib_path, rmb_path, stream=STREAM_RMB):
+    """Read a RIB and RMB file into a putdict and a sewerdict with the
+    measurements of each sewer: the data that save_into_database()
+    or, if stream, save_streamed_into_database() saves. Returns
+    (putdict, sewerdict, riberrors, rmberrors); the dictionaries are
+    None if the RIB file can't be parsed.
+
+    If stream, sufriblib only checks the lines of the RMB file that
+    aren't *MRIO lines (see check_other_records()). The *MRIO lines
+    get the checks of lizard_riool.mrio (ZYA, ZYT and ZYU are numbers,
+    the lines of a sewer are together) and of get_mrio() (ZYR, ZYS
+    and ZYB are present, supported and the same for a whole sewer),
+    as they do without streaming. Any other checks that sufriblib
+    makes of *MRIO fields are not made."""
+    ribinstance, riberrors = parsers.parse(rib_path)
+    if stream:
+        rmbinstance, rmberrors = None, []
+        check_other_records(rmb_path, rmberrors)
+    else:
+        rmbinstance, rmberrors = parsers.parse(rmb_path)
+
+    putdict = None
+    sewerdict = None
+    if ribinstance:
+        # Get PUT data from the RIB and put it in a dictionary
+        putdict = get_puts(ribinstance, riberrors)
+        # Get RIOOL data from the RIB and put it in a dictionary
+        sewerdict = get_sewers(
+            ribinstance, putdict, riberrors)
+
+        if stream:
+            stream_mrio(rmb_path, putdict, sewerdict, riberrors, rmberrors)
+        elif rmbinstance:
+            # Add MRIO information from the RMB to the sewerdict
+            lines = mrio_lines_by_sewer_id(rmbinstance)
+            for sewer in sewerdict:
+                sewerdict[sewer]['measurements'] = (
+                    get_mrio(
+                        lines,
+                        putdict,
+                        sewerdict[sewer],
+                        rmberrors))
+
+    return putdict, sewerdict, riberrors, rmberrors
+
+
+def check_other_records(rmb_path, rmberrors):
+    """Have sufriblib check the lines of the RMB file at rmb_path that
+    aren't *MRIO lines (*ALGE, *RIOO, ...), and append its errors to
+    rmberrors, with their line numbers in the file. There are few of
+    those lines, so they are copied to a temporary file with the same
+    name, which sufriblib parses."""
+    lines = list(line_index.LineIndex.for_file(rmb_path).other_lines(
+            ["*MRIO"]))
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, os.path.basename(rmb_path))
+        with open(path, 'wb') as f:
+            for _, line in lines:
+                f.write(line + '\r\n')
+        _, errors = parsers.parse(path)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    for error in errors:
+        line_number = error.line_number
+        if 1 <= line_number <= len(lines):
+            line_number = lines[line_number - 1][0]
+        rmberrors.append(
+            Error(line_number=line_number, message=error.message))
+
+
 def get_puts(ribfile, riberrors):
     """Returns a dictionary {putid: putinfo} where putinfo has is
     itself a dictionary with the following keys:
@@ -134,7 +270,7 @@ def get_puts(ribfile, riberrors):
         putdict[putid] = {
             'line_number': putline.line_number,
             'putid': putid,
-            'coordinate': putline.wgs84_point,
+            'coordinate': None,  # Set below
             'rd_coordinate': putline.rd_point,
             'is_sink': is_sink,
             'surface_level': surface_level
@@ -145,9 +281,23 @@ def get_puts(ribfile, riberrors):
                 line_number=0,
                 message="Markeer minstens 1 put als gemaal!"))
 
+    set_wgs84_coordinates(putdict.values())
+
     return putdict
 
 
+def set_wgs84_coordinates(putinfos):
+    """Set the 'coordinate' of the puts from their 'rd_coordinate', in
+    one transformation. Puts without RD coordinate are skipped."""
+    putinfos = [putinfo for putinfo in putinfos
+                if putinfo['rd_coordinate'] is not None]
+    xs, ys = coordinates.rd_to_wgs84(
+        [putinfo['rd_coordinate'][0] for putinfo in putinfos],
+        [putinfo['rd_coordinate'][1] for putinfo in putinfos])
+    for putinfo, x, y in zip(putinfos, xs.tolist(), ys.tolist()):
+        putinfo['coordinate'] = (x, y)
+
+
 def get_sewers(ribfile, putdict, riberrors):
     """Returns the sewers. Uses putdict to check if puts mentioned
     actually exist. Appends errors to riberrors. Gets its data from
@@ -165,6 +315,7 @@ def get_sewers(ribfile, putdict, riberrors):
     """
 
     sewerdict = dict()
+    new_putinfos = []  # Puts defined in *RIOO lines
 
     for sewerline in ribfile.lines_of_type("*RIOO"):
         # Get bob1 from ACR
@@ -225,7 +376,7 @@ def get_sewers(ribfile, putdict, riberrors):
                         .format(acb=sewerline.ACB)))
 
         if sewerline.manhole1_id not in putdict:
-            manhole1_coordinate = sewerline.manhole1_wgs84_point
+            manhole1_coordinate = sewerline.manhole1_rd_point
 
             if manhole1_coordinate is None:
                 riberrors.append(Error(
@@ -242,14 +393,15 @@ def get_sewers(ribfile, putdict, riberrors):
                 putdict[sewerline.manhole1_id] = {
                     'line_number': sewerline.line_number,
                     'putid': sewerline.manhole1_id,
-                    'coordinate': manhole1_coordinate,
-                    'rd_coordinate': sewerline.manhole1_rd_point,
+                    'coordinate': None,  # Set below
+                    'rd_coordinate': manhole1_coordinate,
                     'is_sink': False,
                     'surface_level': None
                     }
+                new_putinfos.append(putdict[sewerline.manhole1_id])
 
         if sewerline.manhole2_id not in putdict:
-            manhole2_coordinate = sewerline.manhole2_wgs84_point
+            manhole2_coordinate = sewerline.manhole2_rd_point
 
             if manhole2_coordinate is None:
                 riberrors.append(Error(
@@ -266,11 +418,12 @@ def get_sewers(ribfile, putdict, riberrors):
                 putdict[sewerline.manhole2_id] = {
                     'line_number': sewerline.line_number,
                     'putid': sewerline.manhole2_id,
-                    'coordinate': manhole2_coordinate,
-                    'rd_coordinate': sewerline.manhole2_rd_point,
+                    'coordinate': None,  # Set below
+                    'rd_coordinate': manhole2_coordinate,
                     'is_sink': False,
                     'surface_level': None
                     }
+                new_putinfos.append(putdict[sewerline.manhole2_id])
 
         sewerdict[sewerline.sewer_id] = {
             'sewer_id': sewerline.sewer_id,
@@ -296,6 +449,8 @@ def get_sewers(ribfile, putdict, riberrors):
             putdict[sewerline.manhole2_id]['surface_level'] = (
                 bob_2 + sewerline.ACI)
 
+    set_wgs84_coordinates(new_putinfos)
+
     return sewerdict
 
 
@@ -413,39 +568,258 @@ def get_mrio(lines, putdict, sewerinfo, rmberrors):
     return mrios
 
 
-def virtual_measurements(sewer):
-    startx = sewer.manhole1.the_geom.x  # These are WGS84
-    starty = sewer.manhole1.the_geom.y
-    startbob = sewer.bob1
-
-    dx = sewer.manhole2.the_geom.x - startx
-    dy = sewer.manhole2.the_geom.y - starty
-    dbob = sewer.bob2 - startbob
+def stream_mrio(rmb_path, putdict, sewerdict, riberrors, rmberrors):
+    """Add the measurements of the RMB file at rmb_path to sewerdict,
+    reading it one sewer at a time (see lizard_riool.mrio).
+
+    The measurements of each sewer are turned into a table right away
+    (see measurement_table()), so that the MRIO lines of only a few
+    sewers are kept in memory. Sewers are independent of each other,
+    so this is done by PROCESSES processes (see map_sewers()). If
+    there are errors, no tables are kept; the upload is rejected
+    anyway."""
+    units = (
+        (sewer_id, sewerinfo_and_puts(sewerdict[sewer_id], putdict), lines)
+        for sewer_id, lines in mrio_blocks(rmb_path, rmberrors)
+        if sewer_id in sewerdict)
+
+    for sewer_id, table, quality, errors in map_sewers(sewer_table, units):
+        rmberrors.extend(errors)
+        if not riberrors and not rmberrors:
+            sewerdict[sewer_id]['measurements'] = table
+            sewerdict[sewer_id]['quality'] = quality
+
+    if riberrors or rmberrors:
+        return
 
-    total_length = sewer.the_geom_length  # m
+    # Sewers without *MRIO lines get virtual measurements
+    for sewerinfo in sewerdict.itervalues():
+        if 'measurements' not in sewerinfo:
+            sewerinfo['measurements'] = measurement_table(
+                sewerinfo, putdict, [])
+
+
+def sewerinfo_and_puts(sewerinfo, putdict):
+    """Return (sewerinfo, the part of putdict with its manholes), all
+    that get_mrio() and measurement_table() need of one sewer."""
+    return sewerinfo, dict(
+        (code, putdict[code]) for code in
+        (sewerinfo['manhole_code_1'], sewerinfo['manhole_code_2']))
+
+
+def sewer_table(unit):
+    """Return (sewer_id, measurement table, quality, errors) of the
+    *MRIO lines of a sewer; the table and quality are None if there
+    are errors. A unit of work of stream_mrio(); this may run in a
+    pool process, so everything it needs is in unit."""
+    sewer_id, (sewerinfo, putdict), lines = unit
+    errors = []
+    mrios = get_mrio({sewer_id: lines}, putdict, sewerinfo, errors)
+    if errors:
+        return sewer_id, None, None, errors
+    table = measurement_table(sewerinfo, putdict, mrios)
+    return sewer_id, table, sewerinfo['quality'], errors
+
+
+def map_sewers(function, units):
+    """Yield function(unit) for each of units, in order.
+
+    If PROCESSES is not 1, the units are handed to a pool of that many
+    processes (all cores if it is None), SEWERS_PER_BATCH at a time, so
+    that only that many units are read ahead. Results come back in the
+    order of units, so they are the same as without a pool."""
+    processes = PROCESSES
+    if processes != 1 and multiprocessing.current_process().daemon:
+        # Daemonic processes (some Celery pools) can't have children
+        logger.warning(
+            "Can't start processes from a daemonic process, "
+            "working alone.")
+        processes = 1
+
+    if processes == 1:
+        for unit in units:
+            yield function(unit)
+        return
 
-    distance = 0.3  # Every 30cm
+    pool = multiprocessing.Pool(processes)
+    try:
+        units = iter(units)
+        while True:
+            batch = list(islice(units, SEWERS_PER_BATCH))
+            if not batch:
+                break
+            for result in pool.imap(
+                function, batch, chunksize=SEWERS_PER_TASK):
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def measurement_table(sewerinfo, putdict, mrios):
+    """Return the measurements of a sewer as an array of
+    MEASUREMENT_DTYPE, with the values that create_measurements()
+    gives its SewerMeasurements: the bob corrected mrios between two
+    virtual ones at the ends of the sewer, or only virtual ones if
+    there are no mrios. Water level and flooded pct are NaN.
+
+    Also judges the quality of the sewer into sewerinfo['quality'],
+    which save_sewers() uses."""
+    put1 = putdict[sewerinfo['manhole_code_1']]
+    put2 = putdict[sewerinfo['manhole_code_2']]
+    x1, y1 = put1['coordinate']
+    x2, y2 = put2['coordinate']
+    bob1 = sewerinfo['bob_1']
+    bob2 = sewerinfo['bob_2']
+    diameter = sewerinfo['diameter']
+    length = rd_lengths(putdict, [sewerinfo]).tolist()[0]
+
+    if mrios:
+        dists = [m['dist'] for m in mrios]
+        bobs = [m['bob'] for m in mrios]
+        sewerinfo['quality'] = models.Sewer.judged_quality(dists, length)
+
+        corrections = bob_corrections(bob1, bob2, length, dists, bobs)
+
+        table = np.empty(len(mrios) + 2, dtype=MEASUREMENT_DTYPE)
+        table['dist'] = [0] + dists + [length]
+        table['bob'] = (
+            [bob1] +
+            [bob + correction for bob, correction in zip(bobs, corrections)] +
+            [bob2])
+        table['obb'] = (
+            [bob1 + diameter] +
+            [(bob + diameter) + correction
+             for bob, correction in zip(bobs, corrections)] +
+            [bob2 + diameter])
+        table['x'] = [x1] + [m['coordinate'][0] for m in mrios] + [x2]
+        table['y'] = [y1] + [m['coordinate'][1] for m in mrios] + [y2]
+        table['virtual'] = False
+        table['virtual'][[0, -1]] = True
+    else:
+        sewerinfo['quality'] = models.Sewer.QUALITY_UNKNOWN
+
+        dists = virtual_dists(length)
+        factors = [dist / length for dist in dists[:-1]]
+
+        table = np.empty(len(dists), dtype=MEASUREMENT_DTYPE)
+        table['dist'] = dists
+        table['bob'] = [bob1 + f * (bob2 - bob1) for f in factors] + [bob2]
+        table['obb'] = table['bob'] + diameter
+        table['x'] = [x1 + f * (x2 - x1) for f in factors] + [x2]
+        table['y'] = [y1 + f * (y2 - y1) for f in factors] + [y2]
+        table['virtual'] = True
+
+    table['water_level'] = np.nan
+    table['flooded_pct'] = np.nan
+    return table
+
+
+def virtual_dists(total_length, spacing=VIRTUAL_SPACING):
+    """Return the dists of the virtual measurements of a sewer: one
+    every spacing meters (30cm by default), and one at the end. If
+    spacing is None, only the start and the end."""
+    if spacing is None:
+        steps = [0]
+    else:
+        steps = count(start=0, step=spacing)
 
-    for dist in count(start=0, step=distance):
+    dists = []
+    for dist in steps:
         if dist >= total_length:
             break
+        dists.append(dist)
+
+    # Add last point
+    dists.append(total_length)
+    return dists
+
+
+def water_level_breakpoint(length, bob1, bob2, level1, level2):
+    """Return the dist along a straight sewer where its water level
+    stops being level, or None if there is no such point.
+
+    If the water levels at the ends of the sewer are level1 and level2,
+    the water level at every point in between is the higher of its bob
+    and the lower of level1 and level2. Along a straight sewer that is
+    level up to the point where the bob rises above it, and equal to
+    the bob from there on, so measurements at both ends and at that
+    point describe the water level completely."""
+    if level1 != level1 or level2 != level2:  # NaN, not connected
+        return None
+
+    level = min(level1, level2)
+    if not min(bob1, bob2) < level < max(bob1, bob2):
+        return None
 
-        factor = dist / total_length
+    return (level - bob1) / (bob2 - bob1) * length
 
-        yield models.SewerMeasurement(
-            sewer=sewer,
-            dist=dist,
-            virtual=True,
-            water_level=None,
-            flooded_pct=None,
-            bob=(startbob + factor * dbob),
-            obb=(startbob + factor * dbob) + sewer.diameter,
-            the_geom=Point(startx + factor * dx, starty + factor * dy))
+
+def add_water_level_breakpoints(saved_sewers, measurements_dict, network):
+    """In 'adaptive' mode, add a virtual measurement at the
+    water_level_breakpoint() of each sewer that only has virtual
+    measurements, with its water level and flooded pct set."""
+    if VIRTUAL_MEASUREMENTS != 'adaptive' or network is None:
+        return
+
+    for sewer_id, measurements in measurements_dict.iteritems():
+        if not all(m.virtual for m in measurements):
+            continue
+        sewer = saved_sewers[sewer_id]
+        dist = water_level_breakpoint(
+            sewer.the_geom_length, sewer.bob1, sewer.bob2,
+            *network.sewer_end_waterlevels(sewer_id))
+        dists = [m.dist for m in measurements]
+        if dist is None or dist in dists:
+            continue
+
+        measurement = interpolated_measurement(sewer, dist)
+        measurement.set_water_level(measurement.bob)
+        measurement.compute_flooded_pct(use_sewer=sewer)
+        measurements.insert(bisect(dists, dist), measurement)
+
+
+def add_water_level_breakpoints_to_tables(sewerdict, tables, network):
+    "Like add_water_level_breakpoints(), for measurement tables."
+    if VIRTUAL_MEASUREMENTS != 'adaptive':
+        return
+
+    for sewer_id, table in tables.items():
+        if not table['virtual'].all():
+            continue
+        sewerinfo = sewerdict[sewer_id]
+        length = table['dist'][-1]
+        dist = water_level_breakpoint(
+            length, sewerinfo['bob_1'], sewerinfo['bob_2'],
+            *network.sewer_end_waterlevels(sewer_id))
+        if dist is None or dist in table['dist']:
+            continue
+
+        factor = dist / length
+        bob = table['bob'][0] + factor * (table['bob'][-1] - table['bob'][0])
+        row = np.empty(1, dtype=MEASUREMENT_DTYPE)
+        row['dist'] = dist
+        row['bob'] = bob
+        row['obb'] = bob + sewerinfo['diameter']
+        row['x'] = table['x'][0] + factor * (table['x'][-1] - table['x'][0])
+        row['y'] = table['y'][0] + factor * (table['y'][-1] - table['y'][0])
+        row['virtual'] = True
+        row['water_level'] = bob
+        row['flooded_pct'] = 0.0  # Water level at the bob
+
+        tables[sewer_id] = sewerinfo['measurements'] = np.insert(
+            table, np.searchsorted(table['dist'], dist), row)
+
+
+def virtual_measurements(sewer):
+    for dist in virtual_dists(sewer.the_geom_length)[:-1]:
+        yield interpolated_measurement(sewer, dist)
 
     # Add last point
     yield models.SewerMeasurement(
         sewer=sewer,
-        dist=total_length,
+        dist=sewer.the_geom_length,
         virtual=True,
         water_level=None,
         flooded_pct=None,
@@ -454,6 +828,30 @@ def virtual_measurements(sewer):
         the_geom=sewer.manhole2.the_geom)
 
 
+def interpolated_measurement(sewer, dist):
+    """Return a virtual SewerMeasurement at dist along the ideal line
+    of the sewer."""
+    startx = sewer.manhole1.the_geom.x  # These are WGS84
+    starty = sewer.manhole1.the_geom.y
+    startbob = sewer.bob1
+
+    dx = sewer.manhole2.the_geom.x - startx
+    dy = sewer.manhole2.the_geom.y - starty
+    dbob = sewer.bob2 - startbob
+
+    factor = dist / sewer.the_geom_length
+
+    return models.SewerMeasurement(
+        sewer=sewer,
+        dist=dist,
+        virtual=True,
+        water_level=None,
+        flooded_pct=None,
+        bob=(startbob + factor * dbob),
+        obb=(startbob + factor * dbob) + sewer.diameter,
+        the_geom=Point(startx + factor * dx, starty + factor * dy))
+
+
 def distance(p1, p2):
     return math.sqrt((p2[0] - p1[0]) ** 2 + (p2[1] - p1[1]) ** 2)
 
@@ -461,6 +859,83 @@ def distance(p1, p2):
 def set_geoms_dists(
     mrios, rd_location_manhole1, rd_location_manhole2,
     bob1, bob2, zyrzys, reverse):
+    """Set the 'rd_coordinate', 'coordinate' (WGS84), 'dist' and 'bob'
+    of the mrios of one sewer, which are sorted by 'distance'.
+
+    The mrios lie along the straight line between the manholes, and
+    their bob follows from their measurement: for AE and AF it is a
+    slope (in degrees, or percent) since the previous mrio, for CB it
+    is relative to the ideal line. If reverse is True, the manholes
+    have been swapped and dist is measured from the other end.
+
+    This is done for all mrios at once; set_geoms_dists_reference()
+    is the original version."""
+    if not mrios:
+        return
+
+    horizontal_distance = distance(
+        rd_location_manhole1, rd_location_manhole2)
+    vertical_distance = abs(bob1 - bob2)
+    straight_distance = math.sqrt(
+        vertical_distance ** 2 + horizontal_distance ** 2)
+
+    x1, y1 = rd_location_manhole1
+    dx = rd_location_manhole2[0] - x1
+    dy = rd_location_manhole2[1] - y1
+
+    percentage_along = np.array(
+        [mrio['distance'] for mrio in mrios],
+        dtype=np.float64) / straight_distance
+    measurement = np.array(
+        [mrio['measurement'] for mrio in mrios], dtype=np.float64)
+
+    rd_x = x1 + percentage_along * dx
+    rd_y = y1 + percentage_along * dy
+
+    dists = percentage_along * horizontal_distance
+    if reverse:
+        dists = horizontal_distance - dists
+
+    if zyrzys == "CB":
+        # Meters relative to the ideal line
+        bobs = bob1 + (bob2 - bob1) * percentage_along + measurement
+    elif zyrzys in ("AE", "AF"):
+        # Distance from the previous mrio, the first from manhole 1
+        step_x = np.diff(np.concatenate(([x1], rd_x)))
+        step_y = np.diff(np.concatenate(([y1], rd_y)))
+        steps = np.sqrt(step_x ** 2 + step_y ** 2)
+
+        if zyrzys == "AE":
+            # Slope in degrees
+            rises = steps * np.tan(measurement / 180 * math.pi)
+        else:
+            # Slope in percent
+            rises = steps * measurement / 100.0
+
+        # Summed one after the other, like the mrio by mrio version
+        bobs = np.cumsum(np.concatenate(([bob1], rises)))[1:]
+    else:
+        bobs = None
+
+    wgs84_x, wgs84_y = coordinates.rd_to_wgs84(rd_x, rd_y)
+
+    rd_coordinates = zip(rd_x.tolist(), rd_y.tolist())
+    wgs84_coordinates = zip(wgs84_x.tolist(), wgs84_y.tolist())
+    dists = dists.tolist()
+    bobs = bobs.tolist() if bobs is not None else None
+    for i, mrio in enumerate(mrios):
+        mrio['rd_coordinate'] = rd_coordinates[i]
+        mrio['coordinate'] = wgs84_coordinates[i]
+        mrio['dist'] = dists[i]
+        if bobs is not None:
+            mrio['bob'] = bobs[i]
+
+
+def set_geoms_dists_reference(
+    mrios, rd_location_manhole1, rd_location_manhole2,
+    bob1, bob2, zyrzys, reverse):
+    """The original, one mrio at a time version of set_geoms_dists(),
+    kept as a reference."""
     horizontal_distance = distance(
         rd_location_manhole1, rd_location_manhole2)
     vertical_distance = abs(bob1 - bob2)
@@ -506,58 +981,235 @@ def set_geoms_dists(
             mrio['dist'] = horizontal_distance - mrio['dist']
 
 
-def save_into_database(rib_path, rmb_path, putdict, sewerdict, rmberrors):
-    # Get sewerage name, try to create sewerage
-    # If it exists, return with an error
+def create_sewerage(rmb_path, rmberrors):
+    """Create the Sewerage, named after the RMB file. If one with that
+    name exists already, add an error to rmberrors and return None.
+
+    Sewerage.name is unique, so this is what reserves the name: if
+    another transaction created a sewerage with the same name, the
+    insert waits until that one is committed, and then fails. Call it
+    in a transaction."""
     sewerage_name = os.path.basename(rmb_path)[:-4]  # Minus ".RMB"
 
-    if models.Sewerage.objects.filter(name=sewerage_name).exists():
+    savepoint = transaction.savepoint()
+    try:
+        # Files are copied only at the end
+        sewerage = models.Sewerage.objects.create(
+            name=sewerage_name,
+            rib=None,  # Filled in later
+            rmb=None,
+            active=True)
+    except IntegrityError:
+        transaction.savepoint_rollback(savepoint)
         rmberrors.append(Error(
                 line_number=0,
                 message=("Er bestaat al een stelsel met de naam {name}. "
                  "Verwijder het op de archiefpagina, of gebruik "
                  "een andere naam.").format(name=sewerage_name)))
+        return None
+
+    transaction.savepoint_commit(savepoint)
+    return sewerage
+
+
+def save_into_database(
+    rib_path, rmb_path, putdict, sewerdict, rmberrors, progress=None):
+    if progress is None:
+        progress = UploadProgress()
+
+    # Get sewerage name, try to create sewerage
+    # If it exists, return with an error
+    sewerage = create_sewerage(rmb_path, rmberrors)
+    if sewerage is None:
         return
 
-    # Files are copied only at the end
-    sewerage = models.Sewerage.objects.create(
-        name=sewerage_name,
-        rib=None,  # Filled in later
-        rmb=None,
-        active=True)
-
-    # Save the puts, keep a dictionary
-    saved_puts = dict()
-    for put_id, putinfo in putdict.items():
-        saved_puts[put_id] = models.Manhole.objects.create(
-            sewerage=sewerage,
-            code=put_id,
-            sink=int(putinfo['is_sink']),
-            ground_level=putinfo['surface_level'],
-            the_geom=Point(*putinfo['coordinate']))
-
-    # Save the sewers, use the dictionary
-    saved_sewers = dict()
-    for sewer_id, sewerinfo in sewerdict.items():
+    with progress.stage('manholes'), log_duration("Saving manholes"):
+        saved_puts = save_manholes(sewerage, putdict)
+
+    with progress.stage('sewers'), log_duration("Saving sewers"):
+        saved_sewers = save_sewers(sewerage, sewerdict, putdict, saved_puts)
+
+    with progress.stage('water_levels'):
+        with log_duration("Creating measurements"):
+            sewer_measurements_dict = create_measurements(
+                sewerdict, saved_sewers)
+
+        # Actually compute the lost capacity, the point of this app
+        with log_duration("Computing lost capacity"):
+            network = lost_capacity.compute_lost_capacity(
+                saved_puts, saved_sewers, sewer_measurements_dict)
+            add_water_level_breakpoints(
+                saved_sewers, sewer_measurements_dict, network)
+
+    # Save all the SewerMeasurement objects to the database. Since
+    # there are thousands of them, it is essential to use bulk_create.
+    with progress.stage('measurements'), log_duration("Saving measurements"):
+        if MEASUREMENT_STORAGE in ('packed', 'both'):
+            save_packed_measurements(saved_sewers, dict(
+                    (sewer_id, measurements_as_table(measurements))
+                    for sewer_id, measurements
+                    in sewer_measurements_dict.iteritems()))
+        if MEASUREMENT_STORAGE in ('rows', 'both'):
+            models.SewerMeasurement.objects.bulk_create(list(chain(
+                        *sewer_measurements_dict.values())))
+
+    # Success -- copy files
+    sewerage.move_files(rib_path, rmb_path)
+
+    # The clap on the fireworks
+    with progress.stage('rib'):
+        finish_sewerage(sewerage)
+
+
+def finish_sewerage(sewerage):
+    """Generate the RIB file of a saved sewerage, and cache the data
+    that is computed from it."""
+    with log_duration("Generating RIB"):
+        sewerage.generate_rib()
+
+    with log_duration("Caching side profile data"):
+        side_profile.build_cache(sewerage.pk)
+
+    with log_duration("Building routing index"):
+        routing.build_index(sewerage.pk)
+
+
+def save_streamed_into_database(
+    rib_path, rmb_path, putdict, sewerdict, rmberrors, progress=None):
+    """Like save_into_database(), for a sewerdict filled by
+    stream_mrio(). Its measurements are already complete tables that
+    only miss their water levels, and they are turned into
+    SewerMeasurements chunk by chunk while saving them."""
+    if progress is None:
+        progress = UploadProgress()
+
+    sewerage = create_sewerage(rmb_path, rmberrors)
+    if sewerage is None:
+        return
+
+    with progress.stage('manholes'), log_duration("Saving manholes"):
+        saved_puts = save_manholes(sewerage, putdict)
+
+    with progress.stage('sewers'), log_duration("Saving sewers"):
+        saved_sewers = save_sewers(sewerage, sewerdict, putdict, saved_puts)
+
+    tables = dict(
+        (sewer_id, sewerinfo['measurements'])
+        for sewer_id, sewerinfo in sewerdict.iteritems())
+
+    with progress.stage('water_levels'):
+        with log_duration("Computing lost capacity"):
+            network = lost_capacity.compute_lost_capacity_of_tables(
+                saved_puts, saved_sewers, tables)
+            add_water_level_breakpoints_to_tables(
+                sewerdict, tables, network)
+
+    with progress.stage('measurements'), log_duration("Saving measurements"):
+        save_measurement_tables(saved_sewers, tables)
+
+    sewerage.move_files(rib_path, rmb_path)
+
+    with progress.stage('rib'):
+        finish_sewerage(sewerage)
+
+
+def save_manholes(sewerage, putdict):
+    """Save the puts as Manholes in one query. Return a dictionary
+    put_id: saved Manhole."""
+    put_ids = list(putdict)
+    models.Manhole.objects.bulk_create([
+            models.Manhole(
+                sewerage=sewerage,
+                code=put_id,
+                sink=int(putdict[put_id]['is_sink']),
+                ground_level=putdict[put_id]['surface_level'],
+                the_geom=Point(*putdict[put_id]['coordinate']))
+            for put_id in put_ids])
+
+    return saved_by_code(models.Manhole, sewerage)
+
+
+def saved_by_code(model, sewerage):
+    """bulk_create doesn't set primary keys, so we fetch the objects
+    back, in one query. Return a dictionary code: object; codes are
+    unique within a sewerage."""
+    return dict(
+        (obj.code, obj) for obj in model.objects.filter(sewerage=sewerage))
+
+
+def rd_lengths(putdict, sewerinfos):
+    """Return an array with the length in meters of each of the
+    sewers, computed from the RD coordinates of their puts."""
+    start = np.array([
+            putdict[sewerinfo['manhole_code_1']]['rd_coordinate']
+            for sewerinfo in sewerinfos], dtype=np.float64).reshape(-1, 2)
+    end = np.array([
+            putdict[sewerinfo['manhole_code_2']]['rd_coordinate']
+            for sewerinfo in sewerinfos], dtype=np.float64).reshape(-1, 2)
+    return np.hypot(end[:, 0] - start[:, 0], end[:, 1] - start[:, 1])
+
+
+def save_sewers(sewerage, sewerdict, putdict, saved_puts):
+    """Save the sewers in one query. Return a dictionary sewer_id:
+    saved Sewer, with its manholes set to the ones in saved_puts."""
+    sewer_ids = list(sewerdict)
+    lengths = rd_lengths(
+        putdict, [sewerdict[sewer_id] for sewer_id in sewer_ids])
+
+    sewers = []
+    for sewer_id, length in zip(sewer_ids, lengths.tolist()):
+        sewerinfo = sewerdict[sewer_id]
         manhole1 = saved_puts[sewerinfo['manhole_code_1']]
         manhole2 = saved_puts[sewerinfo['manhole_code_2']]
-        sewer_line_rd = LineString(manhole1.the_geom, manhole2.the_geom)
-        sewer_line_rd.set_srid(4326)
-        sewer_line_rd.transform(RD)
-
-        saved_sewers[sewer_id] = models.Sewer.objects.create(
-            sewerage=sewerage,
-            code=sewer_id,
-            quality=models.Sewer.QUALITY_UNKNOWN,
-            diameter=sewerinfo['diameter'],
-            manhole1=manhole1,
-            manhole2=manhole2,
-            bob1=sewerinfo['bob_1'],
-            bob2=sewerinfo['bob_2'],
-            the_geom=LineString(manhole1.the_geom, manhole2.the_geom),
-            the_geom_length=sewer_line_rd.length)
-
-    # Save the measurements
+        sewers.append(models.Sewer(
+                sewerage=sewerage,
+                code=sewer_id,
+                quality=sewerinfo.get(
+                    'quality', models.Sewer.QUALITY_UNKNOWN),
+                diameter=sewerinfo['diameter'],
+                manhole1=manhole1,
+                manhole2=manhole2,
+                bob1=sewerinfo['bob_1'],
+                bob2=sewerinfo['bob_2'],
+                the_geom=LineString(manhole1.the_geom, manhole2.the_geom),
+                the_geom_length=length))
+    models.Sewer.objects.bulk_create(sewers)
+
+    manholes_by_pk = dict(
+        (manhole.pk, manhole) for manhole in saved_puts.itervalues())
+
+    saved_sewers = saved_by_code(models.Sewer, sewerage)
+    for sewer in saved_sewers.itervalues():
+        # Prevent a query per sewer later on
+        sewer.manhole1 = manholes_by_pk[sewer.manhole1_id]
+        sewer.manhole2 = manholes_by_pk[sewer.manhole2_id]
+
+    return saved_sewers
+
+
+def save_sewer_qualities(sewers, include_unknown=False):
+    """Save the quality field of the sewers, with one UPDATE query per
+    quality (and per MAX_PKS_PER_QUERY sewers). Sewers that still have
+    the default QUALITY_UNKNOWN are skipped, unless include_unknown is
+    True."""
+    pks_per_quality = defaultdict(list)
+    for sewer in sewers:
+        if (include_unknown or
+            sewer.quality != models.Sewer.QUALITY_UNKNOWN):
+            pks_per_quality[sewer.quality].append(sewer.pk)
+
+    for quality, pks in pks_per_quality.iteritems():
+        for i in range(0, len(pks), MAX_PKS_PER_QUERY):
+            models.Sewer.objects.filter(
+                pk__in=pks[i:i + MAX_PKS_PER_QUERY]).update(quality=quality)
+
+
+def create_measurements(sewerdict, saved_sewers):
+    """Create the (unsaved) SewerMeasurements of all sewers, from the
+    MRIO data if there is any, and virtual ones otherwise. Also judges
+    and saves the quality of the sewers.
+
+    Returns a dictionary sewer_id: list of SewerMeasurements."""
     sewer_measurements_dict = dict()
     for sewer_id, sewerinfo in sewerdict.items():
         measurements = sewerinfo['measurements']
@@ -580,7 +1232,6 @@ def save_into_database(rib_path, rmb_path, putdict, sewerdict, rmberrors):
 
             # Quality
             sewer.judge_quality(sewer_measurements)
-            sewer.save()
 
             # BOB correction ("sawtooth" phenomenon)
             correct_bob_values(sewer, sewer_measurements)
@@ -612,22 +1263,80 @@ def save_into_database(rib_path, rmb_path, putdict, sewerdict, rmberrors):
             sewer_measurements_dict[sewer_id] = list(
                 virtual_measurements(sewer))
             sewer.quality = models.Sewer.QUALITY_UNKNOWN
-            sewer.save()
 
-    # Actually compute the lost capacity, the point of this app
-    lost_capacity.compute_lost_capacity(
-        saved_puts, saved_sewers, sewer_measurements_dict)
+    save_sewer_qualities(saved_sewers.itervalues())
 
-    # Save all the SewerMeasurement objects to the database. Since
-    # there are thousands of them, it is essential to use bulk_create.
-    models.SewerMeasurement.objects.bulk_create(list(chain(
-                *sewer_measurements_dict.values())))
+    return sewer_measurements_dict
 
-    # Success -- copy files
-    sewerage.move_files(rib_path, rmb_path)
 
-    # The clap on the fireworks
-    sewerage.generate_rib()
+def save_measurement_tables(
+    saved_sewers, tables, storage=MEASUREMENT_STORAGE):
+    """Save the measurements in tables (a dictionary sewer_id: array
+    of MEASUREMENT_DTYPE) as set by storage, see MEASUREMENT_STORAGE."""
+    if storage in ('packed', 'both'):
+        save_packed_measurements(saved_sewers, tables)
+    if storage in ('rows', 'both'):
+        save_measurement_rows(saved_sewers, tables)
+
+
+def save_measurement_rows(saved_sewers, tables):
+    """Save the measurements in tables as SewerMeasurements. They are
+    created and inserted MEASUREMENT_CHUNK_SIZE at a time, so that
+    there are never more SewerMeasurement objects than that in
+    memory."""
+    chunk = []
+    for sewer_id, table in tables.iteritems():
+        sewer = saved_sewers[sewer_id]
+        for (dist, bob, obb, x, y, virtual,
+             water_level, flooded_pct) in table.tolist():
+            chunk.append(models.SewerMeasurement(
+                    sewer=sewer,
+                    dist=dist,
+                    virtual=virtual,
+                    water_level=models.none_if_nan(water_level),
+                    flooded_pct=models.none_if_nan(flooded_pct),
+                    bob=bob,
+                    obb=obb,
+                    the_geom=Point(x, y)))
+
+            if len(chunk) >= MEASUREMENT_CHUNK_SIZE:
+                models.SewerMeasurement.objects.bulk_create(chunk)
+                chunk = []
+
+    if chunk:
+        models.SewerMeasurement.objects.bulk_create(chunk)
+
+
+def save_packed_measurements(saved_sewers, tables):
+    """Save the measurements in tables as a PackedMeasurements per
+    sewer, inserted in chunks of about MEASUREMENT_CHUNK_SIZE
+    measurements."""
+    chunk = []
+    chunk_count = 0
+    for sewer_id, table in tables.iteritems():
+        chunk.append(models.PackedMeasurements.from_table(
+                saved_sewers[sewer_id], table))
+        chunk_count += len(table)
+
+        if chunk_count >= MEASUREMENT_CHUNK_SIZE:
+            models.PackedMeasurements.objects.bulk_create(chunk)
+            chunk = []
+            chunk_count = 0
+
+    if chunk:
+        models.PackedMeasurements.objects.bulk_create(chunk)
+
+
+def measurements_as_table(measurements):
+    """Return a list of SewerMeasurements as an array of
+    MEASUREMENT_DTYPE."""
+    table = np.empty(len(measurements), dtype=MEASUREMENT_DTYPE)
+    for i, m in enumerate(measurements):
+        table[i] = (
+            m.dist, m.bob, m.obb, m.the_geom.x, m.the_geom.y, m.virtual,
+            np.nan if m.water_level is None else m.water_level,
+            np.nan if m.flooded_pct is None else m.flooded_pct)
+    return table
 
 
 class Line(object):
@@ -658,22 +1367,35 @@ def correct_bob_values(sewer, measurements):
     be corrected using the known BOB values.
     """
 
-    if len(measurements) < 3:
+    corrections = bob_corrections(
+        sewer.bob1, sewer.bob2, sewer.the_geom_length,
+        [m.dist for m in measurements], [m.bob for m in measurements])
+
+    # Correct bob values
+    for measurement, correction in zip(measurements[1:], corrections[1:]):
+        measurement.bob = measurement.bob + correction
+        measurement.obb = measurement.obb + correction
+
+
+def bob_corrections(bob1, bob2, length, dists, bobs):
+    """Return the correction to add to each of the measured bobs, see
+    correct_bob_values(). The first is always 0."""
+    corrections = [0.0] * len(dists)
+    if len(dists) < 3:
         # Nothing to correct
-        return
+        return corrections
 
-    ideal_line = Line((0, sewer.bob1), (sewer.the_geom_length, sewer.bob2))
+    ideal_line = Line((0, bob1), (length, bob2))
 
-    min_measurement = min(measurements, key=lambda m: m.dist)
-    max_measurement = max(measurements, key=lambda m: m.dist)
+    i_min = min(range(len(dists)), key=lambda i: dists[i])
+    i_max = max(range(len(dists)), key=lambda i: dists[i])
 
-    apparent_line = Line((min_measurement.dist, min_measurement.bob),
-                         (max_measurement.dist, max_measurement.bob))
+    apparent_line = Line((dists[i_min], bobs[i_min]),
+                         (dists[i_max], bobs[i_max]))
 
-    # Correct bob values
-    for measurement in measurements[1:]:
-        ideal_bob = ideal_line.y(measurement.dist)
-        apparent_bob = apparent_line.y(measurement.dist)
-        correction = ideal_bob - apparent_bob
-        measurement.bob = measurement.bob + correction
-        measurement.obb = measurement.obb + correction
+    for i in range(1, len(dists)):
+        ideal_bob = ideal_line.y(dists[i])
+        apparent_bob = apparent_line.y(dists[i])
+        corrections[i] = ideal_bob - apparent_bob
+
+    return corrections
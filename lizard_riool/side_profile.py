@@ -0,0 +1,207 @@
+"""Profile-ready data of a sewerage, for the side profile graph.
+
+Drawing a side profile used to mean loading all sewers of the sewerage,
+building a networkx graph of them and running a query per traversed
+sewer. Instead, everything the graph needs is loaded once per sewerage
+into a SideProfileData, so that a profile request only has to slice
+arrays.
+
+Like the routing index (see routing.py), the data is saved as a .npz
+file in the sewerage's directory when the sewerage has been processed,
+and goes when the sewerage is deleted. Processes load it when it is
+first asked for and keep the most recently used ones; it is reloaded
+if the file changes. Large sewerages don't fit in memcached, so the
+Django cache isn't used for it.
+"""
+
+import hashlib
+import logging
+import os
+
+import numpy as np
+
+from lizard_riool import models
+from lizard_riool.loaded_files import LoadedFiles
+
+logger = logging.getLogger(__name__)
+
+DATA_FILENAME = "side_profile.npz"
+
+# Per process, the SideProfileData of the most recently drawn sewerages
+MAX_LOADED = 10
+_loaded = LoadedFiles(MAX_LOADED)
+
+
+class SideProfileData(object):
+    """The manholes and sewers of a sewerage, with the measurements of
+    each sewer as slices of arrays.
+
+    Attributes:
+    - ground_levels: dictionary manhole code: ground level
+    - sewers: dictionary (manhole code, manhole code): (length, start,
+      stop, reverse). There is an entry for both directions; reverse is
+      True if the sewer runs from the second manhole to the first.
+      start:stop is the sewer's slice of the arrays below.
+    - dist, bob, obb, water: float arrays with the measurements, sorted
+      by sewer and dist. water is the water level, or bob for
+      measurements that aren't connected to a sink.
+    - version: a hash of all of the above, which changes if anything
+      that is drawn changes
+    """
+
+    def __init__(self, ground_levels, sewers, dist, bob, obb, water):
+        self.ground_levels = ground_levels
+        self.sewers = sewers
+        self.dist = dist
+        self.bob = bob
+        self.obb = obb
+        self.water = water
+
+        version = hashlib.sha1()
+        version.update(repr(sorted(ground_levels.items())))
+        version.update(repr(sorted(sewers.items())))
+        for array in (dist, bob, obb, water):
+            version.update(array.tostring())
+        self.version = version.hexdigest()
+
+    @classmethod
+    def from_database(cls, sewerage_pk):
+        "Load the data of a sewerage, in four queries."
+        ground_levels = dict(
+            models.Manhole.objects.filter(
+                sewerage__pk=sewerage_pk).values_list('code', 'ground_level'))
+
+        rows = list(models.measurement_values(
+                sewerage_pk, 'sewer__id', 'dist', 'bob', 'obb',
+                'water_level'))
+
+        columns = zip(*rows) if rows else [()] * 5
+        sewer_ids = np.array(columns[0], dtype=np.int64)
+        dist, bob, obb, water_level = [
+            np.array(column, dtype=np.float64)  # None becomes NaN
+            for column in columns[1:]]
+        # Sewers that are not connected to a sink, either directly or
+        # indirectly, have a water_level of None; draw them empty.
+        water = np.where(np.isnan(water_level), bob, water_level)
+
+        sewers = dict()
+        for sewer_id, code1, code2, length in models.Sewer.objects.filter(
+            sewerage__pk=sewerage_pk).order_by('id').values_list(
+            'id', 'manhole1__code', 'manhole2__code', 'the_geom_length'):
+            start = int(np.searchsorted(sewer_ids, sewer_id, 'left'))
+            stop = int(np.searchsorted(sewer_ids, sewer_id, 'right'))
+            # Like the edges of a networkx graph, later sewers between
+            # the same manholes replace earlier ones.
+            sewers[(code1, code2)] = (length, start, stop, False)
+            sewers[(code2, code1)] = (length, start, stop, True)
+
+        return cls(ground_levels, sewers, dist, bob, obb, water)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            ground_levels = dict(zip(
+                    data['manhole_codes'].tolist(),
+                    none_if_nan(data['ground_levels'])))
+            sewers = dict(
+                ((code1, code2), (length, start, stop, reverse))
+                for code1, code2, length, start, stop, reverse in zip(
+                    data['codes1'].tolist(), data['codes2'].tolist(),
+                    none_if_nan(data['lengths']), data['starts'].tolist(),
+                    data['stops'].tolist(), data['reverse'].tolist()))
+            return cls(ground_levels, sewers, data['dist'], data['bob'],
+                       data['obb'], data['water'])
+
+    def save(self, path):
+        # Write to a temporary file first, processes may be loading it
+        keys = list(self.sewers)
+        values = [self.sewers[key] for key in keys]
+        temp_path = path + ".tmp"
+        with open(temp_path, 'wb') as f:
+            np.savez(
+                f,
+                manhole_codes=np.array(
+                    list(self.ground_levels), dtype=np.unicode_),
+                ground_levels=np.array(
+                    self.ground_levels.values(), dtype=np.float64),
+                codes1=np.array(
+                    [code1 for code1, _ in keys], dtype=np.unicode_),
+                codes2=np.array(
+                    [code2 for _, code2 in keys], dtype=np.unicode_),
+                lengths=np.array(
+                    [value[0] for value in values], dtype=np.float64),
+                starts=np.array(
+                    [value[1] for value in values], dtype=np.int64),
+                stops=np.array(
+                    [value[2] for value in values], dtype=np.int64),
+                reverse=np.array(
+                    [value[3] for value in values], dtype=np.bool_),
+                dist=self.dist, bob=self.bob, obb=self.obb,
+                water=self.water)
+        os.rename(temp_path, path)
+
+    def length(self, code1, code2):
+        "Length of the sewer between these manholes."
+        return self.sewers[(code1, code2)][0]
+
+    def measurements(self, code1, code2):
+        """Return (dist, bob, obb, water, reverse) of the sewer between
+        these manholes, sorted by dist. reverse is True if dist is
+        measured from code2."""
+        length, start, stop, reverse = self.sewers[(code1, code2)]
+        return (self.dist[start:stop], self.bob[start:stop],
+                self.obb[start:stop], self.water[start:stop], reverse)
+
+
+def none_if_nan(array):
+    "List of the values of a float array, with None for NaN."
+    return [None if value != value else value for value in array.tolist()]
+
+
+def data_path(sewerage_pk):
+    return os.path.join(
+        models.Sewerage.BASE_PATH, str(sewerage_pk), DATA_FILENAME)
+
+
+def get_side_profile_data(sewerage_pk):
+    """Return the SideProfileData of a sewerage. It is loaded from its
+    file the first time in this process, or when the file has changed.
+    If there is no file (sewerages saved before there were these
+    files), it is built once."""
+    path = data_path(sewerage_pk)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        if os.path.isdir(os.path.dirname(path)):
+            data = build_cache(sewerage_pk)
+            mtime = os.path.getmtime(path)
+        else:
+            # Probably deleted; don't keep this around
+            _loaded.discard(sewerage_pk)
+            return SideProfileData.from_database(sewerage_pk)
+    else:
+        data = _loaded.get(sewerage_pk, mtime)
+        if data is not None:
+            return data
+        data = SideProfileData.load(path)
+
+    _loaded.put(sewerage_pk, mtime, data)
+    return data
+
+
+def data_version(sewerage_pk):
+    "Return the version of the SideProfileData of a sewerage."
+    return get_side_profile_data(sewerage_pk).version
+
+
+def build_cache(sewerage_pk):
+    """Load the SideProfileData of a sewerage from the database and save
+    it in the sewerage's directory, which must exist."""
+    data = SideProfileData.from_database(sewerage_pk)
+    data.save(data_path(sewerage_pk))
+    return data
+
+
+def invalidate_cache(sewerage_pk):
+    "Forget the data of a sewerage whose directory is deleted."
+    _loaded.discard(sewerage_pk)
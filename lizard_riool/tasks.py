@@ -1,14 +1,18 @@
+from contextlib import contextmanager
+import hashlib
 import logging
 import os
-import time
 import traceback
+import uuid
 
 from celery.task import task
 
+from django.core.cache import cache
 from django.db import transaction
 
 from lizard_riool import models
 from lizard_riool import save_uploaded_data
+from lizard_riool import update
 
 logger = logging.getLogger(__name__)
 
@@ -19,7 +23,14 @@ logger = logging.getLogger(__name__)
 # http://docs.celeryproject.org/en/latest/cookbook/tasks.html# \
 # ensuring-a-task-is-only-executed-one-at-a-time
 
-LOCK_KEY = "lizard_riool_computing_all_lost_capacity_percentages"
+# There is a lock per sewerage name, so that uploads of different
+# sewerages are processed at the same time by different workers, while
+# a second upload with a name that is being processed fails right away.
+# That is only a fast path: it needs a cache that the workers share
+# (memcached, not the local memory cache), and locks expire. That no
+# two sewerages get the same name is guaranteed by the database, where
+# Sewerage.name is unique (see save_uploaded_data.create_sewerage()).
+LOCK_KEY = "lizard_riool_processing_sewerage_{name_hash}"
 DURATION = 60 * 60  # If something happens, we want computing to be
                     # possible again after 60 minutes. In testing, the
                     # computation only takes around 10 minutes.
@@ -27,52 +38,121 @@ DURATION = 60 * 60  # If something happens, we want computing to be
 MAX_RETRIES = 5
 
 
+def lock_key(sewerage_name):
+    """Return the cache key of the lock of a sewerage name. Names are
+    compared case insensitively, like uploaded filenames, and hashed
+    because memcached keys can't contain spaces."""
+    sewerage_name = sewerage_name.lower()
+    if isinstance(sewerage_name, unicode):
+        sewerage_name = sewerage_name.encode('utf-8')
+    return LOCK_KEY.format(
+        name_hash=hashlib.md5(sewerage_name).hexdigest())
+
+
+@contextmanager
+def sewerage_name_lock(sewerage_name):
+    """Try to lock a sewerage name; the with-block gets True if this
+    process holds the lock, False if someone else does. cache.add() is
+    atomic, so only one process can get it.
+
+    The lock holds a random token, and is only deleted if it still
+    holds that one: if it expired meanwhile, another process may hold
+    it now."""
+    key = lock_key(sewerage_name)
+    token = uuid.uuid4().hex
+    acquired = cache.add(key, token, DURATION)
+    try:
+        yield acquired
+    finally:
+        if acquired and cache.get(key) == token:
+            cache.delete(key)
+
+
 @task
 def process_uploaded_file_when_ready(upload_id, retries=MAX_RETRIES):
+    """Process the upload with this id once its row and its file are
+    there; the transaction that saves them may not have been committed
+    yet. Checks again a second later, without blocking this worker in
+    the meantime."""
     if retries <= 0:
         return  # Forget it
     try:
         upload = models.Upload.objects.get(pk=upload_id)
     except models.Upload.DoesNotExist:
-        time.sleep(1)  # Wait one second, then try again
-        process_uploaded_file_when_ready.delay(upload_id, retries - 1)
-        return
+        upload = None
 
-    if not os.path.exists(upload.full_path):
-        time.sleep(1)  # Wait one second, then try again
-        process_uploaded_file_when_ready.delay(upload_id, retries - 1)
+    if upload is None or not os.path.exists(upload.full_path):
+        process_uploaded_file_when_ready.apply_async(
+            args=(upload_id, retries - 1), countdown=1)
         return
 
-    process_uploaded_file.delay(upload)
+    process_uploaded_file(upload)
 
 
 @task
 def process_uploaded_file(upload):
-    # If it's an RIB, ignore it, otherwise it's an RMB -- find its RIB.
-    if upload.suffix.lower() != ".rmb":
-        if upload.suffix.lower() != ".rib":
+    """Process an uploaded RIB or RMB file as soon as its other half is
+    there too. Whichever of the two comes last starts the processing;
+    the first one waits with status "not processed yet". An RMB that
+    was uploaded as an update has no other half; it updates the
+    existing sewerage with its name."""
+    if upload.suffix.lower() not in (".rib", ".rmb"):
+        upload.record_error(
+            "Alleen .RIB en .RMB bestanden kunnen verwerkt worden")
+        upload.set_unsuccessful()
+        return
+
+    if upload.is_update:
+        # An RMB for an existing sewerage, see update.py
+        if upload.suffix.lower() != ".rmb":
             upload.record_error(
-                "Alleen .RIB en .RMB bestanden kunnen verwerkt worden")
+                "Alleen een .RMB bestand kan een stelsel bijwerken.")
             upload.set_unsuccessful()
-            return
-        else:
-            # Just let it wait for the .RMB
-            return
+        elif upload.claim():
+            process_rmb_update(
+                upload, os.path.basename(upload.the_file)[:-4])
+        return
 
-    # Set "being processed" status
-    upload.set_being_processed()
+    if upload.suffix.lower() == ".rib":
+        # Process the RMB that waits for this RIB, if there is one
+        upload = upload.find_relevant_rmb()
+        if upload is None:
+            return  # Let it wait for the .RMB
+
+    sewerage_name = os.path.basename(upload.the_file)[:-4]  # Minus ".RMB"
 
     rib = upload.find_relevant_rib()
+    if rib is None:
+        return  # Let it wait for the .RIB
 
-    if not rib:
+    # Set "being processed" status. If another worker was first, leave
+    # them to it.
+    if not upload.claim():
+        return
+
+    if not rib.claim():
+        # Taken by another RMB with the same name
         upload.record_error("Bijbehorende RIB file niet gevonden.")
         upload.set_unsuccessful()
         return
 
-    rib.set_being_processed()
+    # The lock is a fast path; the unique Sewerage.name reserves the
+    # name, see create_sewerage()
+    with sewerage_name_lock(sewerage_name) as locked:
+        if not locked:
+            upload.record_error(
+                ("Er wordt al een bestand met de naam '{name}' verwerkt. "
+                 ).format(name=upload.filename))
+            upload.set_unsuccessful()
+            rib.set_unsuccessful()
+            return
+
+        process_locked_upload(upload, rib, sewerage_name)
 
-    sewerage_name = os.path.basename(upload.the_file)[:-4]  # Minus ".RMB"
 
+def process_locked_upload(upload, rib, sewerage_name):
+    """Process an RMB upload and its RIB, with the lock of
+    sewerage_name held."""
     if models.Sewerage.objects.filter(name=sewerage_name).exists():
         upload.record_error(
             ("Er bestaat al een stelsel met de naam '{name}'. "
@@ -82,29 +162,56 @@ def process_uploaded_file(upload):
         rib.set_unsuccessful()
         return
 
-    for other_upload in models.Upload.objects.filter(
-        status=models.Upload.BEING_PROCESSED):
-        if other_upload == upload or other_upload == rib:
-            continue
-        if other_upload.filename.lower() == upload.filename.lower():
+    try:
+        with transaction.commit_on_success():
+            # All the actual processing
+            save_uploaded_data.protected_file_processing(rib, upload)
+
+    except Exception as e:
+        record_exception(e, [upload, rib])
+
+
+def process_rmb_update(upload, sewerage_name):
+    """Update the existing sewerage named sewerage_name with an RMB
+    upload, see update.update_rmb()."""
+    with sewerage_name_lock(sewerage_name) as locked:
+        if not locked:
             upload.record_error(
                 ("Er wordt al een bestand met de naam '{name}' verwerkt. "
                  ).format(name=upload.filename))
             upload.set_unsuccessful()
-            rib.set_unsuccessful()
             return
 
-    try:
-        with transaction.commit_on_success():
-            # All the actual processing
-            save_uploaded_data.protected_file_processing(rib, upload)
+        if not models.Sewerage.objects.filter(name=sewerage_name).exists():
+            upload.record_error(
+                ("Er bestaat geen stelsel met de naam '{name}' om bij "
+                 "te werken.").format(name=sewerage_name))
+            upload.set_unsuccessful()
+            return
 
-    except Exception as e:
-        # Record whatever happened
-        error_message = (
-            "Exception: {e} {t}"
-            .format(e=e, t=traceback.format_exc()[-250:]))
+        try:
+            with transaction.commit_on_success():
+                # Updates of the same sewerage wait for each other
+                sewerage = models.Sewerage.objects.select_for_update().get(
+                    name=sewerage_name)
+                updated = update.protected_rmb_update(sewerage, upload)
+
+            # Only now that the database is committed, replace the files
+            if updated:
+                update.finish_rmb_update(sewerage, upload.full_path)
+                upload.set_successful()
+
+        except Exception as e:
+            record_exception(e, [upload])
+
+
+def record_exception(e, uploads):
+    """Record whatever happened as an error of the uploads, and set
+    them unsuccessful. Call from an except block."""
+    error_message = (
+        "Exception: {e} {t}"
+        .format(e=e, t=traceback.format_exc()[-250:]))
+    for upload in uploads:
         upload.record_error(error_message)
-        rib.record_error(error_message)
+    for upload in uploads:
         upload.set_unsuccessful()
-        rib.set_unsuccessful()
@@ -1,9 +1,974 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
 
+from collections import defaultdict
+import glob
+import hashlib
+import math
+import os
+import random
+import shutil
+import tempfile
+
+from django.core.cache import cache
 from django.test import TestCase
 
+import networkx as nx
+import numpy as np
+
+from sufriblib import util
+from sufriblib.errors import Error
+from sufriblib.parsers import enumerate_file
+
+from lizard_riool import chunked_upload
+from lizard_riool import coordinates
+from lizard_riool import line_index
+from lizard_riool import loaded_files
+from lizard_riool import lost_capacity
+from lizard_riool import models
+from lizard_riool import mrio
+from lizard_riool import routing
+from lizard_riool import save_uploaded_data
+from lizard_riool import side_profile
+from lizard_riool import tasks
+from lizard_riool import update
+from lizard_riool.network import csr_adjacency_with_edges
+
+
+class Fake(object):
+    """Stand-in for model instances in tests that don't need the
+    database."""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def fake_sewerage(rnd):
+    """Return random saved_puts, saved_sewers and measurements_dict
+    like save_uploaded_data passes to lost_capacity."""
+    puts = dict(
+        (code, Fake(code=code, is_sink=False))
+        for code in ('P{0}'.format(i) for i in range(rnd.randint(2, 12))))
+    puts[rnd.choice(sorted(puts))].is_sink = True
+
+    sewers = dict()
+    measurements = dict()
+    for i in range(rnd.randint(1, 15)):
+        sewer_id = 'S{0}'.format(i)
+        sewers[sewer_id] = Fake(
+            manhole1=puts[rnd.choice(sorted(puts))],
+            manhole2=puts[rnd.choice(sorted(puts))],
+            bob1=rnd.randint(0, 5) * 0.5, bob2=rnd.randint(0, 5) * 0.5)
+        measurements[sewer_id] = [
+            Fake(dist=rnd.choice([0.0, 0.3, 0.6, 1.0, rnd.random()]),
+                 bob=rnd.randint(-2, 6) * 0.5)
+            for _ in range(rnd.randint(0, 6))]
+    return puts, sewers, measurements
+
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(__file__), 'data')
+
+# RIB and RMB files in DATA_DIRECTORY that belong together
+DATA_PAIRS = (
+    ('224-4_DWA.rib', '224-4_DWA.RMB'),
+    ('232-2_DWA.RIB', '232-2_DWA.RMB'),
+    ('4F1 asfalt werk.rib', '4F1 asfalt werk.RMB'),
+    ('Filmwijk nabij 231-0.rib', 'Filmwijk nabij 231-0.RMB'),
+    )
+
+
+class SewerageTestCase(TestCase):
+    """Saves sewerages from copies of files in DATA_DIRECTORY, with
+    Sewerage.BASE_PATH in a temporary directory."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.base_path = models.Sewerage.BASE_PATH
+        models.Sewerage.BASE_PATH = os.path.join(self.directory, 'sewerages')
+
+    def tearDown(self):
+        models.Sewerage.BASE_PATH = self.base_path
+        shutil.rmtree(self.directory)
+
+    def copy(self, filename):
+        """Copy a data file (or the file at an absolute path) into a
+        directory of its own, like an upload. Return the path of the
+        copy."""
+        directory = tempfile.mkdtemp(dir=self.directory)
+        shutil.copy(os.path.join(DATA_DIRECTORY, filename), directory)
+        return os.path.join(directory, os.path.basename(filename))
+
+    def save(self, rib, rmb, stream=False):
+        """Save a sewerage from copies of the data files rib and rmb,
+        like protected_file_processing() does. Return it, or None if
+        the files have errors."""
+        rib_path, rmb_path = self.copy(rib), self.copy(rmb)
+        putdict, sewerdict, riberrors, rmberrors = (
+            save_uploaded_data.parse_files(rib_path, rmb_path, stream))
+        if not putdict or not sewerdict or riberrors or rmberrors:
+            return None
+
+        if stream:
+            save_uploaded_data.save_streamed_into_database(
+                rib_path, rmb_path, putdict, sewerdict, rmberrors)
+        else:
+            save_uploaded_data.save_into_database(
+                rib_path, rmb_path, putdict, sewerdict, rmberrors)
+        self.assertEqual(rmberrors, [])
+        return models.Sewerage.objects.get(
+            name=os.path.basename(rmb_path)[:-4])
+
+    def save_any(self):
+        """Save the first of DATA_PAIRS whose files have no errors.
+        Return (sewerage, (rib, rmb))."""
+        for rib, rmb in DATA_PAIRS:
+            sewerage = self.save(rib, rmb)
+            if sewerage is not None:
+                return sewerage, (rib, rmb)
+        self.fail("All of DATA_PAIRS have errors.")
+
+    def stored(self, sewerage):
+        """Return a dictionary sewer code: (quality, measurement table)
+        of a saved sewerage."""
+        sewers = dict(
+            (sewer.code, sewer) for sewer in
+            models.Sewer.objects.filter(sewerage=sewerage).select_related(
+                'manhole1', 'manhole2'))
+        tables = models.measurement_tables(sewerage.pk, sewers)
+        return dict(
+            (code, (sewer.quality, tables[code]))
+            for code, sewer in sewers.iteritems())
+
+    def assertSameStored(self, stored1, stored2):
+        self.assertEqual(sorted(stored1), sorted(stored2))
+        for code in stored1:
+            (quality1, table1), (quality2, table2) = (
+                stored1[code], stored2[code])
+            self.assertEqual(quality1, quality2, code)
+            self.assertEqual(len(table1), len(table2), code)
+            self.assertTrue(
+                (table1['virtual'] == table2['virtual']).all(), code)
+            for field in ('dist', 'bob', 'obb', 'x', 'y',
+                          'water_level', 'flooded_pct'):
+                self.assertTrue(np.allclose(
+                        table1[field], table2[field], equal_nan=True),
+                                (code, field))
+
+
+def graph_from_bobs(bobs, edges):
+    """Return a networkx graph with nodes 0..len(bobs)-1."""
+    G = nx.Graph()
+    for node, bob in enumerate(bobs):
+        G.add_node(node, bob=bob, waterlevel=None)
+    G.add_edges_from(edges)
+    return G
+
 
 class ExampleTest(TestCase):
 
     def test_something(self):
         self.assertEqual(1, 1)
+
+
+class TestComputeWaterLevel(TestCase):
+
+    def test_water_behind_a_peak_fills_up_to_the_peak(self):
+        # sink - dip - peak - dip - rising end
+        G = graph_from_bobs(
+            [0.0, -1.0, 2.0, 1.0, 3.0],
+            [(0, 1), (1, 2), (2, 3), (3, 4)])
+        lost_capacity.compute_water_level(G, 0)
+        self.assertEqual(
+            [G.node[node]['waterlevel'] for node in range(5)],
+            [0.0, 0.0, 2.0, 2.0, 3.0])
+
+    def test_unconnected_nodes_stay_none(self):
+        G = graph_from_bobs([0.0, 1.0, 0.5], [(0, 1)])
+        lost_capacity.compute_water_level(G, 0)
+        self.assertEqual(G.node[2]['waterlevel'], None)
+
+    def test_same_result_as_reference(self):
+        rnd = random.Random(0)
+        for _ in range(200):
+            n = rnd.randint(1, 40)
+            bobs = [rnd.randint(0, 5) for _ in range(n)]
+            edges = [(i, rnd.randrange(i)) for i in range(1, n)]
+            edges += [(rnd.randrange(n), rnd.randrange(n))
+                      for _ in range(n // 4)]
+            G = graph_from_bobs(bobs, edges)
+            self.assertEqual(
+                lost_capacity.compare_water_levels(G, rnd.randrange(n)),
+                [])
+
+
+class TestSewerNetwork(TestCase):
+
+    def test_same_graph_and_water_levels_as_networkx(self):
+        rnd = random.Random(0)
+        for _ in range(100):
+            puts, sewers, measurements = fake_sewerage(rnd)
+            G, sink_node = lost_capacity.create_graph(
+                puts, sewers, measurements)
+            if sink_node not in G:
+                continue  # Unconnected sink
+            lost_capacity.compute_water_level(G, sink_node)
+
+            network = lost_capacity.create_network(
+                puts, sewers, measurements)
+            network.compute_water_level()
+            G2, sink_node2 = network.to_networkx()
+
+            self.assertEqual(sink_node, sink_node2)
+            self.assertEqual(sorted(G.nodes()), sorted(G2.nodes()))
+            self.assertEqual(
+                set(frozenset(edge) for edge in G.edges()
+                    if edge[0] != edge[1]),
+                set(frozenset(edge) for edge in G2.edges()))
+            for node in G:
+                self.assertEqual(G.node[node], G2.node[node])
+
+    def test_measurement_waterlevels_in_given_order(self):
+        rnd = random.Random(1)
+        puts, sewers, measurements = fake_sewerage(rnd)
+        network = lost_capacity.create_network(puts, sewers, measurements)
+        network.compute_water_level()
+        G, _ = network.to_networkx()
+
+        for sewer_id, sewer_measurements in measurements.items():
+            self.assertEqual(
+                network.measurement_waterlevels(sewer_id),
+                [G.node[("measurement", sewer_id, m.dist)]['waterlevel']
+                 for m in sewer_measurements])
+
+    def test_updated_water_levels_same_as_from_scratch(self):
+        rnd = random.Random(2)
+        for _ in range(200):
+            puts, sewers, measurements = fake_sewerage(rnd)
+            previous = lost_capacity.create_network(
+                puts, sewers, measurements)
+            previous.compute_water_level()
+
+            for sewer in rnd.sample(
+                sewers.values(), rnd.randint(0, min(2, len(sewers)))):
+                sewer.bob1 = rnd.randint(-2, 6) * 0.5
+                sewer.bob2 = rnd.randint(-2, 6) * 0.5
+            for put in rnd.sample(puts.values(), rnd.randint(0, 2)):
+                put.is_sink = not put.is_sink
+
+            network = lost_capacity.create_network(
+                puts, sewers, measurements)
+            changed = network.update_water_level(previous)
+            expected = lost_capacity.create_network(
+                puts, sewers, measurements)
+            expected.compute_water_level()
+
+            np.testing.assert_array_equal(
+                network.waterlevel, expected.waterlevel)
+            unchanged = (previous.waterlevel == expected.waterlevel) | (
+                np.isnan(previous.waterlevel) & np.isnan(expected.waterlevel))
+            np.testing.assert_array_equal(changed, ~unchanged)
+
+
+class TestFloodedFractions(TestCase):
+
+    def test_same_as_compute_flooded_pct(self):
+        rnd = random.Random(0)
+        water_levels, bobs, obbs, shapes, expected = [], [], [], [], []
+        for _ in range(1000):
+            bob = rnd.uniform(-5, 5)
+            obb = bob + rnd.choice([0.0, 0.5, rnd.random()])
+            water_level = rnd.choice([
+                    None, bob, obb, (bob + obb) / 2,
+                    rnd.uniform(bob - 1, obb + 1)])
+            shape = rnd.choice(
+                [models.Sewer.SHAPE_CIRCLE, models.Sewer.SHAPE_RECTANGULAR])
+
+            measurement = models.SewerMeasurement(bob=bob, obb=obb)
+            measurement.set_water_level(water_level)
+            measurement.compute_flooded_pct(
+                use_sewer=models.Sewer(shape=shape))
+
+            water_levels.append(water_level)
+            bobs.append(bob)
+            obbs.append(obb)
+            shapes.append(shape)
+            expected.append(
+                (measurement.water_level, measurement.flooded_pct))
+
+        clamped = models.clamp_water_levels(water_levels, bobs, obbs)
+        fractions = models.flooded_fractions(clamped, bobs, obbs, shapes)
+
+        for (water_level, flooded_pct), clamped_level, fraction in zip(
+            expected, clamped, fractions):
+            if water_level is None:
+                self.assertTrue(np.isnan(clamped_level))
+                self.assertTrue(np.isnan(fraction))
+            else:
+                self.assertEqual(water_level, clamped_level)
+                self.assertAlmostEqual(flooded_pct, fraction)
+
+
+class TestSideProfileData(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_same_after_saving_and_loading(self):
+        data = side_profile.SideProfileData(
+            {u'P1': 1.5, u'P2': None, u'P3': -0.25},
+            {(u'P1', u'P2'): (10.0, 0, 2, False),
+             (u'P2', u'P1'): (10.0, 0, 2, True),
+             (u'P2', u'P3'): (None, 2, 3, False),
+             (u'P3', u'P2'): (None, 2, 3, True)},
+            np.array([0.0, 10.0, 0.0]), np.array([-1.0, -1.2, -1.3]),
+            np.array([-0.7, -0.9, -1.0]), np.array([-1.0, -1.1, np.nan]))
+        path = os.path.join(self.directory, side_profile.DATA_FILENAME)
+        data.save(path)
+
+        loaded = side_profile.SideProfileData.load(path)
+        self.assertEqual(loaded.version, data.version)
+        self.assertEqual(loaded.ground_levels, data.ground_levels)
+        self.assertEqual(loaded.sewers, data.sewers)
+        for field in ('dist', 'bob', 'obb', 'water'):
+            self.assertTrue(np.allclose(
+                    getattr(loaded, field), getattr(data, field),
+                    equal_nan=True), field)
+
+
+class TestLoadedFiles(TestCase):
+
+    def test_least_recently_used_is_dropped(self):
+        loaded = loaded_files.LoadedFiles(2)
+        loaded.put(1, 100.0, 'one')
+        loaded.put(2, 100.0, 'two')
+        self.assertEqual(loaded.get(1, 100.0), 'one')
+        loaded.put(3, 100.0, 'three')
+        self.assertEqual(len(loaded), 2)
+        self.assertEqual(loaded.get(2, 100.0), None)
+        self.assertEqual(loaded.get(1, 100.0), 'one')
+        self.assertEqual(loaded.get(3, 100.0), 'three')
+
+    def test_changed_file_is_loaded_again(self):
+        loaded = loaded_files.LoadedFiles(2)
+        loaded.put(1, 100.0, 'one')
+        self.assertEqual(loaded.get(1, 101.0), None)
+        self.assertEqual(len(loaded), 0)
+
+
+class TestRoutingIndex(TestCase):
+
+    def test_saved_and_loaded_without_leaving_files_open(self):
+        directory = tempfile.mkdtemp()
+        try:
+            indptr, indices, edge_ids = csr_adjacency_with_edges(
+                3, [0, 1], [1, 2])
+            index = routing.RoutingIndex(
+                [u'P0', u'P1', u'P2'], np.zeros(3), np.ones(3), indptr,
+                indices, edge_ids, [u'S0', u'S1'], np.array([1.0, 2.0]))
+            path = os.path.join(directory, routing.INDEX_FILENAME)
+            index.save(path)
+
+            open_files = len(os.listdir('/proc/self/fd'))
+            for _ in range(5):
+                loaded = routing.RoutingIndex.load(path)
+            self.assertEqual(len(os.listdir('/proc/self/fd')), open_files)
+            self.assertEqual(
+                loaded.shortest_path(u'P0', u'P2'),
+                ([u'P0', u'P1', u'P2'], [u'S0', u'S1']))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_same_path_lengths_as_networkx(self):
+        rnd = random.Random(0)
+        for _ in range(100):
+            n = rnd.randint(1, 30)
+            codes = ['P{0}'.format(i) for i in range(n)]
+            edges = [(rnd.randrange(n), rnd.randrange(n))
+                     for _ in range(rnd.randint(0, 2 * n))]
+            lengths = [rnd.choice([1.0, 2.5, 10.0]) for _ in edges]
+
+            indptr, indices, edge_ids = csr_adjacency_with_edges(
+                n, [a for a, b in edges], [b for a, b in edges])
+            index = routing.RoutingIndex(
+                codes, np.zeros(n), np.zeros(n), indptr, indices, edge_ids,
+                ['S{0}'.format(i) for i in range(len(edges))],
+                np.array(lengths))
+
+            G = nx.Graph()
+            G.add_nodes_from(codes)
+            for (a, b), length in zip(edges, lengths):
+                if (a != b and (not G.has_edge(codes[a], codes[b]) or
+                                G[codes[a]][codes[b]]['length'] > length)):
+                    G.add_edge(codes[a], codes[b], length=length)
+
+            source, target = rnd.choice(codes), rnd.choice(codes)
+            if not nx.has_path(G, source, target):
+                self.assertRaises(
+                    ValueError, index.shortest_path, source, target)
+                continue
+
+            path, sewers = index.shortest_path(source, target)
+            self.assertEqual(
+                len(sewers), nx.shortest_path_length(G, source, target))
+
+            path, sewers = index.shortest_path(source, target, weighted=True)
+            self.assertEqual((path[0], path[-1]), (source, target))
+            for i, sewer in enumerate(sewers):
+                a, b = edges[int(sewer[1:])]
+                self.assertEqual(
+                    set([codes[a], codes[b]]), set(path[i:i + 2]))
+            self.assertAlmostEqual(
+                sum(lengths[int(sewer[1:])] for sewer in sewers),
+                nx.dijkstra_path_length(G, source, target, 'length'))
+
+
+# Meters that coordinates.rd_to_wgs84() may differ from sufriblib's
+# util.rd_to_wgs84(), which processing used before
+MAX_WGS84_DIFFERENCE = 1.0
+
+
+def wgs84_distance(point1, point2):
+    "Approximate distance in meters between two nearby WGS84 points."
+    (x1, y1), (x2, y2) = point1, point2
+    return 6371000 * math.radians(math.hypot(
+            (x2 - x1) * math.cos(math.radians((y1 + y2) / 2)), y2 - y1))
+
+
+class TestSetGeomsDists(TestCase):
+
+    def test_same_as_reference_on_f3478_files(self):
+        rd1, rd2 = (138700.0, 485000.0), (138704.0, 485003.0)
+        bob1, bob2 = -1.0, -1.2
+
+        paths = glob.glob(os.path.join(
+                os.path.dirname(__file__), 'data', 'f3478*.rmb'))
+        self.assertTrue(paths)
+
+        for path in paths:
+            for sewer_id, lines in mrio.mrio_blocks(path, []):
+                zyrzys = lines[0].ZYR + lines[0].ZYS
+                if zyrzys not in ("AE", "AF", "CB"):
+                    continue
+                reverse = lines[0].ZYB == "2"
+
+                results = []
+                for function in (save_uploaded_data.set_geoms_dists,
+                                 save_uploaded_data.set_geoms_dists_reference):
+                    mrios = sorted(
+                        ({'distance': line.distance,
+                          'measurement': line.measurement}
+                         for line in lines), key=lambda m: m['distance'])
+                    if reverse:
+                        function(mrios, rd2, rd1, bob2, bob1, zyrzys, True)
+                    else:
+                        function(mrios, rd1, rd2, bob1, bob2, zyrzys, False)
+                    results.append(mrios)
+
+                for vectorized, reference in zip(*results):
+                    for key in ('dist', 'bob'):
+                        self.assertAlmostEqual(vectorized[key], reference[key])
+                    for a, b in zip(vectorized['rd_coordinate'],
+                                    reference['rd_coordinate']):
+                        self.assertAlmostEqual(a, b)
+                    # The reference converts to WGS84 with sufriblib's
+                    # approximation, set_geoms_dists() with pyproj
+                    self.assertTrue(wgs84_distance(
+                            vectorized['coordinate'],
+                            reference['coordinate']) < MAX_WGS84_DIFFERENCE)
+
+
+class TestCoordinates(TestCase):
+
+    def test_rd_to_wgs84_and_back(self):
+        # Onze Lieve Vrouwetoren, Amersfoort
+        xs, ys = coordinates.rd_to_wgs84([155000.0, 138700.0],
+                                         [463000.0, 485000.0])
+        self.assertAlmostEqual(xs[0], 5.3872, places=3)
+        self.assertAlmostEqual(ys[0], 52.1552, places=3)
+
+        xs, ys = coordinates.transform(
+            xs, ys, coordinates.WGS84_SRID, coordinates.RD_SRID)
+        self.assertAlmostEqual(xs[1], 138700.0, places=3)
+        self.assertAlmostEqual(ys[1], 485000.0, places=3)
+
+    def test_close_to_sufriblib(self):
+        # All over the Netherlands
+        rd_xs, rd_ys = np.meshgrid(
+            np.linspace(13000, 278000, 12), np.linspace(306000, 619000, 12))
+        xs, ys = coordinates.rd_to_wgs84(rd_xs.ravel(), rd_ys.ravel())
+        for rd_x, rd_y, x, y in zip(
+            rd_xs.ravel().tolist(), rd_ys.ravel().tolist(),
+            xs.tolist(), ys.tolist()):
+            self.assertTrue(wgs84_distance(
+                    (x, y), util.rd_to_wgs84(rd_x, rd_y)) <
+                            MAX_WGS84_DIFFERENCE, (rd_x, rd_y))
+
+
+class TestPackedMeasurements(TestCase):
+
+    def test_table_round_trip(self):
+        table = np.empty(4, dtype=models.MEASUREMENT_DTYPE)
+        table['dist'] = [0.0, 3.0, 1.5, 4.0]
+        table['bob'] = [1.0, 2.0, 3.0, 4.0]
+        table['obb'] = table['bob'] + 0.5
+        table['x'] = 5.0 + table['dist'] / 4
+        table['y'] = 52.0 - table['dist'] / 4
+        table['virtual'] = [True, False, False, True]
+        table['water_level'] = [np.nan, 1.0, 2.0, 3.0]
+        table['flooded_pct'] = [np.nan, 0.1, 0.2, 1.0]
+
+        sewer = Fake(
+            the_geom=Fake(coords=((5.0, 52.0), (6.0, 51.0))),
+            the_geom_length=4.0)
+        packed = models.PackedMeasurements.from_table(sewer, table)
+        self.assertEqual(packed.count, 4)
+
+        # Sorted by dist, with points along the sewer
+        self.assertEqual(
+            repr(packed.table(sewer).tolist()),
+            repr(table[[0, 2, 1, 3]].tolist()))
+
+        measurements = packed.measurements(sewer)
+        self.assertEqual(measurements[0].water_level, None)
+        self.assertEqual(measurements[1].flooded_pct, 0.2)
+
+
+class TestStreamedSave(SewerageTestCase):
+
+    def test_same_as_not_streamed(self):
+        compared = 0
+        for rib, rmb in DATA_PAIRS:
+            sewerage = self.save(rib, rmb, stream=False)
+            if sewerage is None:
+                continue  # Files with errors
+            compared += 1
+            not_streamed = self.stored(sewerage)
+            sewerage.delete()
+
+            streamed = self.stored(self.save(rib, rmb, stream=True))
+            self.assertSameStored(streamed, not_streamed)
+        self.assertTrue(compared)
+
+    def test_same_errors_outside_mrio_lines(self):
+        rib, rmb = DATA_PAIRS[0]
+        with open(os.path.join(DATA_DIRECTORY, rmb), 'rb') as f:
+            lines = f.readlines()
+        # A *ALGE record without its fields, and an unknown record
+        lines[0] = '*ALGE|\r\n'
+        lines.insert(1, '*XXXX|12|ab\r\n')
+        rmb_path = os.path.join(self.directory, rmb)
+        with open(rmb_path, 'wb') as f:
+            f.writelines(lines)
+        mrio_lines = set(
+            line_number for line_number, line in enumerate(lines, 1)
+            if line.startswith('*MRIO'))
+
+        errors = []
+        for stream in (False, True):
+            _, _, _, rmberrors = save_uploaded_data.parse_files(
+                self.copy(rib), rmb_path, stream)
+            errors.append(sorted(
+                    (error.line_number, error.message) for error in rmberrors
+                    if error.line_number not in mrio_lines))
+        self.assertEqual(errors[0], errors[1])
+
+
+class TestMaterializeMeasurements(SewerageTestCase):
+
+    def setUp(self):
+        super(TestMaterializeMeasurements, self).setUp()
+        self.storage = save_uploaded_data.MEASUREMENT_STORAGE
+        save_uploaded_data.MEASUREMENT_STORAGE = 'packed'
+
+    def tearDown(self):
+        save_uploaded_data.MEASUREMENT_STORAGE = self.storage
+        super(TestMaterializeMeasurements, self).tearDown()
+
+    def test_rows_are_made_once(self):
+        sewerage, _ = self.save_any()
+        self.assertTrue(models.needs_measurement_rows(sewerage.pk))
+
+        self.assertTrue(sewerage.materialize_measurements())
+        self.assertFalse(models.needs_measurement_rows(sewerage.pk))
+        self.assertTrue(models.SewerMeasurement.objects.filter(
+                sewer__sewerage=sewerage).exists())
+        self.assertFalse(sewerage.materialize_measurements())
+
+
+class TestGenerateRib(SewerageTestCase):
+
+    def test_same_as_from_the_whole_rmb_file(self):
+        compared = 0
+        for rib, rmb in DATA_PAIRS:
+            sewerage = self.save(rib, rmb)
+            if sewerage is None:
+                continue  # Files with errors
+            compared += 1
+            # The reference reads measurement rows
+            sewerage.materialize_measurements()
+
+            # As generate_rib() used to write it: reading the whole RMB
+            # file, with a query per sewer for its *WAAR lines
+            expected = []
+            for _, line in enumerate_file(sewerage.rmb):
+                if line.startswith("*ALGE"):
+                    expected.append(line)
+                elif line.startswith("*RIOO"):
+                    expected.append(line)
+                    try:
+                        sewer = models.Sewer.objects.get(
+                            sewerage=sewerage, code=line[6:36].strip())
+                    except models.Sewer.DoesNotExist:
+                        continue
+                    expected.extend(sewer.generate_waar_lines_reference())
+
+            with open(sewerage.generated_rib, 'rb') as f:
+                self.assertEqual(
+                    f.read(), "".join(line + "\n" for line in expected))
+        self.assertTrue(compared)
+
+
+def write_changed_rmb(path, new_path, sewer_id, change):
+    """Write a copy of the RMB file at path to new_path, with change
+    (in the unit of the file) added to the measured values (ZYT) of the
+    *MRIO records of one sewer."""
+    with open(path, 'rb') as f, open(new_path, 'wb') as new:
+        for line in f:
+            fields = line.split('|')
+            if fields[0] == '*MRIO' and fields[3].strip() == sewer_id:
+                value = float(fields[13]) + change
+                fields[13] = '{0:>{1}}'.format(value, len(fields[13]))
+                line = '|'.join(fields)
+            new.write(line)
+
+
+class TestUpdateRmb(SewerageTestCase):
+
+    def test_rewrites_only_what_changed(self):
+        sewerage, (rib, rmb) = self.save_any()
+        before = self.stored(sewerage)
+
+        # A 20 cm dip in the first sewer with measurements
+        sewer_id = next(
+            sewer_id for sewer_id, _ in mrio.mrio_blocks(sewerage.rmb, [])
+            if sewer_id in before)
+        changed_path = os.path.join(self.directory, rmb)
+        write_changed_rmb(sewerage.rmb, changed_path, sewer_id, -200)
+
+        rmb_path = self.copy(changed_path)
+        rmberrors = []
+        rewritten = update.update_rmb(sewerage, rmb_path, rmberrors)
+        update.finish_rmb_update(sewerage, rmb_path)
+        self.assertEqual(rmberrors, [])
+        updated = self.stored(sewerage)
+
+        # The changed sewer, and those whose water levels changed
+        changed = set(
+            code for code in before if not update.same_measurements(
+                before[code][1], updated[code][1]))
+        self.assertTrue(sewer_id in changed)
+        self.assertEqual(rewritten, changed)
+        self.assertTrue(len(rewritten) < len(before))
+
+        # As if the changed file had been uploaded with the RIB file
+        sewerage.delete()
+        rebuilt = self.stored(self.save(rib, changed_path))
+        self.assertSameStored(updated, rebuilt)
+
+
+class TestSameMeasurements(TestCase):
+
+    def table(self, bobs, water_levels):
+        table = np.zeros(len(bobs), dtype=models.MEASUREMENT_DTYPE)
+        table['dist'] = np.arange(len(bobs))
+        table['bob'] = bobs
+        table['water_level'] = water_levels
+        return table
+
+    def test_nans_are_equal(self):
+        self.assertTrue(update.same_measurements(
+                self.table([1.0, 2.0], [np.nan, 2.5]),
+                self.table([1.0, 2.0], [np.nan, 2.5])))
+
+    def test_changed_value(self):
+        self.assertFalse(update.same_measurements(
+                self.table([1.0, 2.0], [np.nan, 2.5]),
+                self.table([1.0, 2.0], [np.nan, 2.6])))
+        self.assertFalse(update.same_measurements(
+                self.table([1.0, 2.0], [np.nan, 2.5]),
+                self.table([1.0, 2.0], [2.5, 2.5])))
+
+    def test_changed_length(self):
+        self.assertFalse(update.same_measurements(
+                self.table([1.0, 2.0], [np.nan, 2.5]),
+                self.table([1.0], [np.nan])))
+        self.assertFalse(update.same_measurements(
+                None, self.table([1.0], [np.nan])))
+
+    def test_x_and_y_are_not_compared(self):
+        table = self.table([1.0, 2.0], [np.nan, 2.5])
+        moved = table.copy()
+        moved['x'] += 1
+        self.assertTrue(update.same_measurements(table, moved))
+
+
+class TestCreateSewerage(TestCase):
+
+    def test_name_is_reserved(self):
+        rmberrors = []
+        sewerage = save_uploaded_data.create_sewerage(
+            '/tmp/test.RMB', rmberrors)
+        self.assertEqual(sewerage.name, 'test')
+        self.assertEqual(
+            save_uploaded_data.create_sewerage('/tmp/test.RMB', rmberrors),
+            None)
+        self.assertEqual(len(rmberrors), 1)
+        self.assertEqual(
+            models.Sewerage.objects.filter(name='test').count(), 1)
+
+
+class TestSewerageNameLock(TestCase):
+
+    def test_expired_lock_of_another_is_kept(self):
+        with tasks.sewerage_name_lock('Test') as locked:
+            self.assertTrue(locked)
+            with tasks.sewerage_name_lock('test') as locked_again:
+                self.assertFalse(locked_again)
+            # Expired, and taken by another process
+            cache.set(tasks.lock_key('test'), 'other')
+        self.assertEqual(cache.get(tasks.lock_key('test')), 'other')
+        cache.delete(tasks.lock_key('test'))
+
+
+class TestSaveManholesAndSewers(TestCase):
+
+    def test_saved_rows_belong_to_their_codes(self):
+        sewerage = models.Sewerage.objects.create(name='test')
+        putdict = dict(
+            ('PUT{0}'.format(i), {
+                    'is_sink': i == 0,
+                    'surface_level': float(i),
+                    'coordinate': (5.0 + i / 1000.0, 52.0),
+                    'rd_coordinate': (155000.0 + i, 463000.0)})
+            for i in range(6))
+        # Sewer codes that sort the other way around than their puts
+        sewerdict = dict(
+            ('RIO{0}'.format(9 - i), {
+                    'manhole_code_1': 'PUT{0}'.format(i),
+                    'manhole_code_2': 'PUT{0}'.format(i + 1),
+                    'diameter': 0.1 * (i + 1),
+                    'bob_1': -float(i),
+                    'bob_2': -float(i + 1)})
+            for i in range(5))
+
+        saved_puts = save_uploaded_data.save_manholes(sewerage, putdict)
+        self.assertEqual(sorted(saved_puts), sorted(putdict))
+        for put_id, manhole in saved_puts.iteritems():
+            self.assertEqual(manhole.code, put_id)
+            self.assertEqual(
+                manhole.ground_level, putdict[put_id]['surface_level'])
+            self.assertEqual(manhole.sink, int(putdict[put_id]['is_sink']))
+
+        saved_sewers = save_uploaded_data.save_sewers(
+            sewerage, sewerdict, putdict, saved_puts)
+        self.assertEqual(sorted(saved_sewers), sorted(sewerdict))
+        for sewer_id, sewer in saved_sewers.iteritems():
+            sewerinfo = sewerdict[sewer_id]
+            self.assertEqual(sewer.code, sewer_id)
+            self.assertEqual(sewer.diameter, sewerinfo['diameter'])
+            self.assertEqual(sewer.bob1, sewerinfo['bob_1'])
+
+            # The foreign keys as saved
+            sewer = models.Sewer.objects.get(pk=sewer.pk)
+            self.assertEqual(
+                sewer.manhole1.code, sewerinfo['manhole_code_1'])
+            self.assertEqual(
+                sewer.manhole2.code, sewerinfo['manhole_code_2'])
+
+
+class TestUploadErrorCategory(TestCase):
+
+    def test_values_are_left_out(self):
+        category = models.UploadErrorCategory.category_of
+        self.assertEqual(
+            category("Waarde in veld ZYA, '1,5x', is geen decimaal getal."),
+            category("Waarde in veld ZYA, 'abc', is geen decimaal getal."))
+        self.assertEqual(
+            category("Put referentie P12 komt meerdere keren voor."),
+            "Put referentie P# komt meerdere keren voor.")
+        self.assertNotEqual(
+            category("Veld ZYR (Type meting) ontbreekt."),
+            category("Veld ZYS (Eenheid meetwaarde) ontbreekt."))
+
+
+class TestRecordErrors(TestCase):
+
+    def setUp(self):
+        self.limits = (models.Upload.MAX_RECORDED_ERRORS,
+                       models.Upload.MAX_ERROR_CATEGORIES,
+                       models.Upload.ERROR_CHUNK_SIZE)
+        models.Upload.MAX_RECORDED_ERRORS = 5
+        models.Upload.MAX_ERROR_CATEGORIES = 3
+        models.Upload.ERROR_CHUNK_SIZE = 2
+
+    def tearDown(self):
+        (models.Upload.MAX_RECORDED_ERRORS,
+         models.Upload.MAX_ERROR_CATEGORIES,
+         models.Upload.ERROR_CHUNK_SIZE) = self.limits
+
+    def test_all_errors_counted_only_the_first_saved(self):
+        upload = models.Upload.objects.create(the_file='test.rmb')
+        upload.record_errors(
+            [Error(line_number=line, message="Fout op regel {0}.".format(line))
+             for line in range(1, 5)] +
+            [Error(line_number=10, message="Andere fout.")])
+        upload.record_errors([
+                Error(line_number=5, message="Fout op regel 5."),
+                Error(line_number=11, message="Derde fout."),
+                Error(line_number=12, message="Derde fout."),
+                Error(line_number=13, message="Vierde fout.")])
+        upload.record_error("Andere fout.", 14)
+
+        upload = models.Upload.objects.get(pk=upload.pk)
+        self.assertEqual(upload.error_count, 10)
+        self.assertEqual(
+            list(models.UploadedFileError.objects.filter(
+                    uploaded_file=upload).order_by('id').values_list(
+                    'line', flat=True)),
+            [1, 2, 3, 4, 10])
+
+        # Categories beyond the limit are counted together
+        self.assertEqual(
+            dict((category.error_message,
+                  (category.count, category.first_line))
+                 for category in models.UploadErrorCategory.objects.filter(
+                    uploaded_file=upload)),
+            {u"Fout op regel #.": (5, 1),
+             u"Andere fout.": (2, 10),
+             models.UploadErrorCategory.OTHER_ERRORS: (3, 11)})
+
+
+class TestLineIndex(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.rmb')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_same_lines_as_reading_the_file(self):
+        rnd = random.Random(0)
+        for _ in range(50):
+            with open(self.path, 'wb') as f:
+                f.write('\r\n'.join(
+                        'x' * rnd.randint(0, 20)
+                        for _ in range(rnd.randint(0, 30))))
+                f.write(rnd.choice(['', '\r\n']))
+            line_index.remove_sidecars(self.path)
+            expected = [line.rstrip('\r\n') for line in open(self.path)]
+
+            index = line_index.LineIndex.for_file(self.path)
+            self.assertFalse(os.path.exists(
+                    line_index.sidecar_path(self.path)))
+            self.assertEqual(len(index), len(expected))
+            self.assertEqual(
+                list(index.lines(1, len(expected))),
+                list(enumerate(expected, 1)))
+            self.assertEqual(
+                list(index.lines(3, 5)), list(enumerate(expected, 1))[2:5])
+
+            # From the sidecar files this time
+            line_index.save_index(self.path)
+            self.assertEqual(
+                list(line_index.LineIndex.for_file(self.path).offsets),
+                list(index.offsets))
+
+    def test_record_and_sewer_lines_same_as_reading_the_file(self):
+        paths = glob.glob(os.path.join(
+                os.path.dirname(__file__), 'data', 'f3478*.rmb'))
+        self.assertTrue(paths)
+
+        for path in paths:
+            shutil.copy(path, self.path)
+            line_index.remove_sidecars(self.path)
+            lines = [(line_number, line.rstrip('\r\n'))
+                     for line_number, line in enumerate(open(self.path), 1)]
+
+            index = line_index.LineIndex.for_file(self.path)
+            self.assertEqual(
+                list(index.record_lines(["*ALGE", "*RIOO"])),
+                [(n, line) for n, line in lines
+                 if line.startswith("*ALGE") or line.startswith("*RIOO")])
+            self.assertEqual(
+                list(index.other_lines(["*MRIO"])),
+                [(n, line) for n, line in lines
+                 if not line.startswith("*MRIO")])
+
+            by_sewer = defaultdict(list)
+            for n, line in lines:
+                if line.startswith("*MRIO"):
+                    by_sewer[line.split("|")[3].strip()].append((n, line))
+            some = sorted(by_sewer)[::3]
+            self.assertEqual(
+                list(line_index.LineIndex.for_file(self.path).sewer_lines(
+                        some)),
+                sorted(sum((by_sewer[sewer_id] for sewer_id in some), [])))
+
+
+class TestChunkedUpload(TestCase):
+
+    def setUp(self):
+        self.base_path = models.Upload.BASE_PATH
+        models.Upload.BASE_PATH = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(models.Upload.BASE_PATH)
+        models.Upload.BASE_PATH = self.base_path
+
+    def test_chunks_in_any_order_make_the_file(self):
+        rnd = random.Random(0)
+        content = ''.join(chr(rnd.randint(0, 255)) for _ in range(1000))
+        size = 64
+        parts = [content[i:i + size] for i in range(0, len(content), size)]
+
+        chunked = chunked_upload.ChunkedUpload(1, 'test')
+        order = range(len(parts))
+        rnd.shuffle(order)
+        order = [3, 0] + order  # Sent twice
+        for chunk in order:
+            chunked.start('test.rmb', len(parts), size)
+            self.assertEqual(chunked.assemble(), None)
+            chunked.write_chunk(
+                chunk, [parts[chunk][:10], parts[chunk][10:]],
+                hashlib.sha1(parts[chunk]).hexdigest())
+        self.assertEqual(
+            chunked.present_chunks(),
+            dict((chunk, hashlib.sha1(part).hexdigest())
+                 for chunk, part in enumerate(parts)))
+
+        path = chunked.assemble()
+        self.assertEqual(os.path.basename(path), 'test.rmb')
+        self.assertEqual(open(path, 'rb').read(), content)
+        self.assertEqual(chunked.assemble(), None)
+
+    def test_damaged_chunk_is_not_present(self):
+        chunked = chunked_upload.ChunkedUpload(1, 'test')
+        chunked.start('test.rmb', 2, 4)
+        self.assertRaises(
+            ValueError, chunked.write_chunk, 0, ['abcd'],
+            hashlib.sha1('abce').hexdigest())
+        self.assertEqual(chunked.present_chunks(), {})
+        self.assertRaises(ValueError, chunked.start, 'other.rmb', 2, 4)
+
+    def test_oversized_chunk_is_not_written(self):
+        chunked = chunked_upload.ChunkedUpload(1, 'test')
+        chunked.start('test.rmb', 2, 4)
+        chunked.write_chunk(1, ['wxyz'])
+        self.assertRaises(
+            ValueError, chunked.write_chunk, 0, ['abc', 'de'])
+        self.assertRaises(ValueError, chunked.write_chunk, 1, ['vwxyz'])
+        self.assertEqual(chunked.present_chunks(), {})
+        with open(chunked.data_path, 'rb') as f:
+            self.assertEqual(f.read(), 'abc\0wxyz')
@@ -0,0 +1,414 @@
+"""Updating sewerages that have already been saved.
+
+A saved sewerage used to be final: a corrected RMB file for it was
+rejected by name, and the only way to change anything was to delete
+the sewerage and upload both files again. A StoredSewerage loads a
+saved sewerage back into the dictionaries and measurement tables that
+save_uploaded_data works with, so that it can be changed and its
+lost capacity computed again, after which only the measurements that
+changed are written back.
+
+That is done for a corrected RMB file (update_rmb()), and for edits of
+the bobs of sewers and the sink flags of manholes (edit_sewerage()).
+"""
+
+import logging
+import os
+
+import numpy as np
+
+from lizard_riool import coordinates
+from lizard_riool import line_index
+from lizard_riool import lost_capacity
+from lizard_riool import models
+from lizard_riool import mrio
+from lizard_riool import save_uploaded_data
+from lizard_riool import side_profile
+
+logger = logging.getLogger(__name__)
+
+# Measurement fields that are compared to see if a sewer's measurements
+# changed; x and y follow from dist.
+COMPARED_FIELDS = (
+    'dist', 'bob', 'obb', 'virtual', 'water_level', 'flooded_pct')
+
+
+class StoredSewerage(object):
+    """A saved Sewerage, loaded from the database.
+
+    Attributes:
+    - saved_puts, saved_sewers: dictionaries code: Manhole, code: Sewer
+      (with its manholes set), like save_manholes() and save_sewers()
+      return them
+    - putdict, sewerdict: the manholes and sewers like get_puts() and
+      get_sewers() return them, as far as they are stored
+    - tables: dictionary sewer code: the stored measurements as an
+      array of MEASUREMENT_DTYPE (see models.measurement_tables())
+    - storage: how the measurements are stored, see
+      save_uploaded_data.MEASUREMENT_STORAGE
+    - network, network_tables: the SewerNetwork with computed water
+      levels and the tables it was made from, once load_network() has
+      been called. apply_edits() keeps them up to date, so that edits
+      can be made one after the other.
+    """
+
+    def __init__(self, sewerage):
+        self.sewerage = sewerage
+
+        manholes = list(models.Manhole.objects.filter(
+                sewerage=sewerage).order_by('id'))
+        self.saved_puts = dict(
+            (manhole.code, manhole) for manhole in manholes)
+
+        # Manholes are stored in WGS84
+        rd_xs, rd_ys = coordinates.transform(
+            [manhole.the_geom.x for manhole in manholes],
+            [manhole.the_geom.y for manhole in manholes],
+            coordinates.WGS84_SRID, coordinates.RD_SRID)
+        self.putdict = dict(
+            (manhole.code, {
+                    'putid': manhole.code,
+                    'coordinate': (manhole.the_geom.x, manhole.the_geom.y),
+                    'rd_coordinate': (rd_x, rd_y),
+                    'is_sink': manhole.is_sink,
+                    'surface_level': manhole.ground_level})
+            for manhole, rd_x, rd_y in zip(
+                manholes, rd_xs.tolist(), rd_ys.tolist()))
+
+        manholes_by_pk = dict(
+            (manhole.pk, manhole) for manhole in manholes)
+        self.saved_sewers = dict()
+        self.sewerdict = dict()
+        for sewer in models.Sewer.objects.filter(
+            sewerage=sewerage).order_by('id'):
+            # Prevent a query per sewer later on
+            sewer.manhole1 = manholes_by_pk[sewer.manhole1_id]
+            sewer.manhole2 = manholes_by_pk[sewer.manhole2_id]
+            self.saved_sewers[sewer.code] = sewer
+            self.sewerdict[sewer.code] = {
+                'sewer_id': sewer.code,
+                'manhole_code_1': sewer.manhole1.code,
+                'manhole_code_2': sewer.manhole2.code,
+                'bob_1': sewer.bob1,
+                'bob_2': sewer.bob2,
+                'diameter': sewer.diameter,
+                'quality': sewer.quality,
+                }
+
+        self.tables = models.measurement_tables(
+            sewerage.pk, self.saved_sewers)
+
+        packed = models.PackedMeasurements.objects.filter(
+            sewer__sewerage=sewerage).exists()
+        rows = models.SewerMeasurement.objects.filter(
+            sewer__sewerage=sewerage).exists()
+        self.storage = (
+            'both' if packed and rows else 'packed' if packed else 'rows')
+
+        self.network = None
+        self.network_tables = None
+
+    def recomputable_tables(self):
+        """Return copies of the stored tables, to compute the lost
+        capacity of again. Sewers with adaptive virtual measurements
+        (see save_uploaded_data.VIRTUAL_MEASUREMENTS) keep only their
+        ends; the point in between depends on the water levels."""
+        tables = dict()
+        for code, table in self.tables.iteritems():
+            if (save_uploaded_data.VIRTUAL_MEASUREMENTS == 'adaptive' and
+                len(table) and table['virtual'].all() and len(table) <= 3):
+                table = table[[0, -1]]
+            tables[code] = table.copy()
+        return tables
+
+    def compute_lost_capacity(self, tables):
+        """Compute the water levels and flooded pcts of tables, a
+        dictionary with a table for every sewer of this sewerage.
+        Returns the SewerNetwork."""
+        network = lost_capacity.compute_lost_capacity_of_tables(
+            self.saved_puts, self.saved_sewers, tables)
+        save_uploaded_data.add_water_level_breakpoints_to_tables(
+            self.sewerdict, tables, network)
+        return network
+
+    def changed_sewers(self, tables):
+        "Return the set of codes of sewers whose table was changed."
+        return set(
+            code for code, table in tables.iteritems()
+            if not same_measurements(self.tables.get(code), table))
+
+    def write_tables(self, tables):
+        """Replace the stored measurements of the sewers in tables (a
+        dictionary sewer code: table) by those tables, in the way they
+        are stored now."""
+        pks = [self.saved_sewers[code].pk for code in tables]
+        for i in range(0, len(pks), save_uploaded_data.MAX_PKS_PER_QUERY):
+            chunk = pks[i:i + save_uploaded_data.MAX_PKS_PER_QUERY]
+            models.SewerMeasurement.objects.filter(
+                sewer__pk__in=chunk).delete()
+            models.PackedMeasurements.objects.filter(
+                sewer__pk__in=chunk).delete()
+
+        save_uploaded_data.save_measurement_tables(
+            self.saved_sewers, tables, self.storage)
+
+        # As they will be loaded next time
+        for code, table in tables.iteritems():
+            self.tables[code] = table[
+                np.argsort(table['dist'], kind='mergesort')]
+
+    def load_network(self):
+        """Make the SewerNetwork of this sewerage and compute its water
+        levels, unless that was already done. Returns it."""
+        if self.network is None:
+            self.network_tables = self.recomputable_tables()
+            self.network = lost_capacity.create_network(
+                self.saved_puts, self.saved_sewers, self.network_tables)
+            self.network.compute_water_level()
+        return self.network
+
+    def apply_edits(self, bobs=None, sinks=None):
+        """Change the bobs of sewers and the sink flags of manholes, and
+        compute the water levels again where they can change, see
+        SewerNetwork.update_water_level(). bobs is a dictionary sewer
+        code: (bob1, bob2), sinks a dictionary manhole code: True or
+        False.
+
+        The Sewer and Manhole rows are saved, and the measurements of
+        the edited sewers and of the sewers whose water levels changed
+        are written back, as far as they changed. Returns the set of
+        codes of those sewers."""
+        bobs = bobs or {}
+        sinks = sinks or {}
+        for code in bobs:
+            if code not in self.saved_sewers:
+                raise ValueError("Unknown sewer: {0}".format(code))
+        for code in sinks:
+            if code not in self.saved_puts:
+                raise ValueError("Unknown manhole: {0}".format(code))
+
+        previous = self.load_network()
+
+        for code, (bob1, bob2) in bobs.iteritems():
+            sewer = self.saved_sewers[code]
+            sewer.bob1, sewer.bob2 = bob1, bob2
+            self.sewerdict[code]['bob_1'] = bob1
+            self.sewerdict[code]['bob_2'] = bob2
+            sewer.save()
+        for code, is_sink in sinks.iteritems():
+            manhole = self.saved_puts[code]
+            manhole.sink = int(bool(is_sink))
+            self.putdict[code]['is_sink'] = manhole.is_sink
+            manhole.save()
+
+        # The measurements of an edited sewer are corrected with its
+        # bobs (see save_uploaded_data.bob_corrections()), so they are
+        # made again
+        self.network_tables.update(self.edited_tables(bobs))
+
+        network = lost_capacity.create_network(
+            self.saved_puts, self.saved_sewers, self.network_tables)
+        with save_uploaded_data.log_duration("Updating water levels"):
+            changed = network.update_water_level(previous)
+        self.network = network
+
+        affected = network.sewers_with_nodes(changed) | set(bobs)
+        logger.info(
+            "Editing %s: %d sewers may have changed.",
+            self.sewerage, len(affected))
+
+        # Copies, as water level breakpoints are added to them
+        tables = dict(
+            (code, self.network_tables[code].copy()) for code in affected)
+        lost_capacity.add_lost_capacity_to_tables(
+            tables, self.saved_sewers, network)
+        save_uploaded_data.add_water_level_breakpoints_to_tables(
+            self.sewerdict, tables, network)
+
+        rewritten = self.changed_sewers(tables)
+        self.write_tables(dict((code, tables[code]) for code in rewritten))
+        return rewritten
+
+    def edited_tables(self, codes):
+        """Return a dictionary sewer code: measurement table, made again
+        from the sewerage's RMB file for the sewers in codes. The file
+        was read without errors before; if it has them now, ValueError
+        is raised."""
+        codes = set(codes)
+        tables = dict()
+        if codes and self.sewerage.rmb and os.path.exists(self.sewerage.rmb):
+            rmberrors = []
+            for sewer_id, lines in mrio.sewer_blocks(
+                self.sewerage.rmb, codes, rmberrors):
+                sewer_id, tables[sewer_id], _, errors = (
+                    save_uploaded_data.sewer_table(
+                        (sewer_id, save_uploaded_data.sewerinfo_and_puts(
+                                self.sewerdict[sewer_id], self.putdict),
+                         lines)))
+                rmberrors.extend(errors)
+            if rmberrors:
+                raise ValueError(
+                    "Errors in {0}: {1}".format(self.sewerage.rmb, rmberrors))
+
+        # Sewers without *MRIO records
+        for code in codes - set(tables):
+            tables[code] = save_uploaded_data.measurement_table(
+                self.sewerdict[code], self.putdict, [])
+        return tables
+
+
+def same_measurements(table1, table2):
+    """Return True if two measurement tables have the same values in
+    COMPARED_FIELDS. NaNs are equal to each other."""
+    if table1 is None or table2 is None or len(table1) != len(table2):
+        return False
+
+    for field in COMPARED_FIELDS:
+        column1, column2 = table1[field], table2[field]
+        if column1.dtype.kind == 'f':
+            equal = (column1 == column2) | (
+                np.isnan(column1) & np.isnan(column2))
+        else:
+            equal = column1 == column2
+        if not equal.all():
+            return False
+    return True
+
+
+def update_rmb(sewerage, rmb_path, rmberrors):
+    """Update a saved sewerage with a new version of its RMB file.
+
+    The manholes and sewers are kept. The *MRIO records of each sewer
+    are compared to those in the sewerage's current RMB file, and only
+    sewers whose records changed (or disappeared) get new measurements.
+    Then the lost capacity is computed again, and the measurements of
+    the changed sewers and of the sewers whose water levels changed
+    because of them are rewritten.
+
+    Errors in the file are appended to rmberrors; then nothing is
+    changed and None is returned. Otherwise the set of codes of
+    rewritten sewers is returned. Only the database is changed; once
+    that is committed, finish_rmb_update() replaces the files."""
+    stored = StoredSewerage(sewerage)
+    putdict, sewerdict = stored.putdict, stored.sewerdict
+
+    if sewerage.rmb and os.path.exists(sewerage.rmb):
+        old_digests = mrio.block_digests(sewerage.rmb)
+    else:
+        old_digests = None  # Everything is new
+
+    sewer_ids_in_file = set()
+
+    def changed_units():
+        for sewer_id, lines in mrio.mrio_blocks(rmb_path, rmberrors):
+            if sewer_id not in sewerdict:
+                continue
+            sewer_ids_in_file.add(sewer_id)
+            if (old_digests is not None and
+                old_digests.get(sewer_id) == mrio.block_digest(lines)):
+                continue
+            yield (sewer_id, save_uploaded_data.sewerinfo_and_puts(
+                    sewerdict[sewer_id], putdict), lines)
+
+    new_tables = dict()
+    qualities = dict()
+    for sewer_id, table, quality, errors in save_uploaded_data.map_sewers(
+        save_uploaded_data.sewer_table, changed_units()):
+        rmberrors.extend(errors)
+        if not rmberrors:
+            new_tables[sewer_id] = table
+            qualities[sewer_id] = quality
+
+    if rmberrors:
+        return None
+
+    # Sewers whose *MRIO records were removed get virtual measurements
+    if old_digests is None:
+        removed = set(sewerdict) - sewer_ids_in_file
+    else:
+        removed = (set(old_digests) & set(sewerdict)) - sewer_ids_in_file
+    for sewer_id in removed:
+        new_tables[sewer_id] = save_uploaded_data.measurement_table(
+            sewerdict[sewer_id], putdict, [])
+        qualities[sewer_id] = sewerdict[sewer_id]['quality']
+
+    logger.info(
+        "Updating %s: %d sewers have new measurements.",
+        sewerage, len(new_tables))
+
+    # The water levels of all sewers are computed again, which is
+    # cheap compared to writing them; only those that changed are
+    # written.
+    tables = stored.recomputable_tables()
+    tables.update(new_tables)
+    with save_uploaded_data.log_duration("Computing lost capacity"):
+        stored.compute_lost_capacity(tables)
+
+    rewritten = set(new_tables) | stored.changed_sewers(tables)
+    with save_uploaded_data.log_duration("Saving measurements"):
+        stored.write_tables(
+            dict((code, tables[code]) for code in rewritten))
+
+    for sewer_id, quality in qualities.iteritems():
+        stored.saved_sewers[sewer_id].quality = quality
+    save_uploaded_data.save_sewer_qualities(
+        [stored.saved_sewers[sewer_id] for sewer_id in qualities],
+        include_unknown=True)
+
+    return rewritten
+
+
+def finish_rmb_update(sewerage, rmb_path):
+    """After the transaction of update_rmb() has been committed, move
+    the new RMB file in place of the old one, and make the generated
+    RIB file and the side profile cache again. Until then, the old
+    files stay, so that a rolled back update leaves them as they
+    were."""
+    sewerage.replace_rmb(rmb_path)
+
+    with save_uploaded_data.log_duration("Generating RIB"):
+        sewerage.generate_rib()
+
+    with save_uploaded_data.log_duration("Caching side profile data"):
+        side_profile.build_cache(sewerage.pk)
+
+
+def edit_sewerage(sewerage, bobs=None, sinks=None):
+    """Edit the bobs of sewers and the sink flags of manholes of a
+    saved sewerage, see StoredSewerage.apply_edits(), and make its
+    generated RIB file and side profile cache again. Returns the set of
+    codes of rewritten sewers. Call it in a transaction.
+
+    To try several edits after each other, keep a StoredSewerage and
+    call its apply_edits() instead; its water levels are computed from
+    scratch only once."""
+    stored = StoredSewerage(sewerage)
+    with save_uploaded_data.log_duration("Computing lost capacity"):
+        stored.load_network()
+
+    with save_uploaded_data.log_duration("Saving measurements"):
+        rewritten = stored.apply_edits(bobs, sinks)
+
+    with save_uploaded_data.log_duration("Generating RIB"):
+        sewerage.generate_rib()
+
+    with save_uploaded_data.log_duration("Caching side profile data"):
+        side_profile.build_cache(sewerage.pk)
+
+    return rewritten
+
+
+def protected_rmb_update(sewerage, rmb_upload):
+    """Like save_uploaded_data.protected_file_processing(), for an RMB
+    upload that updates an existing sewerage. Called from tasks.py,
+    wrapped in a transaction. Returns True if the sewerage was
+    updated; then finish_rmb_update() must be called once the
+    transaction is committed."""
+    line_index.save_index(rmb_upload.full_path)
+
+    rmberrors = []
+    if update_rmb(sewerage, rmb_upload.full_path, rmberrors) is None:
+        rmb_upload.record_errors(rmberrors)
+        rmb_upload.set_unsuccessful()
+        return False
+    return True
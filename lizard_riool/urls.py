@@ -14,6 +14,7 @@ urlpatterns = patterns(
     # Upload pages
     (r'^beheer/uploads/$', login_required(views.UploadsView.as_view())),
     (r'^beheer/uploads/files/$', views.uploaded_file_list),
+    (r'^beheer/uploads/files/changes/$', views.uploaded_file_changes),
     # The next line expects DELE requests
     url('^beheer/uploads/files/uploaded-file-(?P<upload_id>\d+)/$',
         login_required(views.delete_uploaded_file),
@@ -50,6 +51,9 @@ urlpatterns = patterns(
             views.FileView.as_view(template_name="lizard_riool/files.html"))),
     url(r'^beheer/files/upload/$', login_required(views.UploadView.as_view()),
         name="upload_dialog_url"),
+    url(r'^beheer/files/upload/chunks/$',
+        login_required(views.upload_chunks),
+        name="lizard_riool_upload_chunks"),
     (r'^beheer/files/delete/(?P<id>\d+)/$', login_required(
             views.DeleteFileView.as_view())),
     (r'^langsprofielen/$', login_required(views.SideProfileView.as_view())),
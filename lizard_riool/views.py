@@ -2,27 +2,32 @@
 
 from __future__ import division
 
+from cStringIO import StringIO
+import hashlib
 import logging
 import os.path
-import tempfile
+import time
 import urllib
+import uuid
 
 from django.conf import settings
 from django.contrib.gis.geos import Point
-from django.core.paginator import Paginator
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
 from django.core.urlresolvers import reverse
 from django.http import Http404
 from django.http import HttpResponse
+from django.http import HttpResponseBadRequest
+from django.http import HttpResponseNotModified
 from django.utils import simplejson as json
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe
 from django.views.decorators.http import require_http_methods
 from django.views.generic import TemplateView, View
 from django.views.static import serve
 
 from matplotlib import figure, transforms
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-import networkx as nx
 
-from lizard_map.coordinates import RD
 from lizard_map.matplotlib_settings import SCREEN_DPI
 from lizard_map.models import WorkspaceEditItem
 from lizard_map.views import AppView
@@ -31,32 +36,32 @@ from lizard_ui.views import ViewContextMixin
 from sufriblib.parsers import enumerate_file
 
 from lizard_riool import tasks
+from lizard_riool import coordinates
+from lizard_riool import image_cache
+from lizard_riool import line_index
 from lizard_riool import models
+from lizard_riool import progress
+from lizard_riool import routing
+from lizard_riool import side_profile
+from lizard_riool.chunked_upload import ChunkedUpload
 from lizard_riool.layers import SewerageAdapter
 from lizard_riool.models import Upload
-from lizard_riool.models import Sewer
 from lizard_riool.models import Sewerage
 from lizard_riool.models import UploadedFileError
 from lizard_riool.waar import WAAR
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of uploads per page of uploaded_file_list()
+UPLOADS_PER_PAGE = 200
 
-def transform(the_geom, srid):
-    """Perform an in-place geometry transformation.
-
-    the_geom: a GEOSGeometry
-    srid: an integer SRID
-
-    GEOS transform() is not accurate for 28992.
-    The infamous towgs84 parameter is missing?
-
-    """
-
-    if srid == 28992:
-        the_geom.transform(RD)
-    else:
-        the_geom.transform(srid)
+# uploaded_file_changes() answers after at most POLL_TIMEOUT seconds,
+# and looks at the version every POLL_INTERVAL seconds. With a
+# POLL_TIMEOUT of 0 it answers right away, and tells beheer.js to ask
+# again after RETRY_AFTER seconds.
+POLL_TIMEOUT = getattr(settings, 'LIZARD_RIOOL_UPLOADS_POLL_TIMEOUT', 20)
+POLL_INTERVAL = 0.5
+RETRY_AFTER = 2
 
 
 class ScreenFigure(figure.Figure):
@@ -172,23 +177,47 @@ class SideProfileGraph2(View):
         width = int(request.GET['width'])
         height = int(request.GET['height'])
 
-        # Create an empty graph.
-
-        G = nx.Graph()
-
-        # Create nodes (manholes) and edges (sewers).
+        # Images are cached on disk; browsers get an ETag and
+        # Last-Modified, so that they can revalidate their copy.
+
+        key = image_cache.image_key(
+            sewerage_pk, manholes, width, height,
+            side_profile.data_version(sewerage_pk))
+        etag = '"{key}"'.format(key=key)
+
+        if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            return self.not_modified(etag)
+
+        png, mtime = image_cache.get(key)
+        if png is None:
+            png, mtime = image_cache.render(
+                key, self.render_png, sewerage_pk, manholes, width, height)
+
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        if (if_modified_since is not None and
+            'HTTP_IF_NONE_MATCH' not in request.META and
+            int(mtime) <= if_modified_since):
+            return self.not_modified(etag)
+
+        response = HttpResponse(png, content_type='image/png')
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(mtime)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
 
-        sewers = (
-            Sewer.objects.filter(sewerage__pk=sewerage_pk).
-            select_related('manhole1', 'manhole2')
-        )
+    def not_modified(self, etag):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
 
-        for sewer in sewers:
-            G.add_edge(sewer.manhole1, sewer.manhole2, sewer=sewer)
+    def render_png(self, sewerage_pk, manholes, width, height):
+        "Draw the side profile and return it as a PNG."
 
-        # Create a convience dict, mapping a manhole to its code.
+        # All data comes from arrays that are computed once per
+        # sewerage.
 
-        d = {manhole.code: manhole for manhole in G.nodes()}
+        profile = side_profile.get_side_profile_data(sewerage_pk)
 
         # Create matplotlib figure.
 
@@ -200,15 +229,15 @@ class SideProfileGraph2(View):
         xs = [0]
 
         for i in range(len(manholes) - 1):
-            sewer = G[d[manholes[i]]][d[manholes[i + 1]]]['sewer']
-            xs.append(xs[-1] + sewer.the_geom_length)
+            xs.append(
+                xs[-1] + profile.length(manholes[i], manholes[i + 1]))
 
         # Visualize ground level.
 
         ground_levels = []
 
         for manhole in manholes:
-            ground_levels.append(d[manhole].ground_level)
+            ground_levels.append(profile.ground_levels[manhole])
 
         ax1.plot(xs, ground_levels, color='green')
 
@@ -216,28 +245,15 @@ class SideProfileGraph2(View):
 
         for i in range(len(manholes) - 1):
 
-            bobx, boby, obby, water = [], [], [], []
-            sewer = G[d[manholes[i]]][d[manholes[i + 1]]]['sewer']
-
-            for measurement in sewer.measurements.order_by('dist'):
-                bobx.append(measurement.dist)
-                boby.append(measurement.bob)
-                obby.append(measurement.obb)
-                # Sewers that are not connected to a sink,
-                # either directly or indirectly, have a
-                # water_level of `None`.
-                if measurement.water_level is not None:
-                    water_level = measurement.water_level
-                else:
-                    water_level = measurement.bob
-                water.append(water_level)
-
-            if sewer.manhole1.code == manholes[i]:
+            bobx, boby, obby, water, reverse = profile.measurements(
+                manholes[i], manholes[i + 1])
+
+            if not reverse:
                 # Direction manhole1 => manhole2
-                bobx = [x + xs[i] for x in bobx]
+                bobx = bobx + xs[i]
             else:
                 # Direction manhole2 => manhole1
-                bobx = [xs[i + 1] - x for x in bobx]
+                bobx = xs[i + 1] - bobx
 
             ax1.plot(bobx, boby, color='brown')
             ax1.plot(bobx, obby, color='brown')
@@ -265,51 +281,52 @@ class SideProfileGraph2(View):
 
         # Return image as png.
 
-        response = HttpResponse(content_type='image/png')
+        png = StringIO()
         canvas = FigureCanvas(fig)
-        canvas.print_png(response)
+        canvas.print_png(png)
 
-        return response
+        return png.getvalue()
 
 
 class UploadView(TemplateView):
     "Process file uploads."
     template_name = "lizard_riool/plupload.html"
-    dtemp = tempfile.mkdtemp()
 
     @classmethod
     def process(cls, request):
 
-        # Create a temporary directory for file uploads.
-
-        if not os.path.exists(cls.dtemp):
-            cls.dtemp = tempfile.mkdtemp()
-
         # request.POST['filename'] = the client-side filename.
         # request.FILES['file'] = the name of a part.
         # These will be equal for small files only.
 
         filename = request.POST['filename']
-
-        fullpath = os.path.join(cls.dtemp, filename)
         chunks = int(request.POST.get('chunks', 1))
         chunk = int(request.POST.get('chunk', 0))
-
-        # Start a new file or append the next chunk.
-        # NB: Django manages its own chunking.
-
-        with open(fullpath, 'wb' if chunk == 0 else 'ab') as f:
-            for b in request.FILES['file'].chunks():
-                f.write(b)
-
-        # On successful parsing, store the uploaded file in its permanent
-        # location. Some information will be stored into the database as
-        # well for convenience and performance. Roll back on any error.
-
-        if chunk == chunks - 1:
-            upload = Upload()
+        chunk_size = int(request.POST.get('chunk_size', 0))
+
+        # Chunks are kept per upload session, which the client names
+        # (see chunked_upload.py). A file in a single chunk doesn't
+        # need one.
+        session = request.POST.get('session')
+        if not session and chunks == 1:
+            session = uuid.uuid4().hex
+
+        chunked = ChunkedUpload(request.user.pk, session)
+        chunked.start(filename, chunks, chunk_size)
+        chunked.write_chunk(
+            chunk, request.FILES['file'].chunks(),
+            request.POST.get('checksum'))
+
+        # Once all chunks are there, move the file to its permanent
+        # location and process it there.
+
+        fullpath = chunked.assemble()
+        if fullpath:
+            # RMB files can update an existing sewerage instead
+            upload = Upload(is_update=bool(request.POST.get('update')))
             upload.move_file(fullpath)
-            tasks.process_uploaded_file.delay(upload)
+            chunked.remove()
+            tasks.process_uploaded_file_when_ready.delay(upload.id)
 
     @classmethod
     def post(cls, request, *args, **kwargs):
@@ -329,6 +346,22 @@ class UploadView(TemplateView):
         return HttpResponse(json.dumps(result), mimetype="application/json")
 
 
+def upload_chunks(request):
+    """The chunks of the upload session in the 'session' parameter
+    that are present, as {"chunks": {chunk number: SHA-1 checksum}}.
+    A client resumes an upload by sending only the other chunks."""
+    try:
+        chunked = ChunkedUpload(request.user.pk, request.GET.get('session'))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    response = HttpResponse(
+        json.dumps({"chunks": chunked.present_chunks()}),
+        mimetype="application/json")
+    patch_cache_control(response, no_cache=True, no_store=True)
+    return response
+
+
 class JSONResponseMixin(object):
 
     def render_to_response(self, context={}):
@@ -382,11 +415,13 @@ class ManholeFinder(View, JSONResponseMixin):
         except:
             return self.render_to_response()
 
-        transform(manhole.the_geom, srid)
+        x, y = coordinates.transform_point(
+            manhole.the_geom.x, manhole.the_geom.y,
+            manhole.the_geom.srid, srid)
 
         context = {
-            'x': manhole.the_geom.x,
-            'y': manhole.the_geom.y,
+            'x': x,
+            'y': y,
             'put': manhole.code,
             'upload_id': manhole.sewerage.pk,
         }
@@ -408,42 +443,22 @@ class PathFinder(View, JSONResponseMixin):
 
         srid = int(srs.split(':')[1])  # e.g. 28992
 
-        # Create an empty graph.
-
-        G = nx.Graph()
-
-        # Create nodes (manholes) and edges (sewers).
-
-        sewers = (
-            Sewer.objects.filter(sewerage__pk=sewerage_pk).
-            select_related('manhole1', 'manhole2')
-        )
+        # Route along the fewest sewers, or the shortest total length
+        weighted = request.GET.get('weight') == 'length'
 
-        for sewer in sewers:
-            manhole1, manhole2 = sewer.manhole1, sewer.manhole2
-            G.add_edge(manhole1.code, manhole2.code, streng=sewer.code)
-            G.node[manhole1.code]['location'] = manhole1.the_geom
-            G.node[manhole2.code]['location'] = manhole2.the_geom
+        index = routing.get_index(sewerage_pk)
 
         try:
-            path = nx.shortest_path(G, source, target)
-        except Exception, e:
+            path, strengen = index.shortest_path(source, target, weighted)
+        except ValueError, e:
             logger.error(e)
             context = {'strengen': [], 'putten': []}
             return self.render_to_response(context)
 
-        strengen = []
-
-        for i in range(len(path) - 1):
-            streng = G.edge[path[i]][path[i + 1]]['streng']
-            strengen.append(streng)
-
         putten = []
 
-        for put in path:
-            location = G.node[put]['location']
-            transform(location, srid)
-            put = {'put': put, 'x': location.x, 'y': location.y}
+        for put, (x, y) in zip(path, index.locations(path, srid)):
+            put = {'put': put, 'x': x, 'y': y}
             putten.append(put)
 
         context = {'strengen': strengen, 'putten': putten}
@@ -457,33 +472,126 @@ class UploadsView(AppView):
 
 
 def uploaded_file_list(request):
-    return HttpResponse(json.dumps([
-                {
-                    "id": "uploaded-file-{0}".format(upload.pk),
-                    "name": upload.filename,
-                    "status": upload.status_string(),
-                    "error_description": upload.error_description(),
-                    "error_url": reverse(
-                        "lizard_riool_uploaded_file_error_view",
-                        kwargs={"upload_id": upload.id}),
-                    "delete_url": reverse(
-                        "lizard_riool_delete_uploaded_file",
-                        kwargs={"upload_id": upload.id})
-                    }
-                for upload in Upload.objects.all()
-                ]), mimetype="application/json")
+    """A page of the uploads feed that beheer.js polls: the uploads
+    with an id greater than the 'after' parameter, at most 'limit' of
+    them, and the 'next' value of 'after', or null on the last page.
+
+    The ETag is a digest of what the page shows of its own uploads (see
+    models.upload_page_rows()) and of the progress of those being
+    processed, so that when one upload changes, only its page is sent
+    again; the others return 304."""
+    try:
+        after = int(request.GET.get('after', 0))
+    except ValueError:
+        after = 0
+    try:
+        limit = min(int(request.GET.get('limit', UPLOADS_PER_PAGE)),
+                    UPLOADS_PER_PAGE)
+    except ValueError:
+        limit = UPLOADS_PER_PAGE
+    limit = max(limit, 1)
+
+    # Progress is in the cache, not in the rows. Both are looked at
+    # before the page is made, so that a change meanwhile gets a new
+    # ETag at the next poll.
+    rows = models.upload_page_rows(after, limit)
+    progresses = progress.upload_progress([
+            pk for pk, _, status, _ in rows[:limit]
+            if status == Upload.BEING_PROCESSED])
+    etag = '"uploads-{0}"'.format(hashlib.sha1(json.dumps(
+                [after, limit, rows, progresses],
+                sort_keys=True, default=str)).hexdigest())
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    uploads, first_errors, next_after = models.upload_statuses(after, limit)
+    response = HttpResponse(json.dumps({
+                "uploads": [
+                    {
+                        "id": "uploaded-file-{0}".format(upload.pk),
+                        "name": upload.filename,
+                        "status": upload.status_string(),
+                        "error_description": upload.error_description(
+                            first_errors.get(upload.pk)),
+                        "progress": progresses.get(upload.pk),
+                        "error_url": reverse(
+                            "lizard_riool_uploaded_file_error_view",
+                            kwargs={"upload_id": upload.id}),
+                        "delete_url": reverse(
+                            "lizard_riool_delete_uploaded_file",
+                            kwargs={"upload_id": upload.id})
+                        }
+                    for upload in uploads],
+                "next": next_after,
+                }), mimetype="application/json")
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def uploaded_file_changes(request):
+    """Long poll for beheer.js: answer with the current version of the
+    uploads feed as soon as it differs from the 'version' parameter,
+    or after POLL_TIMEOUT seconds. Uploads and the progress of their
+    processing (see progress.py) change the version. beheer.js only
+    waits here while some of its files are waiting or being processed,
+    and fetches the pages of the feed only when the version changed.
+
+    A waiting browser holds a worker for up to POLL_TIMEOUT seconds.
+    Run the site with threaded or asynchronous workers (gunicorn
+    --threads or gevent, mod_wsgi threads) to have long polls. With
+    a few sync workers, set LIZARD_RIOOL_UPLOADS_POLL_TIMEOUT to 0
+    instead: this then answers right away, with a Retry-After header
+    that spaces out the polls."""
+    version = request.GET.get('version', '')
+    deadline = time.time() + POLL_TIMEOUT
+
+    current = models.uploads_version()
+    while str(current) == version and time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+        current = models.uploads_version()
+
+    response = HttpResponse(
+        json.dumps({"version": current}), mimetype="application/json")
+    if POLL_TIMEOUT <= 0:
+        response['Retry-After'] = str(RETRY_AFTER)
+    patch_cache_control(response, no_cache=True, no_store=True)
+    return response
 
 
 class UploadedFileErrorsView(ViewContextMixin, TemplateView):
+    """The errors of an upload, with the lines of the file they are on.
+
+    Only a few lines around each error are read from the file, with a
+    line_index.LineIndex. Errors are shown ERROR_LINES_PER_PAGE lines
+    at a time (?page=N), or any range of lines can be shown
+    (?start=L&count=C), with a link to the range of the next error."""
     template_name = 'lizard_riool/uploaded_file_error_page.html'
 
+    ERROR_LINES_PER_PAGE = 50
+    CONTEXT_LINES = 2  # Shown before and after each line with errors
+    DEFAULT_COUNT = 100
+    MAX_COUNT = 1000
+
     def get(self, request, upload_id):
         self.uploaded_file = Upload.objects.get(pk=upload_id)
         self.user = request.user
 
-        self.errors = self._errors()
         self.general_errors = self._general_errors()
-        self.lines_and_errors = self._lines_and_errors()
+        self.error_categories = self._error_categories()
+        self.unrecorded_error_count = max(
+            0, self.uploaded_file.error_count - self._errors().count())
+
+        self.page = None
+        self.next_error_url = None
+        if 'start' in request.GET:
+            error_lines = self._range(request.GET)
+        else:
+            error_lines = self._page(request.GET.get('page'))
+        self.lines_and_errors = self._lines_and_errors(error_lines)
+        self.errors = self._errors().exists()
 
         return super(UploadedFileErrorsView, self).get(request)
 
@@ -491,42 +599,116 @@ class UploadedFileErrorsView(ViewContextMixin, TemplateView):
         return UploadedFileError.objects.filter(
             uploaded_file=self.uploaded_file).order_by('line')
 
+    def _error_categories(self):
+        """Return the counted kinds of errors, if there is more than
+        one error."""
+        if self.uploaded_file.error_count <= 1:
+            return []
+        return [category.message() for category in
+                self.uploaded_file.error_categories.all()]
+
     def _general_errors(self):
         """Return the errors that have line number 0."""
-        return [error.error_message
-                for error in self.errors if error.line == 0]
+        return list(self._errors().filter(line=0).values_list(
+                'error_message', flat=True))
+
+    def _page(self, page_number):
+        """Set self.page to a page of the line numbers that have errors,
+        and return those line numbers, each with the lines around
+        it."""
+        paginator = Paginator(
+            self._errors().filter(line__gt=0).values_list(
+                'line', flat=True).distinct(),
+            UploadedFileErrorsView.ERROR_LINES_PER_PAGE)
+        try:
+            self.page = paginator.page(page_number or 1)
+        except (EmptyPage, PageNotAnInteger):
+            self.page = paginator.page(paginator.num_pages)
+
+        context = UploadedFileErrorsView.CONTEXT_LINES
+        return list(self.page.object_list), [
+            (line - context, line + context)
+            for line in self.page.object_list]
+
+    def _range(self, parameters):
+        """Return the line numbers with errors among the requested
+        range of lines, and that range. Sets self.next_error_url to
+        the range around the first error after it."""
+        try:
+            start = max(1, int(parameters.get('start')))
+        except ValueError:
+            start = 1
+        try:
+            count = int(parameters.get(
+                    'count', UploadedFileErrorsView.DEFAULT_COUNT))
+        except ValueError:
+            count = UploadedFileErrorsView.DEFAULT_COUNT
+        count = min(max(count, 1), UploadedFileErrorsView.MAX_COUNT)
+        last = start + count - 1
 
-    def _lines_and_errors(self):
-        """Return a line-for-line of the file, with errors.
+        errors = self._errors()
+        for next_error in errors.filter(line__gt=last)[:1]:
+            self.next_error_url = "?start={0}&count={1}".format(
+                max(1, next_error.line - UploadedFileErrorsView.CONTEXT_LINES),
+                count)
+
+        return (list(errors.filter(line__gte=start, line__lte=last)
+                     .values_list('line', flat=True).distinct()),
+                [(start, last)])
+
+    def _lines_and_errors(self, error_lines):
+        """Return the lines of the file in the given windows, with
+        errors. error_lines is (line numbers with errors, list of
+        (first, last) line number of each window).
 
         Each line is a dictionary:
         - 'line_number' (1, ...)
         - 'has_error' (boolean)
         - 'file_line' (string)
         - 'errors' (list of strings)
+        - 'gap' (boolean, True if lines before it are skipped)
         """
+        lines_with_errors, windows = error_lines
 
         errordict = dict()
-        for error in self.errors:
-            if error.line > 0:
-                errordict.setdefault(error.line, []).append(
-                    error.error_message)
+        for error in self._errors().filter(line__in=lines_with_errors):
+            errordict.setdefault(error.line, []).append(
+                error.error_message)
 
         lines = []
         path = self.uploaded_file.the_file
-        if errordict and os.path.exists(path):
-            for line_minus_one, line in enumerate(open(path)):
-                line_number = line_minus_one + 1
+        if not windows or not os.path.exists(path):
+            return lines
+
+        index = line_index.LineIndex.for_file(path)
+        previous = None
+        for first, last in merged_windows(windows):
+            for line_number, line in index.lines(first, last):
                 lines.append({
                         'line_number': line_number,
                         'has_error': line_number in errordict,
-                        'file_line': line.strip("\r\n"),
-                        'file_line_short': line.strip("\r\n")[:300],
-                        'errors': errordict.get(line_number)})
+                        'file_line': line,
+                        'file_line_short': line[:300],
+                        'errors': errordict.get(line_number),
+                        'gap': (previous is not None and
+                                line_number > previous + 1)})
+                previous = line_number
 
         return lines
 
 
+def merged_windows(windows):
+    """Return sorted (first, last) windows of line numbers, with those
+    that overlap or touch merged."""
+    merged = []
+    for first, last in sorted(windows):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
 def delete_uploaded_file(request, upload_id):
     if request.method != "DELETE":
         return
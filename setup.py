@@ -21,6 +21,8 @@ install_requires = [
     'lizard-ui >= 4.0, < 5.0',
     'pkginfo',
     'networkx',
+    'numpy',
+    'pyproj',
     'sufriblib',
     ],
 